@@ -31,5 +31,16 @@ class StaleCompletionAdmin(admin.ModelAdmin):
     search_fields = ['^course_key', '^block_key', '^username']
 
 
+class StaleEnrollmentAdmin(admin.ModelAdmin):
+    """
+    Custom admin for StaleEnrollment model.
+    """
+
+    date_hierarchy = 'modified'
+    list_display = ['id', 'course_key', 'username', 'all_blocks', 'force', 'created', 'modified']
+    search_fields = ['^course_key', '^username']
+
+
 admin.site.register(models.Aggregator, AggregatorAdmin)
 admin.site.register(models.StaleCompletion, StaleCompletionAdmin)
+admin.site.register(models.StaleEnrollment, StaleEnrollmentAdmin)
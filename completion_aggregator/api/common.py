@@ -78,7 +78,7 @@ class CompletionViewMixin(object):
     Common functionality for completion views.
     """
 
-    _allowed_requested_fields = {'mean', 'username'}
+    _allowed_requested_fields = {'mean', 'username', 'stale'}
     permission_classes = (IsAuthenticated,)
     _effective_user = None
     _requested_user = None
@@ -58,6 +58,8 @@ class CompletionListView(CompletionViewMixin, APIView):
 
         * mean (float): The average completion ratio for all students enrolled
           in the course.
+        * stale (bool): True if the course had stale completions that could
+          not be recalculated in time, so the completion is out of date.
         * Aggregations: The actual fields available are configurable, but
           may include `chapter`, `sequential`, or `vertical`.  If requested,
           the field will be a list of all blocks of that type containing
@@ -184,20 +186,13 @@ class CompletionListView(CompletionViewMixin, APIView):
             user=self.user,
             course_key__in=course_keys
         )
-        aggregators_by_enrollment = defaultdict(list)
+        aggregators_by_course = defaultdict(list)
         for agg in aggregator_queryset:
-            aggregators_by_enrollment[self.user, agg.course_key].append(agg)
+            aggregators_by_course[agg.course_key].append(agg)
 
         # Create the list of aggregate completions to be serialized,
         # recalculating any stale completions for this single user.
-        completions = [
-            serializers.AggregatorAdapter(
-                user=self.user,
-                course_key=enrollment.course_id,
-                aggregators=aggregators_by_enrollment[self.user, enrollment.course_id],
-                recalculate_stale=True,
-            ) for enrollment in paginated
-        ]
+        completions = serializers.get_user_adapters(self.user, course_keys, aggregators_by_course)
 
         # Return the paginated, serialized completions
         serializer = self.get_serializer_class()(
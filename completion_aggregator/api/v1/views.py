@@ -15,8 +15,7 @@ from rest_framework.views import APIView
 from django.db.models import Avg, Sum
 from django.http import JsonResponse
 
-from ... import compat, serializers
-from ...models import StaleCompletion
+from ... import compat, serializers, stale
 from ...utils import WAFFLE_AGGREGATE_STALE_FROM_SCRATCH
 from ..common import CompletionViewMixin, UserEnrollments
 
@@ -59,6 +58,8 @@ class CompletionListView(CompletionViewMixin, APIView):
 
         * mean (float): The average completion ratio for all students enrolled
           in the course.
+        * stale (bool): True if the course had stale completions that could
+          not be recalculated in time, so the completion is out of date.
         * Aggregators: The actual fields available are configurable, but
           may include `chapter`, `sequential`, or `vertical`.  If requested,
           the field will be a list of all blocks of that type containing
@@ -181,20 +182,13 @@ class CompletionListView(CompletionViewMixin, APIView):
             user=self.user,
             course_key__in=course_keys
         )
-        aggregators_by_enrollment = defaultdict(list)
+        aggregators_by_course = defaultdict(list)
         for agg in aggregator_queryset:
-            aggregators_by_enrollment[agg.user, agg.course_key].append(agg)
+            aggregators_by_course[agg.course_key].append(agg)
 
         # Create the list of aggregate completions to be serialized,
         # recalculating any stale completions for this single user.
-        completions = [
-            serializers.AggregatorAdapter(
-                user=self.user,
-                course_key=enrollment.course_id,
-                aggregators=aggregators_by_enrollment[self.user, enrollment.course_id],
-                recalculate_stale=True,
-            ) for enrollment in paginated
-        ]
+        completions = serializers.get_user_adapters(self.user, course_keys, aggregators_by_course)
 
         # Return the paginated, serialized completions
         serializer = self.get_serializer_class()(
@@ -378,11 +372,7 @@ class CompletionDetailView(CompletionViewMixin, APIView):
             if not UserEnrollments(self.user).is_enrolled(course_key):
                 # Return 404 if effective user does not have an active enrollment in the requested course
                 raise NotFound()
-            is_stale = StaleCompletion.objects.filter(
-                username=self.user.username,
-                course_key=course_key,
-                resolved=False,
-            ).exists()
+            is_stale = stale.get_stale_backend().is_stale(self.user.username, course_key)
 
             # Use enrollments for the effective user
             enrollments = UserEnrollments(self.user).get_course_enrollments(course_key)
@@ -415,6 +405,7 @@ class CompletionDetailView(CompletionViewMixin, APIView):
                 aggregators=aggregators_by_user[enrollment.user_id],
                 root_block=root_block,
                 recalculate_stale=recalculate_stale,
+                is_stale=is_stale,
             ) for enrollment in paginated
         ]
 
@@ -0,0 +1,152 @@
+"""
+Pacing of the tasks enqueued by the aggregator service.
+
+`perform_aggregation` tells a pacer each time it enqueues a task, and the
+pacer sleeps when tasks are being enqueued faster than they should be.
+`FixedDelay` sleeps for a fixed time every 1000 tasks.  `RateController`
+watches the depth of the celery queue, and holds off while more tasks are
+waiting than the target backlog, for about as long as the workers need to
+drain the excess.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+def get_celery_queue_depth(queue_name=None):
+    """
+    Return the number of messages waiting in a celery queue.
+
+    If `queue_name` is None, the default queue is used.  Returns None if the
+    depth of the queue cannot be measured.
+    """
+    from celery import current_app
+    if queue_name is None:
+        queue_name = current_app.conf.CELERY_DEFAULT_QUEUE
+    try:
+        with current_app.connection() as connection:
+            return connection.default_channel.queue_declare(queue=queue_name, passive=True).message_count
+    except Exception:  # pylint: disable=broad-except
+        log.warning("Could not measure the depth of celery queue %s.", queue_name, exc_info=True)
+        return None
+
+
+class FixedDelay(object):
+    """
+    Sleep for `delay` seconds after every `every` tasks.
+    """
+
+    def __init__(self, delay, every=1000, sleep=None):
+        self.delay = delay
+        self.every = every
+        self.count = 0
+        self._sleep = sleep or time.sleep
+
+    def enqueued(self):
+        """
+        Record that a task was enqueued.
+        """
+        self.count += 1
+        if self.delay and self.count % self.every == 0:
+            self._sleep(self.delay)
+
+
+class RateController(object):
+    """
+    Pace enqueueing to keep the celery queue near a target backlog.
+
+    Every `check_every` tasks, the depth of the queue is measured with
+    `probe`.  Comparing the depth with the previous measurement and the
+    tasks enqueued since gives the rate at which workers are completing
+    tasks.  While the queue is deeper than `target_backlog`, the controller
+    sleeps for the time the workers should need to bring it back to the
+    target (at most `max_sleep` at a time), and measures again.  It holds
+    off for at most `max_wait` in a single call, so that enqueueing is not
+    stalled indefinitely if the workers stop.
+
+    If the probe returns None, the depth is unknown and no pacing is done.
+
+    target_backlog (int):
+        The number of waiting tasks to aim for.  Enough to keep the workers
+        busy, but few enough that new work is not stuck behind a long queue.
+    probe (callable):
+        Returns the number of tasks waiting in the queue.
+    check_every (int):
+        The number of tasks to enqueue between measurements.
+    max_sleep (float):
+        The longest time to sleep before measuring again.
+    max_wait (float):
+        The longest time to hold off in a single call to `enqueued`.
+    stop_event (threading.Event|None):
+        If given, holding off ends as soon as the event is set, such as when
+        the aggregator service is stopped.
+    """
+
+    def __init__(
+            self,
+            target_backlog,
+            probe,
+            check_every=100,
+            max_sleep=5.0,
+            max_wait=60.0,
+            stop_event=None,
+            sleep=None,
+            clock=None,
+    ):
+        self.target_backlog = target_backlog
+        self.probe = probe
+        self.check_every = check_every
+        self.max_sleep = max_sleep
+        self.max_wait = max_wait
+        self.stop_event = stop_event
+        self.completion_rate = None
+        self.sleeping = 0.0
+        self._sleep = sleep or (stop_event.wait if stop_event is not None else time.sleep)
+        self._clock = clock or time.time
+        self._pending = 0
+        self._last_depth = None
+        self._last_time = None
+
+    def enqueued(self):
+        """
+        Record that a task was enqueued, and hold off if the queue is too deep.
+        """
+        self._pending += 1
+        if self._pending < self.check_every:
+            return
+        depth = self._measure()
+        waited = 0.0
+        while depth is not None and depth > self.target_backlog:
+            if waited >= self.max_wait:
+                log.info("Celery queue still holds %s tasks after %.1fs.  Enqueueing anyway.", depth, waited)
+                return
+            if self.stop_event is not None and self.stop_event.is_set():
+                return
+            if self.completion_rate:
+                wait = min((depth - self.target_backlog) / self.completion_rate, self.max_sleep)
+            else:
+                wait = self.max_sleep
+            wait = min(wait, self.max_wait - waited)
+            self._sleep(wait)
+            waited += wait
+            self.sleeping += wait
+            depth = self._measure()
+
+    def _measure(self):
+        """
+        Measure the depth of the queue, and update the completion rate.
+        """
+        depth = self.probe()
+        now = self._clock()
+        if depth is not None:
+            if self._last_depth is not None and now > self._last_time:
+                completed = self._last_depth + self._pending - depth
+                self.completion_rate = max(completed, 0) / (now - self._last_time)
+            self._last_depth = depth
+            self._last_time = now
+        self._pending = 0
+        return depth
@@ -3,42 +3,69 @@
 Aggregator service.
 
 This service periodically determines which stale_blocks need updating, and
-enqueues tasks to perform those updates.
+enqueues tasks to perform those updates.  Stale work is tracked by the
+configured stale backend (see `completion_aggregator.stale`).
+
+Work is split into two lanes.  Updates of individual blocks, which are
+usually caused by learners completing them, go to the interactive lane.
+Forced and whole-course updates, which are usually caused by course
+publishes, go to the bulk lane.  Each lane can be sent to its own celery
+queue, and limited separately, so that large rebuilds do not hold up the
+progress learners see.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import collections
 import logging
-import time
 
 import six
 
-from . import models, utils
+from django.conf import settings
+
+from . import backpressure, stale, utils
 from .tasks import aggregation_tasks
 
 log = logging.getLogger(__name__)
 
-EnrollmentTuple = collections.namedtuple('EnrollmentTuple', ['username', 'course_key'])
+INTERACTIVE_LANE = 'interactive'
+BULK_LANE = 'bulk'
 
-MAX_KEYS_PER_TASK = 16
+# The outcome of a run of `enqueue_stale_work`.  `limited` is True if the
+# run stopped at its limit, rather than because it ran out of stale work.
+AggregationResult = collections.namedtuple('AggregationResult', ['enrollments', 'limited'])
 
 
-def perform_aggregation(batch_size=10000, delay=0.0, limit=None, routing_key=None):
+def perform_aggregation(
+        batch_size=10000,
+        delay=0.0,
+        limit=None,
+        routing_key=None,
+        users_per_task=None,
+        work_filter=None,
+        pacer=None,
+        bulk_routing_key=None,
+        interactive_limit=None,
+        bulk_limit=None,
+        bulk_pacer=None,
+        scan_limit=None,
+):
     """
     Enqueues tasks to reaggregate modified completions.
 
     When blocks are completed, they mark themselves as stale.  This function
     collects all stale blocks for each enrollment, and enqueues a single
-    recalculation of all aggregators containing those stale blocks.
+    recalculation of all aggregators containing those stale blocks.  Stale
+    work is streamed from the stale backend, so tasks are enqueued while
+    the backlog is still being read.
 
     batch_size (int|None) [default: 10000]:
-        Maximum number of stale completions to fetch in a single query to the
-        database.
+        Maximum number of stale completions to fetch from the stale backend at
+        once.
 
     delay (float) [default: 0.0]:
         The amount of time to wait between sending batches of 1000 tasks to
-        celery.
+        celery.  Ignored if `pacer` is given.
 
     limit (int|None) [default: None]:
         Maximum number of stale completions to process in a single run of this
@@ -47,70 +74,251 @@ def perform_aggregation(batch_size=10000, delay=0.0, limit=None, routing_key=Non
     routing_key (str|None) [default None]:
         A routing key to pass to celery for the update_aggregators tasks.  None
         means use the default routing key.
+
+    users_per_task (int|None) [default None]:
+        If set, enrollments in the same course are grouped together, and up to
+        this many are sent to a single update_aggregators_in_bulk task.  None
+        means enqueue one update_aggregators task per enrollment.
+
+    work_filter (callable|None) [default None]:
+        If set, the stream of StaleWork is passed through this function
+        before it is enqueued, so that work can be held back.
+
+    pacer (object|None) [default None]:
+        An object whose `enqueued()` method is called after each task is
+        sent to celery, and can sleep to slow enqueueing down, such as a
+        `backpressure.RateController`.  None means use `delay`.
+
+    bulk_routing_key (str|None) [default None]:
+        The routing key for tasks in the bulk lane.  None means use the
+        COMPLETION_AGGREGATOR_BULK_ROUTING_KEY setting, or `routing_key` if
+        that is not set.
+
+    interactive_limit, bulk_limit (int|None) [default None]:
+        Maximum number of enrollments to enqueue in each lane.  Work beyond
+        the limit is left for a later run.  None means no limit.
+
+    bulk_pacer (object|None) [default None]:
+        The pacer for tasks in the bulk lane, so that each lane can be paced
+        by the depth of its own queue.  None means use `pacer` for both lanes.
+
+    scan_limit (int|None) [default None]:
+        If `work_filter` is given, the maximum number of stale blocks to read
+        from the stale backend, including those of the work it holds back.
+        None means read until `limit` blocks have been let through.
+
+    Returns the number of enrollments enqueued.
+    """
+    return enqueue_stale_work(
+        batch_size=batch_size,
+        delay=delay,
+        limit=limit,
+        routing_key=routing_key,
+        users_per_task=users_per_task,
+        work_filter=work_filter,
+        pacer=pacer,
+        bulk_routing_key=bulk_routing_key,
+        interactive_limit=interactive_limit,
+        bulk_limit=bulk_limit,
+        bulk_pacer=bulk_pacer,
+        scan_limit=scan_limit,
+    ).enrollments
+
+
+def enqueue_stale_work(
+        batch_size=10000,
+        delay=0.0,
+        limit=None,
+        routing_key=None,
+        users_per_task=None,
+        work_filter=None,
+        pacer=None,
+        bulk_routing_key=None,
+        interactive_limit=None,
+        bulk_limit=None,
+        bulk_pacer=None,
+        scan_limit=None,
+):
+    """
+    Enqueue tasks to reaggregate modified completions, and return an AggregationResult.
+
+    Takes the same arguments as `perform_aggregation`.  If `work_filter` is
+    given, the stale backend is scanned past the work it holds back, and
+    `limit` only counts the stale blocks of the work it lets through, so
+    that work which is held back on every run cannot starve older work.
+    `scan_limit` bounds how far past held back work the backend is read.
     """
-    stale_queryset = models.StaleCompletion.objects.filter(resolved=False)
-    task_options = {}
-    if limit is None:
-        limit = float('inf')
+    if pacer is None:
+        pacer = backpressure.FixedDelay(delay)
+    lanes = {
+        INTERACTIVE_LANE: (_get_task_options(routing_key), interactive_limit, pacer),
+        BULK_LANE: (
+            _get_task_options(get_bulk_routing_key(routing_key, bulk_routing_key)),
+            bulk_limit,
+            bulk_pacer or pacer,
+        ),
+    }
 
-    try:
-        min_id = stale_queryset.order_by('id')[0].id
-        max_id = stale_queryset.order_by('-id')[0].id
-    except IndexError:
+    backend = stale.get_stale_backend()
+    stale_work = backend.iter_stale_work(batch_size, scan_limit if work_filter else limit, stale.MAX_KEYS_PER_TASK)
+    if work_filter is not None:
+        stale_work = work_filter(stale_work)
+    collected = collections.Counter()
+    stale_work = _count_stale_blocks(stale_work, limit if work_filter else None, collected)
+    counts = collections.Counter()
+    deferred = []
+    lane_work = _assign_lanes(stale_work, lanes, counts, deferred if backend.REMOVES_COLLECTED_WORK else None)
+    if users_per_task:
+        _enqueue_bulk_updates(lane_work, users_per_task)
+    else:
+        _enqueue_updates(lane_work)
+    if deferred:
+        # The backend stopped offering this work when it was collected, so
+        # return it to the backend for a later run.
+        backend.requeue(deferred)
+    count = sum(counts.values())
+    limited = limit is not None and collected['blocks'] >= limit
+    if not count:
         log.warning("No StaleCompletions to process. Exiting.")
-        return
+        return AggregationResult(enrollments=0, limited=limited)
+    log.info(
+        "Enqueued aggregation updates for %s user enrollments (%s interactive, %s bulk)",
+        count,
+        counts[INTERACTIVE_LANE],
+        counts[BULK_LANE],
+    )
+    return AggregationResult(enrollments=count, limited=limited)
+
+
+def get_lane(work):
+    """
+    Return the lane for a StaleWork.
+    """
+    if work.force or isinstance(work.block_keys, utils.BagOfHolding):
+        return BULK_LANE
+    return INTERACTIVE_LANE
+
+
+def get_bulk_routing_key(routing_key=None, bulk_routing_key=None):
+    """
+    Return the routing key for tasks in the bulk lane.
+
+    Falls back to the COMPLETION_AGGREGATOR_BULK_ROUTING_KEY setting, and
+    then to `routing_key`.
+    """
+    if bulk_routing_key is None:
+        bulk_routing_key = getattr(settings, 'COMPLETION_AGGREGATOR_BULK_ROUTING_KEY', None) or routing_key
+    return bulk_routing_key
+
+
+def _get_task_options(routing_key):
+    """
+    Return the celery options for tasks sent with a routing key.
+    """
     if routing_key:
-        task_options['routing_key'] = routing_key
-
-    stale_blocks = collections.defaultdict(set)
-    forced_updates = set()
-    enqueued = 0
-    for idx in six.moves.range(max_id, min([min_id + batch_size, max_id]) - 1, -1 * batch_size):
-        if enqueued >= limit:
-            break
-        evaluated = stale_queryset.filter(id__gt=idx - batch_size, id__lte=idx)
-        enqueued += len(evaluated)
-        for stale in evaluated:
-            enrollment = EnrollmentTuple(
-                username=stale.username,
-                course_key=stale.course_key,
-            )
-            if not stale.block_key:
-                stale_blocks[enrollment] = utils.BagOfHolding()
-            blocks = stale_blocks[enrollment]
-            if isinstance(blocks, utils.BagOfHolding) or len(blocks) <= MAX_KEYS_PER_TASK:
-                # We can stop adding once we have exceeded the maximum number
-                # of keys per task.  This keeps the memory usage of this
-                # function down, and limits the size of the task signature sent
-                # to celery.
-                stale_blocks[enrollment].add(stale.block_key)
-            if stale.force:
-                forced_updates.add(enrollment)
-
-    log.info("Performing aggregation update for %s user enrollments", len(stale_blocks))
-    for idx, enrollment in enumerate(stale_blocks):
-        if isinstance(stale_blocks[enrollment], utils.BagOfHolding):
-            blocks = []
-        elif len(stale_blocks[enrollment]) > MAX_KEYS_PER_TASK:
-            blocks = []
-        else:
-            blocks = [six.text_type(block_key) for block_key in stale_blocks[enrollment]]
+        return {'routing_key': routing_key}
+    return {}
+
+
+def _count_stale_blocks(stale_work, limit, collected):
+    """
+    Yield the stale work, counting its stale blocks in `collected['blocks']`.
+
+    A whole-course update counts as a single block, which is also how the
+    stale backends count it.  If `limit` is not None, no more work is taken
+    once that many blocks have been counted.
+    """
+    for work in stale_work:
+        collected['blocks'] += 1 if isinstance(work.block_keys, utils.BagOfHolding) else max(len(work.block_keys), 1)
+        yield work
+        if limit is not None and collected['blocks'] >= limit:
+            return
+
+
+def _assign_lanes(stale_work, lanes, counts, deferred):
+    """
+    Yield (work, task_options, pacer) for the stale work within its lane's limit.
+
+    `counts` is updated with the work yielded in each lane.  Work over the
+    limit is appended to `deferred`, unless it is None.
+    """
+    for work in stale_work:
+        lane = get_lane(work)
+        task_options, lane_limit, pacer = lanes[lane]
+        if lane_limit is not None and counts[lane] >= lane_limit:
+            if deferred is not None:
+                deferred.append(work)
+            continue
+        counts[lane] += 1
+        yield work, task_options, pacer
+
+
+def _get_task_block_keys(blocks):
+    """
+    Return the list of block keys to send to an aggregation task.
+
+    An empty list means the whole course needs updating.
+    """
+    if isinstance(blocks, utils.BagOfHolding) or len(blocks) > stale.MAX_KEYS_PER_TASK:
+        return []
+    return [six.text_type(block_key) for block_key in blocks]
+
+
+def _enqueue_updates(lane_work):
+    """
+    Enqueue an update_aggregators task for each enrollment as it is collected.
+    """
+    for work, task_options, pacer in lane_work:
         aggregation_tasks.update_aggregators.apply_async(
             kwargs={
-                'username': enrollment.username,
-                'course_key': six.text_type(enrollment.course_key),
-                'block_keys': blocks,
-                'force': enrollment in forced_updates,
+                'username': work.username,
+                'course_key': six.text_type(work.course_key),
+                'block_keys': _get_task_block_keys(work.block_keys),
+                'force': work.force,
+            },
+            **task_options
+        )
+        pacer.enqueued()
+
+
+def _enqueue_bulk_updates(lane_work, users_per_task):
+    """
+    Enqueue update_aggregators_in_bulk tasks, grouping enrollments by course and lane.
+
+    A task is enqueued as soon as a group has `users_per_task` enrollments
+    waiting, and the remaining partial groups are enqueued at the end.
+    """
+    groups = collections.OrderedDict()
+
+    def enqueue(group):
+        (course_key, _), (task_options, pacer, enrollments) = group, groups.pop(group)
+        aggregation_tasks.update_aggregators_in_bulk.apply_async(
+            kwargs={
+                'course_key': six.text_type(course_key),
+                'enrollments': enrollments,
             },
             **task_options
         )
-        if idx % 1000 == 999:
-            if delay:
-                time.sleep(delay)
+        pacer.enqueued()
+
+    for work, task_options, pacer in lane_work:
+        group = (work.course_key, get_lane(work))
+        if group not in groups:
+            groups[group] = (task_options, pacer, [])
+        enrollments = groups[group][2]
+        enrollments.append({
+            'username': work.username,
+            'block_keys': _get_task_block_keys(work.block_keys),
+            'force': work.force,
+        })
+        if len(enrollments) >= users_per_task:
+            enqueue(group)
+    for group in list(groups):
+        enqueue(group)
 
 
 def perform_cleanup():
     """
-    Remove resolved StaleCompletion objects.
+    Remove records of resolved stale work.
     """
-    return models.StaleCompletion.objects.filter(resolved=True).delete()
+    return stale.get_stale_backend().cleanup()
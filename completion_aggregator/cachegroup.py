@@ -3,19 +3,45 @@ Cache wrapper that allows cache entries to be joined into groups.
 
 Groups can be marked for manual invalidation, and all members of the group
 will then be treated as if it has been removed from the cache.
+
+By default, group invalidations are recorded in the database, and entries
+cached before their group's last invalidation are ignored.  If the
+COMPLETION_AGGREGATOR_VERSIONED_CACHE_GROUPS setting is enabled, each group
+instead has a version number in the cache, which is incremented to
+invalidate the group, and entries cached with an older version are ignored.
 """
 
-from collections import namedtuple
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from datetime import timedelta
 
+from django.conf import settings
 from django.core.cache import cache
 from django.utils import timezone
 
 from .models import CacheGroupInvalidation
 
+log = logging.getLogger(__name__)
+
 DELETE_INVALIDATIONS_AFTER = timedelta(days=90)
+PURGE_BATCH_SIZE = 1000
+
+# How long group invalidation times are cached in the shared cache, and
+# how long invalidation times and versions are cached in each process.
+# Invalidations made in other processes can go unnoticed for up to
+# LOCAL_INVALIDATION_TIMEOUT seconds.
+INVALIDATION_CACHE_TIMEOUT = 300
+LOCAL_INVALIDATION_TIMEOUT = 5
+LOCAL_INVALIDATION_CACHE_SIZE = 1024
 
 _CacheGroupEntry = namedtuple('_CacheGroupEntry', ['group', 'value', 'cached_at'])
+_VersionedCacheGroupEntry = namedtuple('_VersionedCacheGroupEntry', ['group', 'value', 'version'])
+
+# The cached invalidation time of a group.  `invalidated_at` is None if the
+# group has never been invalidated.
+_Invalidation = namedtuple('_Invalidation', ['invalidated_at'])
 
 
 class CacheGroup(object):
@@ -25,10 +51,35 @@ class CacheGroup(object):
     If the group has been invalidated, all keys in its group are also
     invalidated.  This requires durable storage for the group invalidations.
 
+    The invalidation times of groups are themselves cached, in the shared
+    cache and in a small per-process LRU cache, so reading an entry does
+    not usually need a database query.
+
+    In versioned mode, group versions are kept in the same per-process
+    cache, so reading an entry does not usually need a second round trip
+    to the shared cache, however many CacheGroups are created.
+
     Keys are not namespaced by group, and are declared with every call to
     `CacheGroup.set`, so a cache_entry can change groups if desired.
     """
 
+    invalidation_key_template = 'completion_aggregator.cachegroup.invalidation.{group}'
+    version_key_template = 'completion_aggregator.cachegroup.version.{group}'
+
+    _local_values = OrderedDict()
+    _local_lock = threading.Lock()
+
+    def __init__(self, versioned=None):
+        """
+        Create a CacheGroup.
+
+        If `versioned` is None, the COMPLETION_AGGREGATOR_VERSIONED_CACHE_GROUPS
+        setting decides whether groups are versioned.
+        """
+        if versioned is None:
+            versioned = getattr(settings, 'COMPLETION_AGGREGATOR_VERSIONED_CACHE_GROUPS', False)
+        self.versioned = versioned
+
     def get(self, key):
         """
         Get an entry from the cache.
@@ -36,21 +87,115 @@ class CacheGroup(object):
         Returns None if the entry or its group does not exist, has timed out,
         or has been invalidated.
         """
-        cache_entry = cache.get(key)
-        if cache_entry is None:
-            return None
-        invalidation = CacheGroupInvalidation.objects.filter(group=cache_entry.group).first()
-        if invalidation and invalidation.invalidated_at > cache_entry.cached_at:
-            return None
-        return cache_entry.value
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        Get several entries from the cache.
+
+        Returns a dict of the values of the keys that were found, and whose
+        groups have not been invalidated since they were cached.  This reads
+        the cache at most twice, once for the entries and once for the
+        invalidation times or versions of their groups, and the database at
+        most once.
+        """
+        if self.versioned:
+            # Entries cached before switching modes are ignored, as they
+            # cannot have been invalidated in this mode.
+            cache_entries = {
+                key: entry for key, entry in cache.get_many(keys).items()
+                if isinstance(entry, _VersionedCacheGroupEntry)
+            }
+            versions = self.get_versions({entry.group for entry in cache_entries.values()})
+            return {key: entry.value for key, entry in cache_entries.items() if versions[entry.group] == entry.version}
+        cache_entries = {
+            key: entry for key, entry in cache.get_many(keys).items() if isinstance(entry, _CacheGroupEntry)
+        }
+        invalidations = self.get_invalidations({entry.group for entry in cache_entries.values()})
+        return {
+            key: entry.value
+            for key, entry in cache_entries.items()
+            if invalidations[entry.group] is None or invalidations[entry.group] <= entry.cached_at
+        }
+
+    def get_versions(self, groups):
+        """
+        Return a dict of the current version of each group.
+
+        Groups without a version, including those whose version has been
+        evicted from the cache, are given a new one.
+        """
+        versions = {}
+        cache_keys = {}
+        for group in groups:
+            cache_key = self.version_key_template.format(group=group)
+            version = self._get_local(cache_key)
+            if version is None:
+                cache_keys[cache_key] = group
+            else:
+                versions[group] = version
+        if cache_keys:
+            found = cache.get_many(list(cache_keys))
+            for cache_key, group in cache_keys.items():
+                version = found.get(cache_key)
+                if version is None:
+                    version = self._init_version(cache_key)
+                self._set_local(cache_key, version)
+                versions[group] = version
+        return versions
+
+    @staticmethod
+    def _init_version(cache_key):
+        """
+        Give a group its first version, and return the group's version.
+
+        Versions start from the current time in microseconds, so that a group
+        whose version was evicted never reuses an old version.
+        """
+        cache.add(cache_key, int(time.time() * 1000000), None)
+        return cache.get(cache_key)
+
+    def get_invalidations(self, groups):
+        """
+        Return a dict of the time each group was last invalidated, or None.
+        """
+        invalidations = {}
+        missing = set()
+        for group in groups:
+            invalidation = self._get_local(self.invalidation_key_template.format(group=group))
+            if invalidation is None:
+                missing.add(group)
+            else:
+                invalidations[group] = invalidation.invalidated_at
+        if missing:
+            cache_keys = {self.invalidation_key_template.format(group=group): group for group in missing}
+            for cache_key, invalidation in cache.get_many(list(cache_keys)).items():
+                group = cache_keys[cache_key]
+                self._set_local(cache_key, invalidation)
+                invalidations[group] = invalidation.invalidated_at
+                missing.discard(group)
+        if missing:
+            found = dict(
+                CacheGroupInvalidation.objects.filter(group__in=missing).values_list('group', 'invalidated_at')
+            )
+            for group in missing:
+                invalidation = _Invalidation(found.get(group))
+                cache_key = self.invalidation_key_template.format(group=group)
+                self._set_local(cache_key, invalidation)
+                # Adding, rather than setting, keeps an invalidation cached by
+                # `delete_group` since the database was read.
+                cache.add(cache_key, invalidation, INVALIDATION_CACHE_TIMEOUT)
+                invalidations[group] = invalidation.invalidated_at
+        return invalidations
 
     def set(self, group, key, value, timeout):
         """
         Set an entry in the cache, assigning it to an invalidation group.
         """
-        cached_at = timezone.now()
-
-        cache_entry = _CacheGroupEntry(group, value, cached_at)
+        if self.versioned:
+            cache_entry = _VersionedCacheGroupEntry(group, value, self.get_versions([group])[group])
+        else:
+            cache_entry = _CacheGroupEntry(group, value, timezone.now())
         return cache.set(key, cache_entry, timeout)
 
     def touch(self, key, timeout):
@@ -75,10 +220,79 @@ class CacheGroup(object):
         """
         Invalidate an entire entry from the cache.
         """
-        CacheGroupInvalidation.objects.create_or_update(group=group, invalidated_at=timezone.now())
+        if self.versioned:
+            cache_key = self.version_key_template.format(group=group)
+            try:
+                version = cache.incr(cache_key)
+            except ValueError:
+                version = self._init_version(cache_key)
+            self._set_local(cache_key, version)
+            return
+        invalidated_at = timezone.now()
+        CacheGroupInvalidation.objects.update_or_create(group=group, defaults={'invalidated_at': invalidated_at})
+        invalidation = _Invalidation(invalidated_at)
+        cache_key = self.invalidation_key_template.format(group=group)
+        cache.set(cache_key, invalidation, INVALIDATION_CACHE_TIMEOUT)
+        self._set_local(cache_key, invalidation)
+
+    @classmethod
+    def _get_local(cls, cache_key):
+        """
+        Return a group's _Invalidation or version from the process cache, or None if it has expired.
+        """
+        with cls._local_lock:
+            item = cls._local_values.get(cache_key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del cls._local_values[cache_key]
+                return None
+            cls._local_values.pop(cache_key)
+            cls._local_values[cache_key] = item
+            return value
 
-        # Group invalidations are expected to be relatively infrequent, so we
-        # take this opportunity to clean old invalidation records out of the
-        # database.
+    @classmethod
+    def _set_local(cls, cache_key, value):
+        """
+        Store a group's _Invalidation or version in the process cache.
+        """
+        with cls._local_lock:
+            cls._local_values.pop(cache_key, None)
+            cls._local_values[cache_key] = (time.time() + LOCAL_INVALIDATION_TIMEOUT, value)
+            while len(cls._local_values) > LOCAL_INVALIDATION_CACHE_SIZE:
+                cls._local_values.popitem(last=False)
+
+    @classmethod
+    def clear_local(cls):
+        """
+        Empty the process cache of invalidation times and versions.
+        """
+        with cls._local_lock:
+            cls._local_values.clear()
 
-        CacheGroupInvalidation.objects.filter(invalidate_at__lt=timezone.now() - DELETE_INVALIDATIONS_AFTER).delete()
+
+def purge_invalidations(older_than=DELETE_INVALIDATIONS_AFTER, batch_size=PURGE_BATCH_SIZE):
+    """
+    Delete the records of group invalidations older than `older_than`.
+
+    Entries cached before then have long since expired, so the records are
+    no longer needed.  Records are deleted `batch_size` at a time, so that
+    no long-running delete locks the table.  Each batch is read from the
+    start of the invalidated_at index, where the previous batch was deleted,
+    so no query scans rows that are being kept.
+
+    Returns the number of records deleted.
+    """
+    cutoff = timezone.now() - older_than
+    queryset = CacheGroupInvalidation.objects.filter(invalidated_at__lt=cutoff).order_by('invalidated_at', 'id')
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted += CacheGroupInvalidation.objects.filter(id__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            break
+    log.info("Purged %s cache group invalidations from before %s", deleted, cutoff)
+    return deleted
@@ -16,10 +16,23 @@ eliminates external dependencies
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import threading
+from collections import OrderedDict
+
+import six
+
 from django.conf import settings
+from django.db.models import CharField, ExpressionWrapper, F
 
 from .transformers import AggregatorAnnotationTransformer
 
+# The number of course versions for which `_has_library_content` remembers
+# whether the course contains library content.
+LIBRARY_CONTENT_CACHE_SIZE = 100
+
+_library_content = OrderedDict()
+_library_content_lock = threading.Lock()
+
 
 def get_aggregated_model():
     """
@@ -31,11 +44,10 @@ def get_aggregated_model():
     return getattr(settings, 'COMPLETION_AGGREGATED_MODEL_OVERRIDE', 'completion.BlockCompletion')
 
 
-def init_course_block_key(modulestore, course_key):
+def init_course_block_key(modulestore, course_key):  # pragma: no cover
     """
     Return a UsageKey for the root course block.
     """
-    # pragma: no-cover
     return modulestore.make_course_usage_key(course_key)
 
 
@@ -55,7 +67,7 @@ def get_item_not_found_error():
     return ItemNotFoundError
 
 
-def init_course_blocks(user, root_block_key):
+def init_course_blocks(user, root_block_key):  # pragma: no cover
     """
     Return a BlockStructure representing the course.
 
@@ -64,7 +76,6 @@ def init_course_blocks(user, root_block_key):
         .location
         .block_type
     """
-    # pragma: no-cover
     from lms.djangoapps.course_blocks.api import get_course_block_access_transformers, get_course_blocks  # pylint: disable=import-error
     from openedx.core.djangoapps.content.block_structure.transformers import BlockStructureTransformers  # pylint: disable=import-error
 
@@ -75,6 +86,65 @@ def init_course_blocks(user, root_block_key):
     return get_course_blocks(user, root_block_key, transformers)
 
 
+def get_course_structure_signature(modulestore, user, course_key):  # pragma: no cover
+    """
+    Return a hashable signature of the course structure the user can see.
+
+    Users with the same signature are shown the same course blocks, so their
+    course structures can be shared.  The signature combines the course
+    version with the groups the user belongs to in each of the course's user
+    partitions (cohorts, enrollment tracks, and content groups).
+
+    Returns None if the course structure should not be shared, because the
+    course is not versioned, the user sees content ahead of other learners
+    (course staff and beta testers), the course contains library content
+    (whose children are selected for each user), or the user has individual
+    date overrides.
+    """
+    from courseware.access import has_access  # pylint: disable=import-error
+    from courseware.models import StudentFieldOverride  # pylint: disable=import-error
+    from student.roles import CourseBetaTesterRole  # pylint: disable=import-error
+    from xmodule.partitions.partitions_service import get_all_partitions_for_course, get_user_partition_groups  # pylint: disable=import-error
+
+    course = modulestore.get_course(course_key, depth=0)
+    version = getattr(course, 'course_version', None)
+    if version is None:
+        return None
+    if has_access(user, 'staff', course_key) or CourseBetaTesterRole(course_key).has_user(user):
+        return None
+    if _has_library_content(modulestore, course_key, version):
+        return None
+    if StudentFieldOverride.objects.filter(course_id=course_key, student=user).exists():
+        return None
+    groups = get_user_partition_groups(course_key, get_all_partitions_for_course(course), user, partition_dict_key='id')
+    return (
+        six.text_type(version),
+        tuple(sorted((partition_id, group.id) for partition_id, group in groups.items() if group is not None)),
+    )
+
+
+def _has_library_content(modulestore, course_key, version):
+    """
+    Return True if the given version of the course contains library_content blocks.
+
+    Looking the blocks up is slow, and the answer only changes when the
+    course is published, so it is remembered for the most recently seen
+    course versions.
+    """
+    key = (course_key, version)
+    with _library_content_lock:
+        found = _library_content.pop(key, None)
+        if found is not None:
+            _library_content[key] = found
+            return found
+    found = bool(modulestore.get_items(course_key, qualifiers={'category': 'library_content'}))
+    with _library_content_lock:
+        _library_content[key] = found
+        while len(_library_content) > LIBRARY_CONTENT_CACHE_SIZE:
+            _library_content.popitem(last=False)
+    return found
+
+
 def get_block_completions(user, course_key):
     """
     Return the list of BlockCompletions.
@@ -92,6 +162,30 @@ def get_block_completions(user, course_key):
     )
 
 
+def get_block_completion_values(user_ids, course_key, block_keys=None):
+    """
+    Return (user_id, block_key, completion, modified) tuples for BlockCompletions.
+
+    Only the BlockCompletions of the given users in the given course are
+    included.  If `block_keys` is not None, they are further restricted to
+    the given blocks.
+
+    Block keys are returned as unparsed strings, to avoid the cost of
+    parsing a UsageKey for every completion.
+    """
+    from completion.models import BlockCompletion
+    queryset = BlockCompletion.objects.filter(
+        user_id__in=user_ids,
+        course_key=course_key,
+    )
+    if block_keys is not None:
+        queryset = queryset.filter(block_key__in=block_keys)
+    # Wrapping the key in a CharField expression skips UsageKeyField's parsing.
+    return queryset.annotate(
+        raw_block_key=ExpressionWrapper(F('block_key'), output_field=CharField()),
+    ).values_list('user_id', 'raw_block_key', 'completion', 'modified')
+
+
 def get_children(course_blocks, block_key):
     """
     Return a list of blocks that are direct children of the specified block.
@@ -102,11 +196,10 @@ def get_children(course_blocks, block_key):
     return course_blocks.get_children(block_key)
 
 
-def course_enrollment_model():
+def course_enrollment_model():  # pragma: no cover
     """
     Return the student.models.CourseEnrollment model.
     """
-    # pragma: no-cover
     from student.models import CourseEnrollment  # pylint: disable=import-error
     return CourseEnrollment
 
@@ -160,11 +253,10 @@ def get_cohorts_for_course(course_key):
     return None
 
 
-def course_access_role_model():
+def course_access_role_model():  # pragma: no cover
     """
     Return the student.models.CourseAccessRole model.
     """
-    # pragma: no-cover
     from student.models import CourseAccessRole  # pylint: disable=import-error
     return CourseAccessRole
 
@@ -7,28 +7,42 @@ converts them to Aggregators.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
 import logging
-from collections import namedtuple
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict, namedtuple
 from datetime import datetime
 
 import pytz
 import six
 from xblock.completable import XBlockCompletionMode
-from xblock.core import XBlock
-from xblock.plugin import PluginMissingError
 
+from django.conf import settings
 from django.utils import timezone
 
-from . import compat
+from . import compat, stale
 from .cachegroup import CacheGroup
-from .models import Aggregator, StaleCompletion
-from .utils import BagOfHolding
+from .models import Aggregator
+from .utils import BagOfHolding, completion_modes
 
 OLD_DATETIME = pytz.utc.localize(datetime(1900, 1, 1, 0, 0, 0))
 UPDATER_CACHE_TIMEOUT = 600  # 10 minutes
 
-CacheEntry = namedtuple('CacheEntry', ['course_blocks', 'root_block'])
-CompletionStats = namedtuple('CompletionStats', ['earned', 'possible', 'last_modified'])
+# Shared course structures kept in process, and how long they are trusted
+# before being read from the django cache again.
+LOCAL_STRUCTURE_CACHE_SIZE = 16
+LOCAL_STRUCTURE_TIMEOUT = 60  # 1 minute
+
+# Above this many completable blocks, fetch all of the enrollment's
+# completions rather than filtering the query by block.
+MAX_FILTERED_COMPLETIONS = 1000
+
+# `plan` is the compiled AggregationPlan for the structure, or None if it
+# has not been compiled, such as in entries cached by older versions.
+CacheEntry = namedtuple('CacheEntry', ['course_blocks', 'root_block', 'plan'])
+CacheEntry.__new__.__defaults__ = (None,)
 
 log = logging.getLogger(__name__)
 
@@ -84,30 +98,465 @@ class UpdaterCache(object):
         )
 
 
+class SharedStructure(object):
+    """
+    A cached course structure shared by all users with the same view of a course.
+
+    The AggregationPlan for the structure is taken from the cached entry, or
+    compiled on first use, and then reused by every updater sharing the
+    structure.
+    """
+
+    def __init__(self, entry):
+        """
+        Wrap the given CacheEntry.
+        """
+        self.entry = entry
+        self._plan = entry.plan
+
+    @property
+    def plan(self):
+        """
+        Return the AggregationPlan for the structure.
+        """
+        if self._plan is None:
+            self._plan = AggregationPlan(self.entry.course_blocks, self.entry.root_block)
+        return self._plan
+
+
+class StructureCache(object):
+    """
+    Cache course blocks shared by all users who see the same course structure.
+
+    Entries are keyed by a structure signature, which combines the course
+    version with the user's partition groups (see
+    `compat.get_course_structure_signature`), rather than by user.  Like
+    `UpdaterCache`, entries are stored through
+    `completion_aggregator.cachegroup.CacheGroup` in the course's group.
+
+    The most recently used entries are also kept in process for a short
+    time, so that background tasks aggregating many users in a course only
+    need to unpickle the structure and compile its plan once.
+    """
+
+    cache_key_template = "completion_aggregator.structure.{course_key}-{root_block}-{signature}"
+    _local = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, course_key, root_block, signature):
+        """
+        Create a new Structure Cache for the provided course_key, root_block, and signature.
+        """
+        self.course_key = course_key
+        self.root_block = root_block
+        self.signature = hashlib.sha1(six.text_type(signature).encode('utf-8')).hexdigest()
+
+    def get(self):
+        """
+        Return the SharedStructure for the current cache entry, or None.
+        """
+        with self._lock:
+            local = self._local.pop(self.cache_key, None)
+            if local is not None and local[0] > time.time():
+                self._local[self.cache_key] = local
+                return local[1]
+        entry = CacheGroup().get(self.cache_key)
+        if entry is None:
+            return None
+        return self._remember(entry)
+
+    def set(self, value):
+        """
+        Cache a CacheEntry for the current cache entry, and return its SharedStructure.
+
+        Sets the group to `str(self.course_key)`.
+        """
+        group = six.text_type(self.course_key)
+        CacheGroup().set(group, self.cache_key, value, timeout=UPDATER_CACHE_TIMEOUT)
+        return self._remember(value)
+
+    def _remember(self, entry):
+        """
+        Keep a SharedStructure for the entry in process.
+        """
+        structure = SharedStructure(entry)
+        with self._lock:
+            self._local[self.cache_key] = (time.time() + LOCAL_STRUCTURE_TIMEOUT, structure)
+            while len(self._local) > LOCAL_STRUCTURE_CACHE_SIZE:
+                self._local.popitem(last=False)
+        return structure
+
+    @classmethod
+    def clear_local(cls):
+        """
+        Forget all of the structures kept in process.
+        """
+        with cls._lock:
+            cls._local.clear()
+
+    @property
+    def cache_key(self):
+        """
+        Create a key to identify the current cache entry.
+        """
+        return self.cache_key_template.format(
+            course_key=self.course_key,
+            root_block=self.root_block,
+            signature=self.signature,
+        )
+
+
 CourseBlocksEntry = namedtuple('CourseBlocksEntry', ['children', 'aggregators'])
 
 
+class CompactCourseBlocks(object):
+    """
+    A compact, read-only mapping of block keys to CourseBlocksEntry tuples.
+
+    Rather than storing UsageKeys, blocks are stored in a table of course
+    key indexes, block types and block ids, with the block types interned,
+    so each distinct course key and block type is only pickled once.  The
+    children and aggregators of each block are stored as arrays of indexes
+    into the table, in compressed sparse row form: the children of block
+    ``i`` are ``children[child_offsets[i]:child_offsets[i + 1]]``.
+
+    UsageKeys are only created when they are looked up, and each is created
+    at most once, so loading a pickled structure is cheap.
+    """
+
+    def __init__(self, course_blocks):
+        """
+        Compact a dict in the format returned by `AggregationUpdater.format_course_blocks`.
+        """
+        self.course_keys = []
+        self.block_courses = array(str('i'))
+        self.block_types = []
+        self.block_ids = []
+        self.child_offsets = array(str('i'), [0])
+        self.children = array(str('i'))
+        self.aggregator_offsets = array(str('i'), [0])
+        self.aggregators = array(str('i'))
+
+        index = {}
+        course_indexes = {}
+        block_types = {}
+
+        def add(block):
+            """
+            Add a block to the table, and return its index.
+            """
+            if block not in index:
+                if block.course_key not in course_indexes:
+                    course_indexes[block.course_key] = len(self.course_keys)
+                    self.course_keys.append(block.course_key)
+                index[block] = len(self.block_ids)
+                self.block_courses.append(course_indexes[block.course_key])
+                self.block_types.append(block_types.setdefault(block.block_type, block.block_type))
+                self.block_ids.append(block.block_id)
+            return index[block]
+
+        blocks = list(course_blocks)
+        for block in blocks:
+            add(block)
+        # Blocks beyond `size` are only referenced as children or aggregators.
+        self.size = len(blocks)
+        for block in blocks:
+            entry = course_blocks[block]
+            self.children.extend(add(child) for child in entry.children)
+            self.child_offsets.append(len(self.children))
+            self.aggregators.extend(add(aggregator) for aggregator in entry.aggregators)
+            self.aggregator_offsets.append(len(self.aggregators))
+        self._reset()
+
+    def _reset(self):
+        """
+        Clear the lazily populated UsageKeys and lookup table.
+        """
+        self._blocks = [None] * len(self.block_ids)
+        self._index = None
+
+    def __getstate__(self):
+        """
+        Exclude the lazily populated attributes from pickles.
+        """
+        state = self.__dict__.copy()
+        del state['_blocks']
+        del state['_index']
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled structure.
+        """
+        self.__dict__.update(state)
+        self._reset()
+
+    def block(self, index):
+        """
+        Return the UsageKey of the block at the given index in the table.
+        """
+        block = self._blocks[index]
+        if block is None:
+            block = self._blocks[index] = self.course_keys[self.block_courses[index]].make_usage_key(
+                self.block_types[index],
+                self.block_ids[index],
+            )
+        return block
+
+    def index(self, block):
+        """
+        Return the index of the given block, or None if it has no entry.
+        """
+        if self._index is None:
+            self._index = {
+                (self.block_types[index], self.block_ids[index]): index for index in six.moves.range(self.size)
+            }
+        index = self._index.get((block.block_type, block.block_id))
+        if index is None or self.block(index) != block:
+            return None
+        return index
+
+    def __contains__(self, block):
+        return self.index(block) is not None
+
+    def __getitem__(self, block):
+        index = self.index(block)
+        if index is None:
+            raise KeyError(block)
+        return CourseBlocksEntry(
+            children=[
+                self.block(child)
+                for child in self.children[self.child_offsets[index]:self.child_offsets[index + 1]]
+            ],
+            aggregators=[
+                self.block(aggregator)
+                for aggregator in self.aggregators[self.aggregator_offsets[index]:self.aggregator_offsets[index + 1]]
+            ],
+        )
+
+    def get(self, block, default=None):
+        """
+        Return the CourseBlocksEntry for the block, or `default` if it has no entry.
+        """
+        if block in self:
+            return self[block]
+        return default
+
+    def __iter__(self):
+        return (self.block(index) for index in six.moves.range(self.size))
+
+    def __len__(self):
+        return self.size
+
+
+class AggregationPlan(object):
+    """
+    A flattened, precompiled traversal of a course structure.
+
+    The plan stores the course tree as parallel lists indexed by node number.
+    Nodes are numbered in post-order, so every node comes after all of its
+    descendants, and the subtree rooted at node ``i`` occupies the contiguous
+    range ``first[i]`` through ``i``.  The completion mode of every block is
+    resolved once, when the plan is compiled, so aggregating over the plan
+    requires neither recursion nor XBlock plugin lookups.
+
+    Only the children of aggregator blocks are included, because the
+    children of completable and excluded blocks never contribute to
+    aggregation.  A block that appears in more than one place in the course
+    gets a node for each occurrence.
+
+    Because the number of completable blocks under a node depends only on the
+    course structure, the plan also records the `possible` value of every
+    node.  It also records the serialized key of every block, so that
+    completions can be matched to blocks without parsing their keys.
+
+    Plans are cached along with the CompactCourseBlocks they were compiled
+    from, so each course structure is only compiled once.  Nodes refer to
+    blocks by their index in the CompactCourseBlocks table, and the UsageKeys
+    and serialized keys of the nodes are only recreated when they are used.
+    """
+
+    def __init__(self, course_blocks, root_block):
+        """
+        Compile the plan for the given formatted course blocks and root block.
+
+        `course_blocks` is a CompactCourseBlocks, as returned by
+        `AggregationUpdater.format_course_blocks`.
+        """
+        self.course_blocks = course_blocks
+        self.nodes = array(str('i'))
+        self.parents = array(str('i'))
+        self.first = array(str('i'))
+        self.modes = []
+        self.registered = []
+        self.possible = array(str('d'))
+        # Maps the table index of each block to its node, or to None if the
+        # block has more than one occurrence.
+        self.node_index = {}
+        blocks = []
+
+        # Each stack frame holds a block, its completion mode, an iterator
+        # over its remaining children, the index of the first node in its
+        # subtree, and the indices of the children that have already been
+        # compiled.
+        stack = [self._frame(course_blocks, root_block)]
+        while stack:
+            block, mode, children, first, child_indices = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append(self._frame(course_blocks, child))
+                continue
+            stack.pop()
+            index = len(blocks)
+            blocks.append(block)
+            table_index = course_blocks.index(block)
+            self.nodes.append(table_index)
+            self.parents.append(-1)
+            self.first.append(first)
+            self.modes.append(mode)
+            self.registered.append(
+                mode == XBlockCompletionMode.AGGREGATOR and Aggregator.block_is_registered_aggregator(block)
+            )
+            if mode == XBlockCompletionMode.COMPLETABLE:
+                self.possible.append(1.0)
+            else:
+                self.possible.append(sum(self.possible[child_index] for child_index in child_indices))
+            for child_index in child_indices:
+                self.parents[child_index] = index
+            if stack:
+                stack[-1][4].append(index)
+            # Blocks with more than one occurrence have no unique node.
+            self.node_index[table_index] = None if table_index in self.node_index else index
+        self._reset()
+
+    def _reset(self):
+        """
+        Clear the lazily populated UsageKeys and serialized keys of the nodes.
+        """
+        self.blocks = _LazyNodeList(len(self.nodes), lambda index: self.course_blocks.block(self.nodes[index]))
+        self.keys = _LazyNodeList(len(self.nodes), lambda index: six.text_type(self.blocks[index]))
+
+    def __getstate__(self):
+        """
+        Exclude the lazily populated attributes from pickles.
+        """
+        state = self.__dict__.copy()
+        del state['blocks']
+        del state['keys']
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled plan.
+        """
+        self.__dict__.update(state)
+        self._reset()
+
+    def _frame(self, course_blocks, block):
+        """
+        Return a new stack frame for compiling the subtree rooted at `block`.
+        """
+        mode = self.get_mode(block.block_type)
+        if mode == XBlockCompletionMode.AGGREGATOR:
+            children = iter(course_blocks[block].children)
+        else:
+            children = iter(())
+        return (block, mode, children, len(self.nodes), [])
+
+    @staticmethod
+    def get_mode(block_type):
+        """
+        Return the completion mode for the given block type.
+
+        Raises ValueError if the block type declares an invalid completion mode.
+        """
+        mode = completion_modes.get(block_type)
+        if mode not in {
+                XBlockCompletionMode.EXCLUDED,
+                XBlockCompletionMode.COMPLETABLE,
+                XBlockCompletionMode.AGGREGATOR,
+        }:
+            raise ValueError("Invalid completion mode {}".format(mode))
+        return mode
+
+    def node(self, block):
+        """
+        Return the node of the given block, or None if it has no node or more than one.
+        """
+        table_index = self.course_blocks.index(block)
+        if table_index is None:
+            return None
+        return self.node_index.get(table_index)
+
+    def __contains__(self, block):
+        """
+        Return True if the block has at least one node.
+        """
+        return self.course_blocks.index(block) in self.node_index
+
+    @property
+    def root(self):
+        """
+        Return the index of the root node, which is always the last node.
+        """
+        return len(self.nodes) - 1
+
+    def __len__(self):
+        """
+        Return the number of nodes in the plan.
+        """
+        return len(self.nodes)
+
+
+class _LazyNodeList(object):
+    """
+    A read-only list of per-node values, each computed on first access.
+    """
+
+    def __init__(self, size, load):
+        self._items = [None] * size
+        self._load = load
+
+    def __getitem__(self, index):
+        item = self._items[index]
+        if item is None:
+            item = self._items[index] = self._load(index)
+        return item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return (self[index] for index in six.moves.range(len(self._items)))
+
+
 class AggregationUpdater(object):
     """
     Class to update aggregators for a given course and user.
     """
 
-    def __init__(self, user, course_key, modulestore, root_block=None):
+    def __init__(self, user, course_key, modulestore, root_block=None, structures=None):
         """
         Create an aggregation updater for the given user and course.
 
-        Also takes a modulestore instance.
+        Also takes a modulestore instance.  If `structures` is a dict, it is
+        used to share SharedStructures, keyed by structure signature, with
+        the other updaters given the same dict.
         """
         self.user = user
         self.course_key = course_key
         self.raw_root_block = root_block
         self.cache = UpdaterCache(self.user.id, self.course_key, self.raw_root_block)
+        self._shared_structure = None
+
+        self._plan = None
 
         cache_entry = self.cache.get()
         if cache_entry:
             self.using_cache = True
             self.course_blocks = cache_entry.course_blocks
             self.root_block = cache_entry.root_block
+            self._plan = cache_entry.plan
         else:
             self.using_cache = False
             with modulestore.bulk_operations(self.course_key):
@@ -115,22 +564,54 @@ class AggregationUpdater(object):
                     self.root_block = self.raw_root_block
                 else:
                     self.root_block = compat.init_course_block_key(modulestore, self.course_key)
-                self.course_blocks = self.format_course_blocks(
-                    compat.init_course_blocks(self.user, self.root_block),
-                    self.root_block
-                )
-        self.aggregators = {
-            aggregator.block_key: aggregator for aggregator in Aggregator.objects.filter(
-                user=self.user,
-                course_key=self.course_key,
-            )
-        }
+                self.course_blocks = self.load_course_blocks(modulestore, structures)
+        # Stored aggregators are loaded on demand.  `_loaded_aggregators`
+        # records which blocks have been looked up, or is a BagOfHolding
+        # once all of the enrollment's aggregators have been loaded.
+        self._aggregators = {}
+        self._loaded_aggregators = set()
         # used to store all rows for update
         self.updated_aggregators = []
-        self.block_completions = {
-            completion.block_key.map_into_course(self.course_key): completion
-            for completion in compat.get_block_completions(self.user, self.course_key)
-        }
+        # Blocks whose aggregators have new values that need to be written.
+        self._changed_aggregators = set()
+        self.skipped_writes = 0
+        self._block_completions = None
+
+    def load_course_blocks(self, modulestore, structures=None):
+        """
+        Return the formatted course blocks visible to the user.
+
+        Where possible, the course blocks are shared with other users who see
+        the same course structure, so that the course_blocks api is only
+        called once for all of them.  Structures are shared through
+        `StructureCache` if COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES is
+        set, and through the `structures` dict if one is given.
+        """
+        share = getattr(settings, 'COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES', False)
+        signature = None
+        if share or structures is not None:
+            signature = compat.get_course_structure_signature(modulestore, self.user, self.course_key)
+        if signature is None:
+            return self.format_course_blocks(compat.init_course_blocks(self.user, self.root_block), self.root_block)
+        if structures is not None:
+            self._shared_structure = structures.get(signature)
+        structure_cache = StructureCache(self.course_key, self.root_block, signature)
+        if self._shared_structure is None and share:
+            self._shared_structure = structure_cache.get()
+        if self._shared_structure is None:
+            course_blocks = self.format_course_blocks(
+                compat.init_course_blocks(self.user, self.root_block),
+                self.root_block,
+            )
+            entry = CacheEntry(
+                course_blocks=course_blocks,
+                root_block=self.root_block,
+                plan=AggregationPlan(course_blocks, self.root_block),
+            )
+            self._shared_structure = structure_cache.set(entry) if share else SharedStructure(entry)
+        if structures is not None:
+            structures[signature] = self._shared_structure
+        return self._shared_structure.entry.course_blocks
 
     def format_course_blocks(self, course_blocks, root_block):
         """
@@ -143,6 +624,8 @@ class AggregationUpdater(object):
                 )
             }
 
+        The structure is returned as a CompactCourseBlocks mapping, which is
+        much smaller than a dict when pickled into the cache.
         """
         structure = {}
 
@@ -156,12 +639,168 @@ class AggregationUpdater(object):
                     populate(structure, child)
 
         populate(structure, root_block)
-        return structure
+        return CompactCourseBlocks(structure)
+
+    @property
+    def plan(self):
+        """
+        Return the AggregationPlan for the course structure, compiling it on first use.
+        """
+        if self._plan is None:
+            if self._shared_structure is not None:
+                self._plan = self._shared_structure.plan
+            else:
+                self._plan = AggregationPlan(self.course_blocks, self.root_block)
+        return self._plan
+
+    @property
+    def aggregators(self):
+        """
+        Return a dict of all of the enrollment's aggregators, keyed by block key.
+        """
+        self.load_aggregators()
+        return self._aggregators
+
+    def load_aggregators(self, blocks=None):
+        """
+        Load stored aggregators that have not been loaded yet.
+
+        If `blocks` is given, only the aggregators of those blocks are loaded.
+        Otherwise, all of the enrollment's aggregators are loaded.
+        Aggregators that have already been loaded (and possibly modified)
+        are left in place.
+        """
+        if isinstance(self._loaded_aggregators, BagOfHolding):
+            return
+        queryset = Aggregator.objects.filter(user=self.user, course_key=self.course_key)
+        if blocks is not None:
+            blocks = [block for block in blocks if block not in self._loaded_aggregators]
+            if not blocks:
+                return
+            queryset = queryset.filter(block_key__in=blocks)
+            self._loaded_aggregators.update(blocks)
+        else:
+            self._loaded_aggregators = BagOfHolding()
+        for aggregator in queryset:
+            self._aggregators.setdefault(aggregator.block_key, aggregator)
+
+    def load_affected_aggregators(self, affected_aggregators):
+        """
+        Load the stored aggregators needed to update the affected aggregators.
+
+        These are the affected aggregators themselves, and the nearest
+        unaffected aggregators beneath them, whose stored values stand in
+        for their subtrees.  Where an unaffected aggregator has never been
+        stored, its subtree has to be recalculated, so the aggregators
+        beneath it are loaded in turn.
+        """
+        if isinstance(affected_aggregators, BagOfHolding):
+            self.load_aggregators()
+            return
+        plan = self.plan
+        if plan.blocks[plan.root] in affected_aggregators:
+            frontier = self._get_unaffected_aggregators(plan.root, affected_aggregators)
+        else:
+            frontier = [plan.root]
+        self.load_aggregators(
+            [block for block in affected_aggregators if block in plan]
+            + [plan.blocks[index] for index in frontier]
+        )
+        while frontier:
+            missing = [index for index in frontier if plan.blocks[index] not in self._aggregators]
+            frontier = []
+            for index in missing:
+                frontier.extend(self._get_unaffected_aggregators(index, affected_aggregators))
+            self.load_aggregators([plan.blocks[index] for index in frontier])
+
+    def _get_unaffected_aggregators(self, index, affected_aggregators):
+        """
+        Return the nearest unaffected aggregators in the subtree of the given plan node.
+
+        The node itself is not considered.
+        """
+        plan = self.plan
+        unaffected = []
+        descendant = index - 1
+        while descendant >= plan.first[index]:
+            if (
+                plan.modes[descendant] == XBlockCompletionMode.AGGREGATOR
+                and plan.blocks[descendant] not in affected_aggregators
+            ):
+                unaffected.append(descendant)
+                descendant = plan.first[descendant]
+            descendant -= 1
+        return unaffected
+
+    def preload(self, aggregators, block_completions):
+        """
+        Use stored aggregators and completions that have already been loaded.
+
+        This allows the data for many enrollments to be loaded in bulk.
+        `aggregators` must contain all of the enrollment's stored
+        aggregators, and `block_completions` must be in the format returned
+        by `load_block_completions`.
+        """
+        for aggregator in aggregators:
+            self._aggregators.setdefault(aggregator.block_key, aggregator)
+        self._loaded_aggregators = BagOfHolding()
+        self._block_completions = block_completions
+
+    @property
+    def block_completions(self):
+        """
+        Return all of the enrollment's completions, loading them on first use.
+
+        See `load_block_completions` for the format.
+        """
+        if self._block_completions is None:
+            self._block_completions = self.load_block_completions()
+        return self._block_completions
+
+    def load_block_completions(self, block_keys=None):
+        """
+        Return a dict mapping serialized block keys to (completion, modified) tuples.
+
+        If `block_keys` is given, only the completions of those blocks are
+        loaded.
+
+        Keys are left unparsed, and matched against the serialized keys in the
+        plan.  Keys stored without a course run still match, as their
+        serialized form does not include the run.
+        """
+        return {
+            block_key: (completion, modified)
+            for _, block_key, completion, modified in compat.get_block_completion_values(
+                [self.user.id],
+                self.course_key,
+                block_keys,
+            )
+        }
+
+    def get_plan_completions(self, nodes, affected_aggregators):
+        """
+        Return the completions needed to aggregate the given plan nodes.
+
+        When only part of the course is being updated, only the completions
+        of the completable blocks taking part in the update are loaded.
+        """
+        if self._block_completions is not None or isinstance(affected_aggregators, BagOfHolding):
+            return self.block_completions
+        plan = self.plan
+        block_keys = [plan.blocks[index] for index in nodes if plan.modes[index] == XBlockCompletionMode.COMPLETABLE]
+        if len(block_keys) > MAX_FILTERED_COMPLETIONS:
+            return self.block_completions
+        elif not block_keys:
+            return {}
+        return self.load_block_completions(block_keys)
 
     def set_cache(self):
         """
         Cache updater values to prevent calling course_blocks api.
 
+        The compiled AggregationPlan is cached with the course blocks, so
+        later requests do not need to compile it again.
+
         Calling the course_blocks api is time-consuming, primarily due to
         the StudentViewTransformer, which calls student_view_data() on each
         block.
@@ -173,7 +812,7 @@ class AggregationUpdater(object):
         """
         if self.using_cache:
             self.cache.touch()
-        entry = CacheEntry(course_blocks=self.course_blocks, root_block=self.root_block)
+        entry = CacheEntry(course_blocks=self.course_blocks, root_block=self.root_block, plan=self.plan)
         self.cache.set(entry)
 
     def get_affected_aggregators(self, changed_blocks):
@@ -196,9 +835,110 @@ class AggregationUpdater(object):
         Return updated aggregators without sumitting them to the database.
 
         And without clearing stale completions.
+
+        Unless the update is forced, changes to a few blocks are applied to
+        the aggregators containing them by `calculate_delta_aggregators`, if
+        COMPLETION_AGGREGATOR_DELTA_UPDATES is set.
         """
+        # Aggregators stored for courses with deprecated keys are stored
+        # without a course run, so they never match the plan's blocks.
+        if (
+            changed_blocks and not force and not self.course_key.deprecated
+            and getattr(settings, 'COMPLETION_AGGREGATOR_DELTA_UPDATES', True)
+        ):
+            if self.calculate_delta_aggregators(changed_blocks) is not None:
+                return self.updated_aggregators
+            log.info("Could not apply changes for %s in %s by difference.  Recalculating.", self.user, self.course_key)
         affected_aggregators = self.get_affected_aggregators(changed_blocks)
-        self.update_for_block(self.root_block, affected_aggregators, force)
+        self.update_for_plan(affected_aggregators, force)
+        return self.updated_aggregators
+
+    def calculate_delta_aggregators(self, changed_blocks):
+        """
+        Return aggregators updated along the paths from the changed blocks to the root, or None.
+
+        The nearest registered aggregator above each changed block is
+        recalculated from its own subtree, and the difference between its new
+        and stored `earned` values is added to the stored aggregators above
+        it.  Only the aggregators on those paths, and the completions
+        beneath the nearest aggregators, are loaded, rather than the whole
+        course.  Because the difference is taken against the stored values,
+        rather than reported by the caller, applying the same change again
+        leaves the aggregators as they are.
+
+        Returns None, without updating anything, when the course has to be
+        recalculated instead: when a changed block is not a completable block
+        with a single place in the course, or an aggregator on the path has
+        never been stored, or was stored with a different `possible` value
+        because the course structure has changed since, or the completions
+        beneath an aggregator have become older than its stored value.
+        """
+        plan = self.plan
+        nearest = set()
+        for block in changed_blocks:
+            index = plan.node(block)
+            if index is None or plan.modes[index] != XBlockCompletionMode.COMPLETABLE:
+                return None
+            index = plan.parents[index]
+            while index >= 0 and not plan.registered[index]:
+                index = plan.parents[index]
+            if index < 0:
+                return None
+            nearest.add(index)
+        path = set()
+        for index in nearest:
+            while index >= 0 and index not in path:
+                if plan.registered[index]:
+                    path.add(index)
+                index = plan.parents[index]
+        self.load_aggregators([plan.blocks[index] for index in path])
+        for index in path:
+            aggregator = self._aggregators.get(plan.blocks[index])
+            if aggregator is None or aggregator.possible != plan.possible[index]:
+                return None
+
+        leaves = sorted(set(
+            descendant
+            for index in nearest
+            for descendant in six.moves.range(plan.first[index], index)
+            if plan.modes[descendant] == XBlockCompletionMode.COMPLETABLE
+        ))
+        if self._block_completions is not None:
+            completions = self._block_completions
+        else:
+            completions = self.load_block_completions([plan.blocks[index] for index in leaves])
+        # Each changed aggregator's (earned, last_modified), starting from
+        # their stored values.
+        changes = {}
+        for index in sorted(nearest):
+            aggregator = self._aggregators[plan.blocks[index]]
+            earned = 0.0
+            last_modified = OLD_DATETIME
+            for descendant in six.moves.range(plan.first[index], index):
+                if plan.modes[descendant] == XBlockCompletionMode.COMPLETABLE:
+                    completion, modified = completions.get(plan.keys[descendant], (0.0, OLD_DATETIME))
+                    earned += completion
+                    last_modified = max(last_modified, modified)
+            if last_modified < aggregator.last_modified:
+                return None
+            delta = earned - aggregator.earned
+            changes[index] = (earned, last_modified)
+            # Aggregators up to the next recalculated aggregator already
+            # include this change.
+            ancestor = plan.parents[index]
+            while ancestor >= 0 and ancestor not in nearest:
+                if plan.registered[ancestor]:
+                    stored = self._aggregators[plan.blocks[ancestor]]
+                    ancestor_earned, ancestor_modified = changes.get(
+                        ancestor,
+                        (stored.earned, stored.last_modified),
+                    )
+                    changes[ancestor] = (ancestor_earned + delta, max(ancestor_modified, last_modified))
+                ancestor = plan.parents[ancestor]
+
+        for index in sorted(changes):
+            earned, last_modified = changes[index]
+            self._update_aggregator(plan.blocks[index], earned, plan.possible[index], last_modified)
         return self.updated_aggregators
 
     def update(self, changed_blocks=frozenset(), force=False):
@@ -211,94 +951,140 @@ class AggregationUpdater(object):
         updated. Otherwise, the entire course tree will be updated.
         """
         start = timezone.now()
-        updated_aggregators = self.calculate_updated_aggregators(changed_blocks, force)
-        Aggregator.objects.bulk_create_or_update(updated_aggregators)
+        self.calculate_updated_aggregators(changed_blocks, force)
+        self.write_aggregators()
         self.resolve_stale_completions(changed_blocks, start)
 
-    def update_for_block(self, block, affected_aggregators, force=False):
+    def write_aggregators(self):
+        """
+        Write the aggregators that have changed to the database.
         """
-        Recursive function to perform updates for a given block.
+        Aggregator.objects.bulk_create_or_update(self.get_aggregators_to_write())
+        if self.skipped_writes:
+            log.info(
+                "Skipped writing %s unchanged aggregators for %s in %s.",
+                self.skipped_writes,
+                self.user,
+                self.course_key,
+            )
 
-        Dispatches to an appropriate method given the block's completion_mode.
+    def get_plan_nodes(self, affected_aggregators):
         """
-        try:
-            mode = XBlockCompletionMode.get_mode(XBlock.load_class(block.block_type))
-        except PluginMissingError:
-            # Do not count blocks that aren't registered
-            mode = XBlockCompletionMode.EXCLUDED
-        if mode == XBlockCompletionMode.EXCLUDED:
-            return self.update_for_excluded()
-        elif mode == XBlockCompletionMode.COMPLETABLE:
-            return self.update_for_completable(block)
-        elif mode == XBlockCompletionMode.AGGREGATOR:
-            return self.update_for_aggregator(block, affected_aggregators, force)
-        else:
-            raise ValueError("Invalid completion mode {}".format(mode))
+        Return the plan nodes that take part in this update.
 
-    def update_for_aggregator(self, block, affected_aggregators, force):
-        """
-        Calculate the new completion values for an aggregator.
-        """
-        total_earned = 0.0
-        total_possible = 0.0
-        last_modified = OLD_DATETIME
-
-        if block not in affected_aggregators:
-            obj = self.aggregators.get(block)
-            if obj:
-                return CompletionStats(earned=obj.earned, possible=obj.possible, last_modified=obj.last_modified)
-        for child in self.course_blocks[block].children:
-            (earned, possible, modified) = self.update_for_block(child, affected_aggregators, force)
-            total_earned += earned
-            total_possible += possible
-            if modified is not None:
-                last_modified = max(last_modified, modified)
-        if self._aggregator_needs_update(block, last_modified, force):
-            if total_possible == 0.0:
-                percent = 1.0
-            else:
-                percent = total_earned / total_possible
-            Aggregator.objects.validate(self.user, self.course_key, block)
-            if block not in self.aggregators:
-                aggregator = Aggregator(
-                    user=self.user,
-                    course_key=self.course_key,
-                    block_key=block,
-                    aggregation_name=block.block_type,
-                    earned=total_earned,
-                    possible=total_possible,
-                    percent=percent,
-                    last_modified=last_modified,
-                )
-                self.aggregators[block] = aggregator
+        Walks the plan from the root down, descending into every aggregator
+        that needs to be recalculated.  Aggregators that are unaffected by
+        the update and already have a stored value are included, but their
+        subtrees are skipped.
+
+        Returns a tuple of the node indices, in reverse post-order (so every
+        node comes before its descendants), and the set of indices of the
+        aggregators whose stored values will be used.
+        """
+        plan = self.plan
+        self.load_affected_aggregators(affected_aggregators)
+        nodes = []
+        stored = set()
+        index = plan.root
+        while index >= 0:
+            nodes.append(index)
+            if plan.modes[index] == XBlockCompletionMode.AGGREGATOR:
+                block = plan.blocks[index]
+                if block not in affected_aggregators and block in self._aggregators:
+                    # Skip the rest of the subtree, and use the stored value.
+                    stored.add(index)
+                    index = plan.first[index]
+            index -= 1
+        return nodes, stored
+
+    def update_for_plan(self, affected_aggregators, force=False):
+        """
+        Calculate the completion values of the course in a single iterative pass over the plan.
+
+        Updated aggregators are appended to `self.updated_aggregators`.
+        """
+        plan = self.plan
+        nodes, stored = self.get_plan_nodes(affected_aggregators)
+        completions = self.get_plan_completions(nodes, affected_aggregators)
+        total_earned = [0.0] * len(plan)
+        total_possible = [0.0] * len(plan)
+        total_modified = [OLD_DATETIME] * len(plan)
+
+        for index in reversed(nodes):
+            block = plan.blocks[index]
+            mode = plan.modes[index]
+            if mode == XBlockCompletionMode.EXCLUDED:
+                continue
+            elif mode == XBlockCompletionMode.COMPLETABLE:
+                earned, last_modified = completions.get(plan.keys[index], (0.0, OLD_DATETIME))
+                possible = 1.0
+            elif index in stored:
+                obj = self._aggregators[block]
+                earned = obj.earned
+                possible = obj.possible
+                last_modified = obj.last_modified
             else:
-                aggregator = self.aggregators[block]
-                aggregator.earned = total_earned
-                aggregator.possible = total_possible
+                # All children of this aggregator have already been accumulated.
+                earned = total_earned[index]
+                possible = total_possible[index]
+                last_modified = total_modified[index]
+                if plan.registered[index] and self._aggregator_needs_update(block, last_modified, force):
+                    self._update_aggregator(block, earned, possible, last_modified)
+
+            parent = plan.parents[index]
+            if parent >= 0:
+                total_earned[parent] += earned
+                total_possible[parent] += possible
+                if last_modified is not None and last_modified > total_modified[parent]:
+                    total_modified[parent] = last_modified
+
+    def _update_aggregator(self, block, earned, possible, last_modified):
+        """
+        Record new completion values for the aggregator of the given block.
+        """
+        if possible == 0.0:
+            percent = 1.0
+        else:
+            percent = earned / possible
+        Aggregator.objects.validate(self.user, self.course_key, block)
+        if block not in self._aggregators:
+            aggregator = Aggregator(
+                user=self.user,
+                course_key=self.course_key,
+                block_key=block,
+                aggregation_name=block.block_type,
+                earned=earned,
+                possible=possible,
+                percent=percent,
+                last_modified=last_modified,
+            )
+            self._aggregators[block] = aggregator
+            self._changed_aggregators.add(block)
+        else:
+            aggregator = self._aggregators[block]
+            if (aggregator.earned, aggregator.possible, aggregator.last_modified) != (earned, possible, last_modified):
+                aggregator.earned = earned
+                aggregator.possible = possible
                 aggregator.percent = percent
                 aggregator.last_modified = last_modified
                 aggregator.modified = timezone.now()
-            self.updated_aggregators.append(aggregator)
-        return CompletionStats(earned=total_earned, possible=total_possible, last_modified=last_modified)
+                self._changed_aggregators.add(block)
+        self.updated_aggregators.append(aggregator)
 
-    def update_for_excluded(self):
-        """
-        Return a sentinel empty completion value for excluded blocks.
+    def get_aggregators_to_write(self):
         """
-        return CompletionStats(earned=0.0, possible=0.0, last_modified=OLD_DATETIME)
+        Return the updated aggregators whose values need to be written to the database.
 
-    def update_for_completable(self, block):
+        Forced updates recalculate aggregators whose values have not changed.
+        Writing those would only bump their `modified` time, so they are left
+        out, and counted in `self.skipped_writes`.
         """
-        Return the block completion value for a given completable block.
-        """
-        completion = self.block_completions.get(block)
-        if completion:
-            earned = completion.completion
-            last_modified = completion.modified
-        else:
-            earned = 0.0
-            last_modified = OLD_DATETIME
-        return CompletionStats(earned=earned, possible=1.0, last_modified=last_modified)
+        to_write = [
+            aggregator for aggregator in self.updated_aggregators
+            if aggregator.block_key in self._changed_aggregators
+        ]
+        self.skipped_writes = len(self.updated_aggregators) - len(to_write)
+        return to_write
 
     def _aggregator_needs_update(self, block, modified, force):
         """
@@ -307,7 +1093,7 @@ class AggregationUpdater(object):
         This method assumes that the block has already been determined to be an aggregator.
         """
         if Aggregator.block_is_registered_aggregator(block):
-            agg = self.aggregators.get(block)
+            agg = self._aggregators.get(block)
             if agg is None or force:
                 return True
             return getattr(agg, 'last_modified', OLD_DATETIME) < modified
@@ -315,16 +1101,9 @@ class AggregationUpdater(object):
 
     def resolve_stale_completions(self, changed_blocks, start):
         """
-        Find all StaleCompletions resolved by this task and mark them resolved.
+        Find all stale work resolved by this task and mark it resolved.
         """
-        queryset = StaleCompletion.objects.filter(
-            username=self.user.username,
-            course_key=self.course_key,
-            modified__lt=start,
-        )
-        if changed_blocks:
-            queryset = queryset.filter(block_key__in=changed_blocks)
-        queryset.update(resolved=True)
+        stale.get_stale_backend().resolve(self.user.username, self.course_key, changed_blocks, before=start)
 
 
 def calculate_updated_aggregators(user, course_key, changed_blocks=frozenset(), root_block=None, force=False):
@@ -370,9 +1149,85 @@ def update_aggregators(user, course_key, block_keys=frozenset(), force=False):
         updater = AggregationUpdater(user, course_key, compat.get_modulestore())
     except compat.get_item_not_found_error():
         log.exception("Course not found in modulestore.  Skipping aggregation for %s in %s.", user, course_key)
-        StaleCompletion.objects.filter(username=user.username, course_key=course_key).update(resolved=True)
+        stale.get_stale_backend().discard([user.username], course_key)
     except TypeError:
         log.exception("Could not parse modulestore data.  Skipping aggregation for %s in %s.", user, course_key)
-        StaleCompletion.objects.filter(username=user.username, course_key=course_key).update(resolved=True)
+        stale.get_stale_backend().discard([user.username], course_key)
     else:
         updater.update(block_keys, force)
+
+
+def update_aggregators_in_bulk(course_key, enrollments):
+    """
+    Update the aggregators for many enrollments in a single course.
+
+    The stored aggregators and completions of all the enrollments are
+    loaded with one query each, and all of the updated aggregators are
+    written with a single bulk update.  Enrollments with the same view of
+    the course share a single course structure and plan.
+
+    Parameters
+    ----------
+        course_key (opaque_keys.edx.keys.CourseKey):
+            The course in which the aggregators need updating.
+        enrollments (list[tuple]):
+            A list of (user, block_keys, force) tuples, where `user` is the
+            django.contrib.auth.models.User whose aggregators need updating,
+            `block_keys` is the set of completable blocks that have changed
+            (or an empty set to update the whole course), and `force` is True
+            if the aggregators should be updated even if they are
+            up-to-date.
+
+    """
+    start = timezone.now()
+    modulestore = compat.get_modulestore()
+    updaters = []
+    structures = {}
+    try:
+        with modulestore.bulk_operations(course_key):
+            for user, block_keys, force in enrollments:
+                try:
+                    updater = AggregationUpdater(user, course_key, modulestore, structures=structures)
+                except TypeError:
+                    log.exception(
+                        "Could not parse modulestore data.  Skipping aggregation for %s in %s.", user, course_key
+                    )
+                    stale.get_stale_backend().discard([user.username], course_key)
+                else:
+                    updaters.append((updater, block_keys, force))
+    except compat.get_item_not_found_error():
+        log.exception("Course not found in modulestore.  Skipping aggregation for %s.", course_key)
+        stale.get_stale_backend().discard([user.username for user, _, _ in enrollments], course_key)
+        return
+    if not updaters:
+        return
+
+    users = {updater.user.id: updater.user for updater, _, _ in updaters}
+    aggregators = defaultdict(list)
+    for aggregator in Aggregator.objects.filter(course_key=course_key, user_id__in=list(users)):
+        aggregator.user = users[aggregator.user_id]
+        aggregators[aggregator.user_id].append(aggregator)
+    block_completions = defaultdict(dict)
+    for user_id, block_key, completion, modified in compat.get_block_completion_values(list(users), course_key):
+        block_completions[user_id][block_key] = (completion, modified)
+
+    updated_aggregators = []
+    skipped_writes = 0
+    for updater, block_keys, force in updaters:
+        updater.preload(aggregators[updater.user.id], block_completions[updater.user.id])
+        updater.calculate_updated_aggregators(block_keys, force)
+        updated_aggregators.extend(updater.get_aggregators_to_write())
+        skipped_writes += updater.skipped_writes
+    Aggregator.objects.bulk_create_or_update(updated_aggregators)
+    if skipped_writes:
+        log.info("Skipped writing %s unchanged aggregators in %s.", skipped_writes, course_key)
+
+    # Enrollments updated for the whole course can be resolved together.
+    stale.get_stale_backend().resolve_many(
+        [updater.user.username for updater, block_keys, _ in updaters if not block_keys],
+        course_key,
+        before=start,
+    )
+    for updater, block_keys, _ in updaters:
+        if block_keys:
+            updater.resolve_stale_completions(block_keys, start)
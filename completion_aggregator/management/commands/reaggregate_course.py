@@ -18,8 +18,7 @@ from django.core.management.base import BaseCommand
 
 from completion.models import BlockCompletion
 
-from ... import compat
-from ...models import StaleCompletion
+from ... import compat, stale
 
 
 class Command(BaseCommand):
@@ -59,18 +58,14 @@ class Command(BaseCommand):
         CourseEnrollment = compat.course_enrollment_model()  # pylint: disable=invalid-name
         for course in options['course_keys']:
             all_enrollments = CourseEnrollment.objects.filter(course_key=course).select_related('user')
-            StaleCompletion.objects.bulk_create(
-                (
-                    StaleCompletion(
-                        course_key=enrollment.course_id,
-                        username=enrollment.user,
-                        block_key=None,
-                        force=True,
-                        resolved=False
-                    )
-                    for enrollment in all_enrollments
-                ),
-                batch_size=10000,
+            stale.get_stale_backend().mark_stale(
+                stale.StaleEntry(
+                    course_key=enrollment.course_id,
+                    username=enrollment.user.username,
+                    block_key=None,
+                    force=True,
+                )
+                for enrollment in all_enrollments
             )
 
         return
@@ -5,7 +5,8 @@ Usage:
 
     ./manage.py run_aggregator_cleanup
 
-Removes StaleAggregators that have been marked resolved.
+Removes StaleAggregators that have been marked resolved, and old cache group
+invalidation records.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
@@ -15,6 +16,7 @@ import logging
 from django.core.management.base import BaseCommand
 
 from ...batch import perform_cleanup
+from ...cachegroup import PURGE_BATCH_SIZE, purge_invalidations
 
 
 class Command(BaseCommand):
@@ -22,12 +24,26 @@ class Command(BaseCommand):
     run_aggregator_service management command.
     """
 
+    def add_arguments(self, parser):
+        """
+        Add command-line arguments
+        """
+        parser.add_argument(
+            '--invalidation-batch-size',
+            help='Number of cache group invalidation records to delete at a time.  (default: {})'.format(
+                PURGE_BATCH_SIZE,
+            ),
+            default=PURGE_BATCH_SIZE,
+            type=int,
+        )
+
     def handle(self, *args, **options):
         """
         Run the aggregator service.
         """
         self.set_logging(options['verbosity'])
         perform_cleanup()
+        purge_invalidations(batch_size=options['invalidation_batch_size'])
 
     def set_logging(self, verbosity):
         """
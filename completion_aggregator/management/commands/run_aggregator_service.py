@@ -7,7 +7,8 @@ Usage:
 
 Performs the actual aggregation.
 
-For continuous aggregation, set a cron job to run this task periodically.
+For continuous aggregation, either set a cron job to run this task
+periodically, or run it as a long-lived process with --continuous.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
@@ -16,7 +17,10 @@ import logging
 
 from django.core.management.base import BaseCommand
 
-from ...batch import perform_aggregation
+from ...backpressure import RateController, get_celery_queue_depth
+from ...batch import get_bulk_routing_key, perform_aggregation
+from ...service import AggregatorService
+from ...tasks.handler_tasks import mark_due_courses_stale
 
 
 class Command(BaseCommand):
@@ -51,19 +55,131 @@ class Command(BaseCommand):
             dest='routing_key',
             help='Celery routing key to use.',
         )
+        parser.add_argument(
+            '--users-per-task',
+            dest='users_per_task',
+            help='Group up to this many enrollments in the same course into a single celery task.  '
+                 '(default: one task per enrollment)',
+            type=int,
+        )
+        parser.add_argument(
+            '--bulk-routing-key',
+            dest='bulk_routing_key',
+            help='Celery routing key to use for forced and whole-course updates.  '
+                 '(default: COMPLETION_AGGREGATOR_BULK_ROUTING_KEY, or --routing-key)',
+        )
+        parser.add_argument(
+            '--interactive-limit',
+            help='Maximum number of block-level updates to enqueue per run.  (default: no limit)',
+            type=int,
+        )
+        parser.add_argument(
+            '--bulk-limit',
+            help='Maximum number of forced or whole-course updates to enqueue per run.  (default: no limit)',
+            type=int,
+        )
+        parser.add_argument(
+            '--target-backlog',
+            help='Pace enqueueing to keep about this many messages waiting in the celery queue, instead of '
+                 'sleeping a fixed time between batches.  (default: no pacing)',
+            type=int,
+        )
+        parser.add_argument(
+            '--continuous',
+            action='store_true',
+            help='Keep running, enqueueing up to --limit StaleCompletions per cycle, until stopped by SIGTERM or '
+                 'SIGINT.',
+        )
+        parser.add_argument(
+            '--min-sleep',
+            help='In continuous mode, seconds to sleep between cycles that find work.  (default: 1.0)',
+            default=1.0,
+            type=float,
+        )
+        parser.add_argument(
+            '--max-sleep',
+            help='In continuous mode, the longest time to sleep between cycles while idle.  (default: 30.0)',
+            default=30.0,
+            type=float,
+        )
+        parser.add_argument(
+            '--max-queue-depth',
+            help='In continuous mode, skip cycles while the celery queue holds more than this many messages.  '
+                 '(default: no limit)',
+            type=int,
+        )
+        parser.add_argument(
+            '--requeue-after',
+            help='In continuous mode, seconds before an enrollment with unresolved stale work is enqueued again.  '
+                 '(default: 60.0)',
+            default=60.0,
+            type=float,
+        )
+        parser.add_argument(
+            '--scan-limit',
+            help='In continuous mode, the maximum number of StaleCompletions to read per cycle, including those of '
+                 'enrollments that are still in flight.  (default: ten times --limit)',
+            type=int,
+        )
 
     def handle(self, *args, **options):
         """
         Run the aggregator service.
         """
         self.set_logging(options['verbosity'])
+        if options.get('continuous'):
+            service = AggregatorService(
+                batch_size=options['batch_size'],
+                limit=options['limit'],
+                routing_key=options.get('routing_key'),
+                users_per_task=options.get('users_per_task'),
+                min_sleep=options['min_sleep'],
+                max_sleep=options['max_sleep'],
+                max_queue_depth=options.get('max_queue_depth'),
+                requeue_after=options['requeue_after'],
+                scan_limit=options.get('scan_limit'),
+                target_backlog=options.get('target_backlog'),
+                **self.get_lane_options(options)
+            )
+            service.install_signal_handlers()
+            service.run()
+            return
+        mark_due_courses_stale()
         perform_aggregation(
             batch_size=options['batch_size'],
             delay=options['delay_between_batches'],
             limit=options['limit'],
             routing_key=options.get('routing_key'),
+            users_per_task=options.get('users_per_task'),
+            **dict(self.get_lane_options(options), **self.get_pacers(options))
         )
 
+    def get_lane_options(self, options):
+        """
+        Return the options for the interactive and bulk lanes.
+        """
+        return {
+            'bulk_routing_key': options.get('bulk_routing_key'),
+            'interactive_limit': options.get('interactive_limit'),
+            'bulk_limit': options.get('bulk_limit'),
+        }
+
+    def get_pacers(self, options):
+        """
+        Return RateControllers for each lane's queue if a target backlog was given.
+        """
+        if options.get('target_backlog') is None:
+            return {}
+        routing_key = options.get('routing_key')
+        pacers = {'pacer': RateController(options['target_backlog'], lambda: get_celery_queue_depth(routing_key))}
+        bulk_routing_key = get_bulk_routing_key(routing_key, options.get('bulk_routing_key'))
+        if bulk_routing_key != routing_key:
+            pacers['bulk_pacer'] = RateController(
+                options['target_backlog'],
+                lambda: get_celery_queue_depth(bulk_routing_key),
+            )
+        return pacers
+
     def set_logging(self, verbosity):
         """
         Set the logging level depending on the desired vebosity
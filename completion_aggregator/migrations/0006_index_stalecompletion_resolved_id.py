@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('completion_aggregator', '0005_cachegroupinvalidation'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='stalecompletion',
+            index_together=set([('username', 'course_key', 'created', 'resolved'), ('resolved', 'id')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 03:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import opaque_keys.edx.django.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('completion_aggregator', '0007_staleenrollment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingStaleCourse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('course_key', opaque_keys.edx.django.models.CourseKeyField(max_length=255, unique=True)),
+                ('requested', models.DateTimeField()),
+                ('run_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
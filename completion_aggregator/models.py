@@ -5,6 +5,7 @@ Database models for completion aggregator.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import six
 from opaque_keys.edx.django.models import CourseKeyField, UsageKeyField
 from opaque_keys.edx.keys import CourseKey, UsageKey
 
@@ -24,8 +25,7 @@ INSERT_OR_UPDATE_AGGREGATOR_QUERY = """
     INSERT INTO completion_aggregator_aggregator
         (user_id, course_key, block_key, aggregation_name, earned, possible, percent, last_modified, created, modified)
     VALUES
-        (%(user)s, %(course_key)s, %(block_key)s, %(aggregation_name)s, %(earned)s,
-        %(possible)s, %(percent)s, %(last_modified)s, %(created)s, %(modified)s)
+        {values}
     ON DUPLICATE KEY UPDATE
         earned=VALUES(earned),
         possible=VALUES(possible),
@@ -34,6 +34,25 @@ INSERT_OR_UPDATE_AGGREGATOR_QUERY = """
         modified=VALUES(modified);
 """
 
+UPSERT_AGGREGATOR_ON_CONFLICT_QUERY = """
+    INSERT INTO completion_aggregator_aggregator
+        (user_id, course_key, block_key, aggregation_name, earned, possible, percent, last_modified, created, modified)
+    VALUES
+        {values}
+    ON CONFLICT (course_key, block_key, user_id, aggregation_name) DO UPDATE SET
+        earned=excluded.earned,
+        possible=excluded.possible,
+        percent=excluded.percent,
+        last_modified=excluded.last_modified,
+        modified=excluded.modified;
+"""
+
+# The number of columns in each row of the upsert queries above.
+UPSERT_AGGREGATOR_COLUMN_COUNT = 10
+
+# The default maximum number of aggregators to write in a single upsert query.
+DEFAULT_UPSERT_BATCH_SIZE = 1000
+
 
 def validate_percent(value):
     """
@@ -174,25 +193,65 @@ class AggregatorManager(models.Manager):
 
     def bulk_create_or_update(self, updated_aggregators):
         """
-        Update the collection of aggregator object using mysql insert on duplicate update query.
-        """
-        if updated_aggregators:
-            with connection.cursor() as cur:
-                # SQLite doesn't support the bulk query, so use the normal inefficient approach
-                if connection.vendor == 'sqlite':
-                    for aggregator in updated_aggregators:
-                        self.submit_completion(
-                            user=aggregator.user,
-                            course_key=aggregator.course_key,
-                            block_key=aggregator.block_key,
-                            aggregation_name=aggregator.aggregation_name,
-                            possible=aggregator.possible,
-                            earned=aggregator.earned,
-                            last_modified=aggregator.last_modified,
-                        )
-                else:
-                    aggregation_data = [obj.get_values() for obj in updated_aggregators]
-                    cur.executemany(INSERT_OR_UPDATE_AGGREGATOR_QUERY, aggregation_data)
+        Update the collection of aggregator objects with bulk upsert queries.
+
+        MySQL uses INSERT ... ON DUPLICATE KEY UPDATE, while PostgreSQL and
+        SQLite (3.24.0 and later) use INSERT ... ON CONFLICT DO UPDATE.  Each
+        query writes a chunk of at most COMPLETION_AGGREGATOR_UPSERT_BATCH_SIZE
+        rows, to bound the size of the query and the time row locks are
+        held.  Other databases fall back to updating one aggregator at a
+        time.
+        """
+        if not updated_aggregators:
+            return
+        if connection.vendor == 'mysql':
+            self._bulk_upsert(INSERT_OR_UPDATE_AGGREGATOR_QUERY, updated_aggregators)
+        elif self._supports_on_conflict():
+            self._bulk_upsert(UPSERT_AGGREGATOR_ON_CONFLICT_QUERY, updated_aggregators)
+        else:
+            for aggregator in updated_aggregators:
+                self.submit_completion(
+                    user=aggregator.user,
+                    course_key=aggregator.course_key,
+                    block_key=aggregator.block_key,
+                    aggregation_name=aggregator.aggregation_name,
+                    possible=aggregator.possible,
+                    earned=aggregator.earned,
+                    last_modified=aggregator.last_modified,
+                )
+
+    @staticmethod
+    def _supports_on_conflict():
+        """
+        Return True if the database supports INSERT ... ON CONFLICT DO UPDATE.
+        """
+        if connection.vendor == 'postgresql':
+            return True
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 24, 0)
+        return False
+
+    @staticmethod
+    def _bulk_upsert(query, updated_aggregators):
+        """
+        Upsert the aggregators in chunks, using a multi-row query for each chunk.
+
+        `query` is formatted with the VALUES placeholders for each chunk.
+        """
+        batch_size = max(1, getattr(settings, 'COMPLETION_AGGREGATOR_UPSERT_BATCH_SIZE', DEFAULT_UPSERT_BATCH_SIZE))
+        # SQLite limits the number of parameters in a single query.
+        batch_size = min(
+            batch_size,
+            connection.ops.bulk_batch_size([None] * UPSERT_AGGREGATOR_COLUMN_COUNT, updated_aggregators),
+        )
+        row = '({})'.format(', '.join(['%s'] * UPSERT_AGGREGATOR_COLUMN_COUNT))
+        with connection.cursor() as cur:
+            for start in six.moves.range(0, len(updated_aggregators), batch_size):
+                batch = updated_aggregators[start:start + batch_size]
+                params = []
+                for aggregator in batch:
+                    params.extend(aggregator.get_row())
+                cur.execute(query.format(values=', '.join([row] * len(batch))), params)
 
 
 @python_2_unicode_compatible
@@ -253,6 +312,25 @@ class Aggregator(TimeStampedModel):
         ]})
         return values
 
+    def get_row(self):
+        """
+        Return a tuple of column values to be used in bulk create or update queries.
+
+        The values are in the column order of INSERT_OR_UPDATE_AGGREGATOR_QUERY.
+        """
+        return (
+            self.user_id,
+            six.text_type(self.course_key),
+            six.text_type(self.block_key),
+            self.aggregation_name,
+            self.earned,
+            self.possible,
+            get_percent(self.earned, self.possible) if self.percent is None else self.percent,
+            make_datetime_timezone_unaware(self.last_modified),
+            make_datetime_timezone_unaware(self.created),
+            make_datetime_timezone_unaware(self.modified),
+        )
+
     @classmethod
     def block_is_registered_aggregator(cls, block_key):
         """
@@ -287,6 +365,7 @@ class StaleCompletion(TimeStampedModel):
 
         index_together = [
             ('username', 'course_key', 'created', 'resolved'),
+            ('resolved', 'id'),
         ]
 
     def __str__(self):
@@ -301,6 +380,61 @@ class StaleCompletion(TimeStampedModel):
         return ''.join(parts)
 
 
+@python_2_unicode_compatible
+class StaleEnrollment(TimeStampedModel):
+    """
+    Tracking model for the aggregation work outstanding for an enrollment.
+
+    Unlike StaleCompletion, there is at most one row per enrollment, which
+    accumulates the enrollment's stale blocks until its aggregators are
+    updated, and is then deleted.
+    """
+
+    username = models.CharField(max_length=255)
+    course_key = CourseKeyField(max_length=255)
+    # Newline-separated usage keys of the stale blocks.  Empty if all_blocks is set.
+    block_keys = models.TextField(blank=True, default='')
+    all_blocks = models.BooleanField(default=False)
+    force = models.BooleanField(default=False)
+
+    class Meta(object):
+        """
+        Metadata describing the StaleEnrollment model.
+        """
+
+        unique_together = [
+            ('username', 'course_key'),
+        ]
+
+    def __str__(self):
+        """
+        Render the StaleEnrollment.
+        """
+        return '{}/{}'.format(self.username, self.course_key)
+
+
+@python_2_unicode_compatible
+class PendingStaleCourse(models.Model):
+    """
+    A course waiting to have all of its enrollments marked stale.
+
+    Course publishes come in bursts, so rather than marking the course stale
+    on every publish, it is recorded here, and marked stale once publishes
+    stop for a while.  Recording it in the database means the marking is not
+    lost if the task scheduled to do it is.
+    """
+
+    course_key = CourseKeyField(max_length=255, unique=True)
+    requested = models.DateTimeField()
+    run_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        """
+        Render the PendingStaleCourse.
+        """
+        return '{} at {}'.format(self.course_key, self.run_at)
+
+
 @python_2_unicode_compatible
 class CacheGroupInvalidation(models.Model):
     group = models.CharField(max_length=150, unique=True)
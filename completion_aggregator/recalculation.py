@@ -0,0 +1,152 @@
+"""
+Recalculation of stale aggregators while serving API requests.
+
+When a learner has stale completions in several courses, recalculating the
+aggregators of each course in turn can make a request very slow, as each
+recalculation may need to build a course structure.  If the
+COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS setting is set, the
+recalculations are instead run in a process-wide pool of that many threads.
+The request waits for them for at most
+COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET seconds, after which the
+courses that have not been recalculated are served from their stored
+aggregators, and flagged as stale.
+
+Parallel recalculation requires `concurrent.futures`, which on python 2 is
+provided by the `futures` package.  Without it, recalculation is serial.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import threading
+
+from django import db
+from django.conf import settings
+
+from .core import calculate_updated_aggregators
+
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RECALCULATION_BUDGET = 5.0
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+# The running recalculations, by (user id, course key, root block).
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return the thread pool for recalculating stale aggregators, or None if recalculation is serial.
+    """
+    threads = getattr(settings, 'COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS', None)
+    if not threads:
+        return None
+    if futures is None:  # pragma: no cover
+        log.warning("Parallel recalculation of stale aggregators requires concurrent.futures.  Recalculating serially.")
+        return None
+    with _executors_lock:
+        if threads not in _executors:
+            _executors[threads] = futures.ThreadPoolExecutor(max_workers=threads)
+        return _executors[threads]
+
+
+def _calculate_in_thread(user, course_key, root_block):
+    """
+    Calculate the updated aggregators of an enrollment in a pool thread.
+
+    Django opens a database connection for each thread that uses one, so
+    the thread's connections are closed when it is done, rather than being
+    held open by the idle thread.
+    """
+    try:
+        return calculate_updated_aggregators(user, course_key, root_block=root_block, force=True)
+    finally:
+        db.connections.close_all()
+
+
+def _submit(executor, user, course_key, root_block):
+    """
+    Return a future for the recalculation of an enrollment.
+
+    If a recalculation of the enrollment is already queued or running, such
+    as one abandoned by an earlier request that ran out of time, its future
+    is returned rather than tying up another pool thread.
+    """
+    key = (user.id, course_key, root_block)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            return future
+        future = executor.submit(_calculate_in_thread, user, course_key, root_block)
+        _in_flight[key] = future
+
+    def forget(done):
+        with _in_flight_lock:
+            if _in_flight.get(key) is done:
+                del _in_flight[key]
+
+    future.add_done_callback(forget)
+    return future
+
+
+def recalculate(adapters, executor, root_block=None, budget=None):
+    """
+    Recalculate the aggregators of stale AggregatorAdapters in parallel.
+
+    The adapters hold their stored aggregators, which are replaced by the
+    recalculated ones.  Recalculations that have not finished within
+    `budget` seconds are abandoned, and their adapters keep their stored
+    aggregators and are flagged as stale.  If `budget` is None, the
+    COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET setting is used, or
+    DEFAULT_RECALCULATION_BUDGET if that is not set, so a request never
+    waits indefinitely.  Recalculations that fail are handled in the same
+    way.  An enrollment that is still being recalculated for an earlier
+    request is not submitted again; its running recalculation is waited on
+    instead.
+    """
+    if budget is None:
+        budget = getattr(settings, 'COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET', None)
+    if budget is None:
+        budget = DEFAULT_RECALCULATION_BUDGET
+    pending = {
+        _submit(executor, adapter.user, adapter.course_key, root_block): adapter
+        for adapter in adapters
+    }
+    done, not_done = futures.wait(pending, timeout=budget)
+    # Recalculations cancelled by another request that ran out of time count
+    # as unfinished.
+    cancelled = {future for future in done if future.cancelled()}
+    for future in done - cancelled:
+        adapter = pending[future]
+        try:
+            aggregators = future.result()
+        except Exception:  # pylint: disable=broad-except
+            log.exception(
+                "Recalculation of stale completions for %s+%s failed, using stored aggregators.",
+                adapter.user,
+                adapter.course_key,
+            )
+            adapter.stale = True
+            continue
+        adapter.aggregators.clear()
+        adapter.update_aggregators(aggregators)
+    for future in not_done | cancelled:
+        # Recalculations that have not started are dropped.  Those that have
+        # started run to completion, and their results are discarded.
+        future.cancel()
+        adapter = pending[future]
+        log.info(
+            "Recalculation of stale completions for %s+%s took over %ss, using stored aggregators.",
+            adapter.user,
+            adapter.course_key,
+            budget,
+        )
+        adapter.stale = True
@@ -12,32 +12,21 @@ from collections import defaultdict
 import six
 from rest_framework import serializers
 from xblock.completable import XBlockCompletionMode
-from xblock.core import XBlock
-from xblock.plugin import PluginMissingError
 
 from django.core.cache import cache
 from django.db.models import Sum, Value
 from django.db.models.functions import Coalesce
 
-from . import compat
+from . import compat, recalculation, stale
 from .core import calculate_updated_aggregators
-from .models import Aggregator, StaleCompletion
+from .models import Aggregator
+from .utils import completion_modes
 
 log = logging.getLogger(__name__)
 
 MEAN_CACHE_KEY_FORMAT = 'completion-api-v0.mean-completion.{course_key}'
 
 
-def get_completion_mode(block):
-    """
-    Return the completion_mode of the specified block.
-
-    Blocks with no explicit completion_mode are considered to be
-    COMPLETABLE.
-    """
-    return getattr(block, "completion_mode", XBlockCompletionMode.COMPLETABLE)
-
-
 def is_aggregation_name(category):
     """
     Return True if the named category is a valid aggregation name.
@@ -46,12 +35,44 @@ def is_aggregation_name(category):
     a completion_mode of XBlockCompletionMode.AGGREGATOR, but this may be
     expanded in the future.
     """
-    try:
-        cls = XBlock.load_class(category)
-    except PluginMissingError:
-        return False
+    return completion_modes.get(category) == XBlockCompletionMode.AGGREGATOR
 
-    return get_completion_mode(cls) == XBlockCompletionMode.AGGREGATOR
+
+def get_stale_enrollments(user, course_keys):
+    """
+    Return the set of the given courses in which the user has stale completions.
+    """
+    return {
+        course_key for _, course_key in stale.get_stale_backend().is_stale_many(
+            [(user.username, course_key) for course_key in course_keys]
+        )
+    }
+
+
+def get_user_adapters(user, course_keys, aggregators_by_course):
+    """
+    Return an AggregatorAdapter for each of the user's courses.
+
+    Courses with stale completions are recalculated, in parallel if a
+    recalculation thread pool is configured.
+    """
+    stale_course_keys = get_stale_enrollments(user, course_keys)
+    executor = recalculation.get_executor()
+    adapters = [
+        AggregatorAdapter(
+            user=user,
+            course_key=course_key,
+            aggregators=aggregators_by_course[course_key],
+            recalculate_stale=executor is None,
+            is_stale=course_key in stale_course_keys,
+        ) for course_key in course_keys
+    ]
+    if executor is not None and stale_course_keys:
+        recalculation.recalculate(
+            [adapter for adapter in adapters if adapter.course_key in stale_course_keys],
+            executor,
+        )
+    return adapters
 
 
 class AggregatorAdapter(object):
@@ -96,26 +117,30 @@ class AggregatorAdapter(object):
     The adapter or list of adapters can then be passed to the serializer for processing.
     """
 
-    def __init__(self, user, course_key, aggregators=None, root_block=None, recalculate_stale=False):
+    def __init__(self, user, course_key, aggregators=None, root_block=None, recalculate_stale=False, is_stale=None):
         """
         Initialize the adapter.
 
         Optionally, an initial collection of aggregators may be provided, though these may be recalculated if the course
         is found to have stale completions.  Aggregators passed later will not be recalculated.
+
+        When creating many adapters, staleness can be looked up in bulk with
+        `get_stale_enrollments`, and passed in as `is_stale`, to save a query
+        per adapter.
+
+        `stale` is set if the adapter's aggregators are known to be out of
+        date, because they could not be recalculated in time.
         """
         self.user = user
         self.course_key = course_key
         self.aggregators = defaultdict(list)
+        self.stale = False
 
         # If requested, check for stale completions, to trigger recalculating the aggregators if any are found.
-        if recalculate_stale:
-            is_stale = StaleCompletion.objects.filter(
-                resolved=False,
-                username=self.user.username,
-                course_key=self.course_key,
-            ).exists()
-        else:
+        if not recalculate_stale:
             is_stale = False
+        elif is_stale is None:
+            is_stale = stale.get_stale_backend().is_stale(self.user.username, self.course_key)
 
         self.update_aggregators(aggregators or [], root_block=root_block, is_stale=is_stale)
 
@@ -235,8 +260,9 @@ class CourseCompletionSerializer(serializers.Serializer):
     completion = _CompletionSerializer(source='*')
     username = serializers.SerializerMethodField()
     mean = serializers.SerializerMethodField()
+    stale = serializers.BooleanField()
 
-    optional_fields = {'mean', 'username'}
+    optional_fields = {'mean', 'username', 'stale'}
 
     def __init__(self, instance, requested_fields=frozenset(), *args, **kwargs):
         """
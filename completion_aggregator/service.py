@@ -0,0 +1,254 @@
+"""
+Continuously running aggregator service.
+
+Rather than running `perform_aggregation` from cron, the service can run as
+a long-lived process that collects stale work in small cycles, so that
+aggregators are updated seconds after completions change.  Between cycles
+it sleeps for an interval that shrinks while there is work to do and grows
+while there is none.  While the celery queue is backed up beyond a maximum
+depth, no new work is enqueued.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import logging
+import signal
+import threading
+import time
+
+import six
+
+from django.conf import settings
+
+from . import backpressure, batch, stale
+from .tasks import handler_tasks
+
+log = logging.getLogger(__name__)
+
+# Unless given, a cycle's scan of the stale backend is limited to this many
+# times its `limit`.
+SCAN_LIMIT_FACTOR = 10
+
+# Measurements of a single cycle of the service.  `queue_depth` is None if
+# it was not measured, and `enrollments` is None if the cycle was skipped
+# because the queue was backed up.
+CycleMetrics = collections.namedtuple(
+    'CycleMetrics',
+    ['enrollments', 'duration', 'queue_depth', 'sleep'],
+)
+
+
+class AggregatorService(object):
+    """
+    Run `perform_aggregation` repeatedly until stopped.
+
+    min_sleep (float):
+        Seconds to sleep after a cycle that found work.  After a cycle that
+        stopped at its `limit` of stale blocks, the next cycle starts
+        immediately.
+    max_sleep (float):
+        While no work is found, the sleep doubles up to this many seconds.
+    max_queue_depth (int|None):
+        If the celery queue holds more messages than this, cycles are
+        skipped until it drains.  None disables the check.
+    requeue_after (float):
+        With stale backends that keep work until it is resolved, an
+        enrollment is not enqueued again for this many seconds, to give its
+        task time to run.
+    scan_limit (int|None):
+        With stale backends that keep work until it is resolved, the maximum
+        number of stale blocks read from the backend in a cycle, including
+        those of enrollments still in flight, so a large backlog of in-flight
+        work is not read again every cycle.  Defaults to ten times `limit`.
+    target_backlog (int|None):
+        If set, enqueueing within a cycle is paced by a RateController to
+        keep about this many messages in the celery queue.  If the bulk
+        lane has its own queue, it is paced by the depth of that queue.
+    queue_depth (callable|None):
+        A function returning the number of messages waiting in the celery
+        queue.  Defaults to measuring the queue for `routing_key`.
+
+    Other arguments, including the lane options `bulk_routing_key`,
+    `interactive_limit` and `bulk_limit`, are passed to
+    `perform_aggregation`.
+    """
+
+    def __init__(
+            self,
+            batch_size=1000,
+            limit=10000,
+            routing_key=None,
+            users_per_task=None,
+            min_sleep=1.0,
+            max_sleep=30.0,
+            max_queue_depth=None,
+            requeue_after=60.0,
+            scan_limit=None,
+            target_backlog=None,
+            queue_depth=None,
+            **lane_options
+    ):
+        self.batch_size = batch_size
+        self.limit = limit
+        self.routing_key = routing_key
+        self.users_per_task = users_per_task
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.max_queue_depth = max_queue_depth
+        self.requeue_after = requeue_after
+        if scan_limit is None and limit is not None:
+            scan_limit = limit * SCAN_LIMIT_FACTOR
+        self.scan_limit = scan_limit
+        self.queue_depth = queue_depth or (lambda: backpressure.get_celery_queue_depth(routing_key))
+        self.target_backlog = target_backlog
+        self.lane_options = lane_options
+        self.sleep = min_sleep
+        self.cycles = 0
+        self.total_enrollments = 0
+        self._enqueued = collections.OrderedDict()
+        self._next_sweep = 0.0
+        self._stopped = threading.Event()
+
+    def run(self, max_cycles=None):
+        """
+        Run cycles until stopped, or until `max_cycles` have run.
+        """
+        log.info("Starting aggregator service.")
+        while not self._stopped.is_set() and (max_cycles is None or self.cycles < max_cycles):
+            metrics = self.run_cycle()
+            if metrics.sleep:
+                self._stopped.wait(metrics.sleep)
+        log.info(
+            "Stopped aggregator service after %s cycles, enqueueing %s enrollments.",
+            self.cycles,
+            self.total_enrollments,
+        )
+
+    def run_cycle(self):
+        """
+        Enqueue one increment of stale work, and return the CycleMetrics.
+        """
+        start = time.time()
+        self.cycles += 1
+        if start >= self._next_sweep:
+            # Overdue courses only need catching occasionally, so they are
+            # swept less often than cycles run.
+            handler_tasks.mark_due_courses_stale()
+            self._next_sweep = start + getattr(
+                settings,
+                'COMPLETION_AGGREGATOR_STALE_COURSE_SWEEP_INTERVAL',
+                handler_tasks.DEFAULT_STALE_COURSE_SWEEP_INTERVAL,
+            )
+        depth = self.queue_depth() if self.max_queue_depth is not None else None
+        if depth is not None and depth > self.max_queue_depth:
+            enrollments = None
+            self.sleep = self._backoff()
+        else:
+            result = batch.enqueue_stale_work(
+                batch_size=self.batch_size,
+                limit=self.limit,
+                routing_key=self.routing_key,
+                users_per_task=self.users_per_task,
+                work_filter=None if stale.get_stale_backend().REMOVES_COLLECTED_WORK else self._skip_in_flight,
+                scan_limit=self.scan_limit,
+                **dict(self.lane_options, **self._get_pacers())
+            )
+            enrollments = result.enrollments
+            self.total_enrollments += enrollments
+            if result.limited:
+                self.sleep = 0.0
+            elif enrollments:
+                self.sleep = self.min_sleep
+            else:
+                self.sleep = self._backoff()
+        metrics = CycleMetrics(
+            enrollments=enrollments,
+            duration=time.time() - start,
+            queue_depth=depth,
+            sleep=self.sleep,
+        )
+        self.report(metrics)
+        return metrics
+
+    def _get_pacers(self):
+        """
+        Return the pacers for a cycle's enqueueing, as arguments to `enqueue_stale_work`.
+
+        No pacers are returned if there is no target backlog, so tasks are
+        enqueued without pausing.
+        """
+        if self.target_backlog is None:
+            return {}
+        pacers = {'pacer': self._get_rate_controller(self.queue_depth)}
+        bulk_routing_key = batch.get_bulk_routing_key(self.routing_key, self.lane_options.get('bulk_routing_key'))
+        if bulk_routing_key != self.routing_key:
+            pacers['bulk_pacer'] = self._get_rate_controller(
+                lambda: backpressure.get_celery_queue_depth(bulk_routing_key)
+            )
+        return pacers
+
+    def _get_rate_controller(self, probe):
+        """
+        Return a RateController that stops holding off when the service is stopped.
+        """
+        return backpressure.RateController(self.target_backlog, probe, stop_event=self._stopped)
+
+    def _backoff(self):
+        """
+        Return the next, longer, sleep while the service is idle.
+        """
+        return min(max(self.sleep * 2, self.min_sleep), self.max_sleep)
+
+    def _skip_in_flight(self, stale_work):
+        """
+        Filter out enrollments enqueued within the last `requeue_after` seconds.
+        """
+        now = time.time()
+        while self._enqueued and next(six.itervalues(self._enqueued)) < now - self.requeue_after:
+            self._enqueued.popitem(last=False)
+        for work in stale_work:
+            enrollment = (work.username, work.course_key)
+            if enrollment in self._enqueued:
+                continue
+            self._enqueued[enrollment] = now
+            yield work
+
+    def report(self, metrics):
+        """
+        Log the metrics of a cycle.
+        """
+        if metrics.enrollments is None:
+            log.info(
+                "Aggregator cycle %s skipped: queue depth %s exceeds %s.  Sleeping %.1fs.",
+                self.cycles,
+                metrics.queue_depth,
+                self.max_queue_depth,
+                metrics.sleep,
+            )
+            return
+        log.info(
+            "Aggregator cycle %s: enqueued %s enrollments in %.3fs (%.1f/s), queue depth %s.  Sleeping %.1fs.",
+            self.cycles,
+            metrics.enrollments,
+            metrics.duration,
+            metrics.enrollments / metrics.duration if metrics.duration else 0.0,
+            metrics.queue_depth,
+            metrics.sleep,
+        )
+
+    def stop(self, signum=None, frame=None):  # pylint: disable=unused-argument
+        """
+        Stop the service once the current cycle has finished.
+
+        Can be used as a signal handler.
+        """
+        log.info("Stopping aggregator service.")
+        self._stopped.set()
+
+    def install_signal_handlers(self):
+        """
+        Stop the service gracefully on SIGTERM and SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
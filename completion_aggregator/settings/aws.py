@@ -18,3 +18,88 @@ def plugin_settings(settings):
         'COMPLETION_AGGREGATOR_ASYNC_AGGREGATION',
         settings.COMPLETION_AGGREGATOR_ASYNC_AGGREGATION,
     )
+
+    settings.COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES',
+        settings.COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES,
+    )
+
+    settings.COMPLETION_AGGREGATOR_DELTA_UPDATES = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_DELTA_UPDATES',
+        settings.COMPLETION_AGGREGATOR_DELTA_UPDATES,
+    )
+
+    settings.COMPLETION_AGGREGATOR_UPSERT_BATCH_SIZE = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_UPSERT_BATCH_SIZE',
+        settings.COMPLETION_AGGREGATOR_UPSERT_BATCH_SIZE,
+    )
+
+    settings.COMPLETION_AGGREGATOR_COALESCE_STALE_COMPLETIONS = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_COALESCE_STALE_COMPLETIONS',
+        settings.COMPLETION_AGGREGATOR_COALESCE_STALE_COMPLETIONS,
+    )
+
+    settings.COMPLETION_AGGREGATOR_DEDUPE_STALE_COMPLETIONS = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_DEDUPE_STALE_COMPLETIONS',
+        settings.COMPLETION_AGGREGATOR_DEDUPE_STALE_COMPLETIONS,
+    )
+
+    settings.COMPLETION_AGGREGATOR_STALE_BACKEND = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_STALE_BACKEND',
+        settings.COMPLETION_AGGREGATOR_STALE_BACKEND,
+    )
+
+    settings.COMPLETION_AGGREGATOR_STALE_REDIS_URL = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_STALE_REDIS_URL',
+        settings.COMPLETION_AGGREGATOR_STALE_REDIS_URL,
+    )
+
+    settings.COMPLETION_AGGREGATOR_STALE_REDIS_LEASE = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_STALE_REDIS_LEASE',
+        settings.COMPLETION_AGGREGATOR_STALE_REDIS_LEASE,
+    )
+
+    settings.COMPLETION_AGGREGATOR_BULK_ROUTING_KEY = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_BULK_ROUTING_KEY',
+        settings.COMPLETION_AGGREGATOR_BULK_ROUTING_KEY,
+    )
+
+    settings.COMPLETION_AGGREGATOR_MARK_ALL_STALE_CHUNK_SIZE = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_MARK_ALL_STALE_CHUNK_SIZE',
+        settings.COMPLETION_AGGREGATOR_MARK_ALL_STALE_CHUNK_SIZE,
+    )
+
+    settings.COMPLETION_AGGREGATOR_MARK_ALL_STALE_USERS_PER_TASK = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_MARK_ALL_STALE_USERS_PER_TASK',
+        settings.COMPLETION_AGGREGATOR_MARK_ALL_STALE_USERS_PER_TASK,
+    )
+
+    settings.COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_SECONDS = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_SECONDS',
+        settings.COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_SECONDS,
+    )
+
+    settings.COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_MAX_DELAY = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_MAX_DELAY',
+        settings.COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_MAX_DELAY,
+    )
+
+    settings.COMPLETION_AGGREGATOR_STALE_COURSE_SWEEP_INTERVAL = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_STALE_COURSE_SWEEP_INTERVAL',
+        settings.COMPLETION_AGGREGATOR_STALE_COURSE_SWEEP_INTERVAL,
+    )
+
+    settings.COMPLETION_AGGREGATOR_VERSIONED_CACHE_GROUPS = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_VERSIONED_CACHE_GROUPS',
+        settings.COMPLETION_AGGREGATOR_VERSIONED_CACHE_GROUPS,
+    )
+
+    settings.COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS',
+        settings.COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS,
+    )
+
+    settings.COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET = settings.ENV_TOKENS.get(
+        'COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET',
+        settings.COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET,
+    )
@@ -16,3 +16,20 @@ def plugin_settings(settings):
         'vertical',
     }
     settings.COMPLETION_AGGREGATOR_ASYNC_AGGREGATION = False
+    settings.COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES = False
+    settings.COMPLETION_AGGREGATOR_DELTA_UPDATES = True
+    settings.COMPLETION_AGGREGATOR_UPSERT_BATCH_SIZE = 1000
+    settings.COMPLETION_AGGREGATOR_COALESCE_STALE_COMPLETIONS = False
+    settings.COMPLETION_AGGREGATOR_DEDUPE_STALE_COMPLETIONS = False
+    settings.COMPLETION_AGGREGATOR_STALE_BACKEND = 'completion_aggregator.stale.TableStaleBackend'
+    settings.COMPLETION_AGGREGATOR_STALE_REDIS_URL = 'redis://localhost:6379/0'
+    settings.COMPLETION_AGGREGATOR_STALE_REDIS_LEASE = 3600
+    settings.COMPLETION_AGGREGATOR_BULK_ROUTING_KEY = None
+    settings.COMPLETION_AGGREGATOR_MARK_ALL_STALE_CHUNK_SIZE = 1000
+    settings.COMPLETION_AGGREGATOR_MARK_ALL_STALE_USERS_PER_TASK = None
+    settings.COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_SECONDS = 0
+    settings.COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_MAX_DELAY = 600
+    settings.COMPLETION_AGGREGATOR_STALE_COURSE_SWEEP_INTERVAL = 60
+    settings.COMPLETION_AGGREGATOR_VERSIONED_CACHE_GROUPS = False
+    settings.COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS = None
+    settings.COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET = 5.0
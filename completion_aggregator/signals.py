@@ -4,16 +4,88 @@ Handlers for signals emitted by block completion models.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import logging
+import threading
+import weakref
 
 from django.conf import settings
+from django.db import transaction
 from django.db.models.signals import post_save
 
-from . import batch, compat, models
+from . import batch, compat, stale
 from .tasks import handler_tasks
 
 log = logging.getLogger(__name__)
 
 
+class StaleCompletionBuffer(threading.local):
+    """
+    Coalesce the StaleCompletions created in a transaction into a single insert.
+
+    Stale blocks are collected in a per-thread set, and passed to the stale
+    backend in one call when the current transaction commits (or
+    immediately, when no transaction is open), so that saving the same
+    completion several times in a request only marks it stale once.
+    """
+
+    def __init__(self):
+        """
+        Create an empty buffer.
+        """
+        super(StaleCompletionBuffer, self).__init__()
+        self.pending = set()
+        self._registered = None
+
+    def add(self, username, course_key, block_key):
+        """
+        Mark a block stale when the current transaction commits.
+        """
+        entry = stale.StaleEntry(username, course_key, block_key, False)
+        if self._get_registered() is not None:
+            self.pending.add(entry)
+            return
+        # Either the buffer is empty, or the transaction that buffered the
+        # pending blocks was rolled back, discarding its callback, so their
+        # completions were never saved.  The flush is registered once, and
+        # runs straight away if no transaction is open.
+        self.pending = {entry}
+        callback = _BufferFlush(self)
+        self._registered = weakref.ref(callback)
+        transaction.on_commit(callback)
+
+    def _get_registered(self):
+        """
+        Return the flush registered with the current transaction, or None.
+
+        Only a weak reference to the callback is kept, so it is gone once the
+        transaction or savepoint holding it is rolled back.
+        """
+        return self._registered() if self._registered is not None else None
+
+    def flush(self):
+        """
+        Mark all pending blocks stale.
+        """
+        self._registered = None
+        pending, self.pending = self.pending, set()
+        if pending:
+            stale.get_stale_backend().mark_stale(pending)
+
+
+class _BufferFlush(object):
+    """
+    A callback that flushes a StaleCompletionBuffer when a transaction commits.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __call__(self):
+        self.buffer.flush()
+
+
+stale_completion_buffer = StaleCompletionBuffer()
+
+
 def register():
     """
     Register signal handlers.
@@ -65,7 +137,7 @@ def item_deleted_handler(usage_key, user_id, **kwargs):
     # extracting a course_key from a usage_key, but the item_delete signal is
     # only fired from split-mongo, so it will always contain the course run.
     course_key = usage_key.course_key
-    handler_tasks.mark_all_stale.delay(course_key=course_key)
+    handler_tasks.schedule_mark_all_stale(course_key)
 
 
 def course_published_handler(course_key, **kwargs):
@@ -73,7 +145,7 @@ def course_published_handler(course_key, **kwargs):
     Update aggregators when a general course change happens.
     """
     log.debug("Updating aggregators due to course_published signal")
-    handler_tasks.mark_all_stale.delay(course_key=course_key)
+    handler_tasks.schedule_mark_all_stale(course_key)
 
 
 def cohort_updated_handler(user, course_key, **kwargs):
@@ -101,11 +173,16 @@ def completion_updated_handler(signal, sender, instance, created, raw, using, up
         instance.course_key,
         instance.block_key,
     )
-    models.StaleCompletion.objects.create(
-        username=instance.user.username,
-        course_key=instance.course_key,
-        block_key=instance.block_key
-    )
     if not getattr(settings, 'COMPLETION_AGGREGATOR_ASYNC_AGGREGATION', False):
+        # Synchronous aggregation needs the block marked stale straight away.
+        stale.get_stale_backend().mark_stale([
+            stale.StaleEntry(instance.user.username, instance.course_key, instance.block_key, False),
+        ])
         batch.perform_aggregation()
         batch.perform_cleanup()
+    elif getattr(settings, 'COMPLETION_AGGREGATOR_COALESCE_STALE_COMPLETIONS', False):
+        stale_completion_buffer.add(instance.user.username, instance.course_key, instance.block_key)
+    else:
+        stale.get_stale_backend().mark_stale([
+            stale.StaleEntry(instance.user.username, instance.course_key, instance.block_key, False),
+        ])
@@ -0,0 +1,884 @@
+"""
+Backends that track the enrollments whose aggregators need updating.
+
+When blocks are completed, or a course changes, the affected enrollments
+are marked stale.  The aggregator service later collects the stale work and
+enqueues updates, and the update tasks resolve the work they have done.
+
+The backend is configured with the COMPLETION_AGGREGATOR_STALE_BACKEND
+setting, which names a `StaleBackend` subclass.  By default, stale work is
+stored in the StaleCompletion table, with a row per stale block.
+EnrollmentStaleBackend keeps a single row per stale enrollment instead.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import json
+import logging
+import time
+from datetime import datetime
+
+import pytz
+import six
+from opaque_keys.edx.keys import CourseKey, UsageKey
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import models, utils
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STALE_BACKEND = 'completion_aggregator.stale.TableStaleBackend'
+
+EPOCH = pytz.utc.localize(datetime(1970, 1, 1))
+
+# When more blocks than this are stale in an enrollment, its update task
+# updates the whole course.
+MAX_KEYS_PER_TASK = 16
+
+# A block that has been marked stale.  `block_key` is None if the whole
+# course is stale.
+StaleEntry = collections.namedtuple('StaleEntry', ['username', 'course_key', 'block_key', 'force'])
+
+# The stale work collected for an enrollment.  `block_keys` is a
+# BagOfHolding if the whole course needs updating.
+StaleWork = collections.namedtuple('StaleWork', ['username', 'course_key', 'block_keys', 'force'])
+
+_backends = {}
+
+
+def get_stale_backend():
+    """
+    Return an instance of the configured stale backend.
+    """
+    path = getattr(settings, 'COMPLETION_AGGREGATOR_STALE_BACKEND', DEFAULT_STALE_BACKEND)
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def make_stale_work(username, course_key, block_keys, force, max_keys):
+    """
+    Return the StaleWork for an enrollment.
+
+    If more than `max_keys` blocks are stale, the whole course is updated.
+    """
+    if isinstance(block_keys, utils.BagOfHolding) or len(block_keys) > max_keys:
+        block_keys = utils.BagOfHolding()
+    return StaleWork(username=username, course_key=course_key, block_keys=block_keys, force=force)
+
+
+class StaleBackend(object):
+    """
+    Interface for tracking stale work.
+    """
+
+    # True if collecting work removes it, rather than it being kept until
+    # it is resolved.
+    REMOVES_COLLECTED_WORK = False
+
+    def mark_stale(self, entries):
+        """
+        Record the given StaleEntry tuples.
+        """
+        raise NotImplementedError
+
+    def get_stale_work(self, batch_size, limit, max_keys):
+        """
+        Return the outstanding work as a list of StaleWork tuples, one per enrollment.
+
+        batch_size (int):
+            The amount of stale work to fetch from storage at a time.
+        limit (int|None):
+            The approximate maximum amount of stale work to collect.  None
+            means collect all outstanding work.
+        max_keys (int):
+            If more than this many blocks are stale in an enrollment, the
+            whole course is updated instead.
+        """
+        raise NotImplementedError
+
+    def iter_stale_work(self, batch_size, limit, max_keys):
+        """
+        Yield the outstanding work as StaleWork tuples.
+
+        Takes the same arguments as `get_stale_work`.  Backends that can
+        collect work incrementally override this, so that callers can start
+        acting on work before it has all been collected.
+        """
+        return iter(self.get_stale_work(batch_size, limit, max_keys))
+
+    def requeue(self, stale_work):
+        """
+        Return collected StaleWork that was not acted on, to be collected again.
+
+        Backends that keep work until it is resolved have nothing to do.
+        """
+
+    def resolve(self, username, course_key, block_keys=None, before=None):
+        """
+        Resolve the stale work for an enrollment that has been done.
+
+        If `block_keys` is given, only work for those blocks is resolved.
+        If `before` is given, only work marked stale before that time is
+        resolved.
+        """
+        raise NotImplementedError
+
+    def resolve_many(self, usernames, course_key, before=None):
+        """
+        Resolve all stale work for several enrollments in a course.
+        """
+        for username in usernames:
+            self.resolve(username, course_key, before=before)
+
+    def discard(self, usernames, course_key=None):
+        """
+        Drop all stale work for the given users, which cannot be done.
+
+        If `course_key` is None, work in all courses is dropped.
+        """
+        raise NotImplementedError
+
+    def is_stale(self, username, course_key):
+        """
+        Return True if the enrollment has outstanding stale work.
+        """
+        raise NotImplementedError
+
+    def is_stale_many(self, enrollments):
+        """
+        Return the set of the given (username, course_key) pairs that have outstanding stale work.
+        """
+        return {(username, course_key) for username, course_key in enrollments if self.is_stale(username, course_key)}
+
+    def cleanup(self):
+        """
+        Remove records of resolved work.
+        """
+        raise NotImplementedError
+
+
+class TableStaleBackend(StaleBackend):
+    """
+    Track stale work in the StaleCompletion table.
+
+    Each stale block gets a row, which is marked resolved by the update that
+    handles it, and later deleted by `cleanup`.
+    """
+
+    ENROLLMENTS_PER_FLUSH = 1000
+
+    def mark_stale(self, entries):
+        """
+        Insert a StaleCompletion for each entry.
+
+        If COMPLETION_AGGREGATOR_DEDUPE_STALE_COMPLETIONS is set, blocks that
+        already have an unresolved StaleCompletion are not inserted again.
+        Instead, the existing row's `modified` time is bumped, so that it is
+        not resolved by an update that started before this call, and may
+        not have seen the new completion.  The existing rows are locked
+        until the current transaction ends, so an update cannot resolve them
+        between the lookup and the bump.
+        """
+        entries = set(entries)
+        if not entries:
+            return
+        if getattr(settings, 'COMPLETION_AGGREGATOR_DEDUPE_STALE_COMPLETIONS', False):
+            blocks = [entry for entry in entries if entry.block_key and not entry.force]
+            if blocks:
+                with transaction.atomic():
+                    existing = {
+                        (username, course_key, block_key): row_id
+                        for row_id, username, course_key, block_key in models.StaleCompletion.objects.filter(
+                            resolved=False,
+                            username__in={entry.username for entry in blocks},
+                            course_key__in={entry.course_key for entry in blocks},
+                            block_key__in={entry.block_key for entry in blocks},
+                        ).select_for_update().values_list('id', 'username', 'course_key', 'block_key')
+                    }
+                    bumped = {
+                        entry for entry in blocks if (entry.username, entry.course_key, entry.block_key) in existing
+                    }
+                    if bumped:
+                        models.StaleCompletion.objects.filter(id__in=[
+                            existing[entry.username, entry.course_key, entry.block_key] for entry in bumped
+                        ]).update(modified=timezone.now())
+                entries -= bumped
+        models.StaleCompletion.objects.bulk_create(
+            [
+                models.StaleCompletion(
+                    username=entry.username,
+                    course_key=entry.course_key,
+                    block_key=entry.block_key,
+                    force=entry.force,
+                ) for entry in entries
+            ],
+            batch_size=1000,
+        )
+
+    def get_stale_work(self, batch_size, limit, max_keys):
+        """
+        Collect the unresolved StaleCompletions.
+        """
+        return list(self.iter_stale_work(batch_size, limit, max_keys))
+
+    def iter_stale_work(self, batch_size, limit, max_keys):
+        """
+        Stream the unresolved StaleCompletions, newest first.
+
+        Stale blocks are gathered for up to ENROLLMENTS_PER_FLUSH enrollments
+        before they are yielded.  Rows found later for an enrollment yielded
+        by the previous flush are left unresolved, to be collected by the next
+        run.  Only that flush's enrollments are remembered, so memory stays
+        bounded however large the backlog is.  An enrollment whose rows span
+        more than one flush may be yielded again, which only costs a
+        redundant update.
+        """
+        pending = collections.OrderedDict()
+        forced_updates = set()
+        flushed = set()
+        for rows in self._iter_stale_rows(batch_size, limit):
+            for username, course_key, block_key, force in rows:
+                enrollment = (username, course_key)
+                if enrollment in flushed:
+                    continue
+                if enrollment not in pending:
+                    pending[enrollment] = set()
+                if not block_key:
+                    pending[enrollment] = utils.BagOfHolding()
+                blocks = pending[enrollment]
+                if isinstance(blocks, utils.BagOfHolding) or len(blocks) <= max_keys:
+                    # We can stop adding once we have exceeded the maximum number
+                    # of keys per task.  This limits the size of the task
+                    # signature sent to celery.
+                    blocks.add(block_key)
+                if force:
+                    forced_updates.add(enrollment)
+            if len(pending) >= self.ENROLLMENTS_PER_FLUSH:
+                flushed = set(pending)
+                for work in self._flush(pending, forced_updates, max_keys):
+                    yield work
+        for work in self._flush(pending, forced_updates, max_keys):
+            yield work
+
+    @staticmethod
+    def _flush(pending, forced_updates, max_keys):
+        """
+        Yield and forget the pending work.
+        """
+        while pending:
+            (username, course_key), blocks = pending.popitem(last=False)
+            force = (username, course_key) in forced_updates
+            forced_updates.discard((username, course_key))
+            yield make_stale_work(username, course_key, blocks, force, max_keys)
+
+    @staticmethod
+    def _iter_stale_rows(batch_size, limit):
+        """
+        Yield pages of (username, course_key, block_key, force) tuples for unresolved StaleCompletions.
+
+        Pages are fetched newest first, using keyset pagination on
+        (resolved, id), so each query reads only the rows it returns however
+        sparse the ids are.  Iteration stops once `limit` rows have been read.
+        """
+        queryset = models.StaleCompletion.objects.filter(resolved=False).order_by('-id')
+        fetched = 0
+        last_id = None
+        while limit is None or fetched < limit:
+            page = queryset if last_id is None else queryset.filter(id__lt=last_id)
+            rows = list(page.values_list('id', 'username', 'course_key', 'block_key', 'force')[:batch_size])
+            if not rows:
+                return
+            fetched += len(rows)
+            last_id = rows[-1][0]
+            yield [row[1:] for row in rows]
+            if len(rows) < batch_size:
+                return
+
+    def resolve(self, username, course_key, block_keys=None, before=None):
+        """
+        Mark the enrollment's StaleCompletions resolved.
+        """
+        queryset = models.StaleCompletion.objects.filter(username=username, course_key=course_key)
+        if before is not None:
+            queryset = queryset.filter(modified__lt=before)
+        if block_keys:
+            queryset = queryset.filter(block_key__in=block_keys)
+        queryset.update(resolved=True)
+
+    def resolve_many(self, usernames, course_key, before=None):
+        """
+        Mark the StaleCompletions of several enrollments resolved with a single query.
+        """
+        queryset = models.StaleCompletion.objects.filter(username__in=usernames, course_key=course_key)
+        if before is not None:
+            queryset = queryset.filter(modified__lt=before)
+        queryset.update(resolved=True)
+
+    def discard(self, usernames, course_key=None):
+        """
+        Mark the users' StaleCompletions resolved.
+        """
+        queryset = models.StaleCompletion.objects.filter(username__in=usernames)
+        if course_key is not None:
+            queryset = queryset.filter(course_key=course_key)
+        queryset.update(resolved=True)
+
+    def is_stale(self, username, course_key):
+        """
+        Return True if the enrollment has unresolved StaleCompletions.
+        """
+        return models.StaleCompletion.objects.filter(
+            resolved=False,
+            username=username,
+            course_key=course_key,
+        ).exists()
+
+    def is_stale_many(self, enrollments):
+        """
+        Find the enrollments with unresolved StaleCompletions with a single query.
+        """
+        return _filter_enrollments(
+            models.StaleCompletion.objects.filter(resolved=False),
+            enrollments,
+        )
+
+    def cleanup(self):
+        """
+        Delete resolved StaleCompletions.
+        """
+        return models.StaleCompletion.objects.filter(resolved=True).delete()
+
+
+class EnrollmentStaleBackend(StaleBackend):
+    """
+    Track stale work in the StaleEnrollment table.
+
+    Each stale enrollment has a single row, holding up to MAX_KEYS_PER_TASK
+    stale blocks (past which the whole course is stale) and a force flag.
+    Writers merge new work into the existing row, so the table grows with
+    the number of stale enrollments rather than the number of completions.
+    Rows are deleted once the work they describe has been done.
+
+    Every write bumps the row's `modified` time, even if the work was
+    already recorded, so that an update that started before the write,
+    and may not have seen the new completion, does not delete the row.
+    """
+
+    ENROLLMENTS_PER_QUERY = 500
+    SEPARATOR = '\n'
+
+    def mark_stale(self, entries):
+        """
+        Merge the entries into the StaleEnrollment row of each enrollment.
+        """
+        enrollments = collections.OrderedDict()
+        for entry in entries:
+            enrollment = (entry.username, entry.course_key)
+            blocks, force = enrollments.get(enrollment, (set(), False))
+            if not entry.block_key:
+                blocks = utils.BagOfHolding()
+            elif not isinstance(blocks, utils.BagOfHolding):
+                blocks.add(six.text_type(entry.block_key))
+            enrollments[enrollment] = (blocks, force or entry.force)
+        items = list(six.iteritems(enrollments))
+        for start in six.moves.range(0, len(items), self.ENROLLMENTS_PER_QUERY):
+            self._merge(items[start:start + self.ENROLLMENTS_PER_QUERY])
+
+    def _merge(self, items, attempts=3):
+        """
+        Upsert a chunk of (enrollment, (blocks, force)) items.
+
+        Existing rows are locked while they are merged, and all of them are
+        touched, whether or not their work changed.  If another writer
+        inserts one of the new rows first, the whole chunk is merged again.
+        """
+        try:
+            with transaction.atomic():
+                existing = {
+                    (row.username, row.course_key): row
+                    for row in models.StaleEnrollment.objects.select_for_update().filter(
+                        username__in={username for (username, _), _ in items},
+                        course_key__in={course_key for (_, course_key), _ in items},
+                    )
+                }
+                new_rows = []
+                unchanged = []
+                for (username, course_key), (blocks, force) in items:
+                    row = existing.get((username, course_key))
+                    if row is None:
+                        row = models.StaleEnrollment(username=username, course_key=course_key)
+                        self._update_row(row, blocks, force)
+                        new_rows.append(row)
+                    elif self._update_row(row, blocks, force):
+                        row.save()
+                    else:
+                        unchanged.append(row.id)
+                if unchanged:
+                    models.StaleEnrollment.objects.filter(id__in=unchanged).update(modified=timezone.now())
+                models.StaleEnrollment.objects.bulk_create(new_rows)
+        except IntegrityError:
+            if attempts <= 1:
+                raise
+            self._merge(items, attempts - 1)
+
+    def _update_row(self, row, blocks, force):
+        """
+        Merge stale blocks into a StaleEnrollment.
+
+        Returns True if the row was changed.
+        """
+        changed = False
+        if force and not row.force:
+            row.force = changed = True
+        if row.all_blocks:
+            return changed
+        current = set(filter(None, row.block_keys.split(self.SEPARATOR)))
+        if isinstance(blocks, utils.BagOfHolding) or len(current | blocks) > MAX_KEYS_PER_TASK:
+            row.all_blocks = True
+            row.block_keys = ''
+            return True
+        if not blocks <= current:
+            row.block_keys = self.SEPARATOR.join(sorted(current | blocks))
+            changed = True
+        return changed
+
+    def iter_stale_work(self, batch_size, limit, max_keys):
+        """
+        Stream the StaleEnrollments, oldest first.
+        """
+        queryset = models.StaleEnrollment.objects.order_by('id')
+        fetched = 0
+        last_id = None
+        while limit is None or fetched < limit:
+            page = queryset if last_id is None else queryset.filter(id__gt=last_id)
+            rows = list(page.values_list(
+                'id', 'username', 'course_key', 'block_keys', 'all_blocks', 'force',
+            )[:batch_size])
+            for _, username, course_key, block_keys, all_blocks, force in rows:
+                if all_blocks:
+                    blocks = utils.BagOfHolding()
+                else:
+                    blocks = {UsageKey.from_string(key) for key in block_keys.split(self.SEPARATOR) if key}
+                yield make_stale_work(username, course_key, blocks, force, max_keys)
+            fetched += len(rows)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def get_stale_work(self, batch_size, limit, max_keys):
+        """
+        Collect the StaleEnrollments.
+        """
+        return list(self.iter_stale_work(batch_size, limit, max_keys))
+
+    def resolve(self, username, course_key, block_keys=None, before=None):
+        """
+        Delete the enrollment's StaleEnrollment if the work it describes has been done.
+
+        If only some blocks were updated, a row with other stale blocks is
+        left for the next run.
+        """
+        queryset = models.StaleEnrollment.objects.filter(username=username, course_key=course_key)
+        if before is not None:
+            queryset = queryset.filter(modified__lt=before)
+        if block_keys:
+            block_keys = {six.text_type(block_key) for block_key in block_keys}
+            try:
+                row = queryset.get()
+            except models.StaleEnrollment.DoesNotExist:
+                return
+            if row.all_blocks or not set(filter(None, row.block_keys.split(self.SEPARATOR))) <= block_keys:
+                return
+            # Only delete the row if no more work has been merged into it.
+            queryset = queryset.filter(id=row.id, modified=row.modified)
+        queryset.delete()
+
+    def resolve_many(self, usernames, course_key, before=None):
+        """
+        Delete the StaleEnrollments of several enrollments with a single query.
+        """
+        queryset = models.StaleEnrollment.objects.filter(username__in=usernames, course_key=course_key)
+        if before is not None:
+            queryset = queryset.filter(modified__lt=before)
+        queryset.delete()
+
+    def discard(self, usernames, course_key=None):
+        """
+        Delete the users' StaleEnrollments.
+        """
+        queryset = models.StaleEnrollment.objects.filter(username__in=usernames)
+        if course_key is not None:
+            queryset = queryset.filter(course_key=course_key)
+        queryset.delete()
+
+    def is_stale(self, username, course_key):
+        """
+        Return True if the enrollment has a StaleEnrollment.
+        """
+        return models.StaleEnrollment.objects.filter(username=username, course_key=course_key).exists()
+
+    def is_stale_many(self, enrollments):
+        """
+        Find the enrollments with StaleEnrollments with a single query.
+        """
+        return _filter_enrollments(models.StaleEnrollment.objects.all(), enrollments)
+
+    def cleanup(self):
+        """
+        Do nothing, as rows are deleted when their work is done.
+        """
+
+
+class RedisStaleBackend(StaleBackend):
+    """
+    Track stale work in redis.
+
+    Each stale enrollment is a member of a sorted set, scored by the time it
+    first became stale, so an enrollment is only queued once however many
+    of its blocks change.  Its stale blocks are the fields of a hash, along
+    with markers for whole-course and forced updates.
+
+    Collecting an enrollment moves it atomically from the queue to a set of
+    enrollments being processed, where it is leased for
+    COMPLETION_AGGREGATOR_STALE_REDIS_LEASE seconds.  The enrollment is still
+    stale while it is processed, and its lease is released when the update
+    task resolves it.  If the task is lost, the lease expires, and the work
+    is returned to the queue the next time work is collected.
+
+    Each user's enrollments are also indexed in a set, so that a user's
+    work can be discarded without scanning the queue.
+
+    The redis server is configured with COMPLETION_AGGREGATOR_STALE_REDIS_URL.
+    """
+
+    ALL_BLOCKS = '*'
+    FORCE = '!force'
+    # Markers in the hash of a leased enrollment, holding the time the lease
+    # was taken, and the score the enrollment had in the queue.
+    LEASED = '!leased'
+    QUEUED = '!queued'
+    DEFAULT_LEASE = 3600
+    # Collected work is not collected again, even though it is kept until it
+    # is resolved.
+    REMOVES_COLLECTED_WORK = True
+
+    def __init__(self, client=None, prefix=None):
+        """
+        Connect to redis, unless a client is provided.
+        """
+        if client is None:
+            if redis is None:
+                raise ImproperlyConfigured("RedisStaleBackend requires the redis package.")
+            client = redis.StrictRedis.from_url(settings.COMPLETION_AGGREGATOR_STALE_REDIS_URL)
+        self.client = client
+        self.prefix = prefix or getattr(
+            settings,
+            'COMPLETION_AGGREGATOR_STALE_REDIS_PREFIX',
+            'completion_aggregator:stale',
+        )
+        self.lease = getattr(settings, 'COMPLETION_AGGREGATOR_STALE_REDIS_LEASE', self.DEFAULT_LEASE)
+        self.queue_key = '{}:queue'.format(self.prefix)
+        self.processing_key = '{}:processing'.format(self.prefix)
+
+    @staticmethod
+    def _member(username, course_key):
+        """
+        Return the sorted set member for an enrollment.
+        """
+        return json.dumps([username, six.text_type(course_key)])
+
+    def _blocks_key(self, member):
+        """
+        Return the key of the hash of stale blocks for a queued enrollment.
+        """
+        return '{}:blocks:{}'.format(self.prefix, member)
+
+    def _leased_key(self, member):
+        """
+        Return the key of the hash of stale blocks for a leased enrollment.
+        """
+        return '{}:leased:{}'.format(self.prefix, member)
+
+    def _user_key(self, username):
+        """
+        Return the key of the set of a user's stale enrollments.
+        """
+        return '{}:user:{}'.format(self.prefix, username)
+
+    def mark_stale(self, entries):
+        """
+        Queue each entry's enrollment, and add its block to the enrollment's hash.
+        """
+        now = time.time()
+        pipe = self.client.pipeline()
+        for entry in entries:
+            member = self._member(entry.username, entry.course_key)
+            pipe.zadd(self.queue_key, {member: now}, nx=True)
+            field = six.text_type(entry.block_key) if entry.block_key else self.ALL_BLOCKS
+            pipe.hset(self._blocks_key(member), field, 1)
+            if entry.force:
+                pipe.hset(self._blocks_key(member), self.FORCE, 1)
+            pipe.sadd(self._user_key(entry.username), member)
+        pipe.execute()
+
+    def get_stale_work(self, batch_size, limit, max_keys):
+        """
+        Lease the enrollments that have been stale longest.
+        """
+        return list(self.iter_stale_work(batch_size, limit, max_keys))
+
+    def iter_stale_work(self, batch_size, limit, max_keys):
+        """
+        Lease the enrollments that have been stale longest, a batch at a time.
+
+        Enrollments whose leases have expired are queued again first.
+        """
+        self.requeue_expired()
+        leased = 0
+        while limit is None or leased < limit:
+            count = batch_size if limit is None else min(batch_size, limit - leased)
+            members = [_text(member) for member in self.client.zrange(self.queue_key, 0, count - 1)]
+            if not members:
+                break
+            for member, fields in self._take_leases(members):
+                leased += 1
+                yield self._make_work(member, fields, max_keys)
+
+    def _take_leases(self, members):
+        """
+        Move queued enrollments to the processing set, and return their (member, fields) pairs.
+
+        An enrollment that is already leased, because it was marked stale
+        again while it was processed, keeps its leased blocks, so that the
+        new lease covers the work of both.  Enrollments collected by another
+        process in the meantime are skipped.
+        """
+        watches = [self._blocks_key(member) for member in members] + [self._leased_key(member) for member in members]
+
+        def take_leases(pipe):
+            reads = self.client.pipeline(transaction=False)
+            for member in members:
+                reads.zscore(self.queue_key, member)
+                reads.hgetall(self._blocks_key(member))
+                reads.hgetall(self._leased_key(member))
+            results = reads.execute()
+            now = time.time()
+            leases = []
+            pipe.multi()
+            for index, member in enumerate(members):
+                score, fields, leased_fields = results[3 * index:3 * index + 3]
+                if score is None:
+                    continue
+                fields = {_text(field) for field in fields}
+                leased_fields = {_text(field): _text(value) for field, value in leased_fields.items()}
+                if self.QUEUED in leased_fields:
+                    score = min(score, float(leased_fields.pop(self.QUEUED)))
+                leased_fields.pop(self.LEASED, None)
+                fields.update(leased_fields)
+                pipe.zrem(self.queue_key, member)
+                pipe.delete(self._blocks_key(member))
+                pipe.zadd(self.processing_key, {member: now + self.lease})
+                for field in fields:
+                    pipe.hset(self._leased_key(member), field, 1)
+                pipe.hset(self._leased_key(member), self.LEASED, now)
+                pipe.hset(self._leased_key(member), self.QUEUED, score)
+                leases.append((member, fields))
+            return leases
+
+        return self.client.transaction(take_leases, *watches, value_from_callable=True)
+
+    def requeue_expired(self):
+        """
+        Return the work of enrollments whose leases have expired to the queue.
+
+        Leases expire when their update tasks are lost, or take longer than
+        the lease to run.  The work keeps its original place in the queue.
+        """
+        expired = [_text(member) for member in self.client.zrangebyscore(self.processing_key, '-inf', time.time())]
+        for member in expired:
+            if self._release_lease(member, expired_only=True):
+                log.warning("The lease on stale work for %s expired.  Queueing it again.", member)
+
+    def requeue(self, stale_work):
+        """
+        Return the leased work to the queue, in the place it had before it was collected.
+        """
+        for work in stale_work:
+            self._release_lease(self._member(work.username, work.course_key))
+
+    def _release_lease(self, member, expired_only=False):
+        """
+        Move a leased enrollment back to the queue with its original score, and return True if it was leased.
+
+        If the enrollment was marked stale again while it was leased, it
+        keeps the earlier of the two scores.
+        """
+
+        def requeue(pipe):
+            expiry = pipe.zscore(self.processing_key, member)
+            if expiry is None or (expired_only and expiry > time.time()):
+                return False
+            fields = {_text(field): _text(value) for field, value in pipe.hgetall(self._leased_key(member)).items()}
+            score = float(fields.pop(self.QUEUED, time.time()))
+            queued = pipe.zscore(self.queue_key, member)
+            if queued is not None:
+                score = min(score, queued)
+            fields.pop(self.LEASED, None)
+            pipe.multi()
+            pipe.zrem(self.processing_key, member)
+            pipe.delete(self._leased_key(member))
+            pipe.zadd(self.queue_key, {member: score})
+            for field in fields or [self.ALL_BLOCKS]:
+                pipe.hset(self._blocks_key(member), field, 1)
+            return True
+
+        return self.client.transaction(
+            requeue,
+            self._leased_key(member),
+            self._blocks_key(member),
+            value_from_callable=True,
+        )
+
+    def _make_work(self, member, fields, max_keys):
+        """
+        Return the StaleWork for a leased enrollment.
+        """
+        username, course_key = json.loads(member)
+        fields = set(fields)
+        force = self.FORCE in fields
+        fields.discard(self.FORCE)
+        if self.ALL_BLOCKS in fields:
+            block_keys = utils.BagOfHolding()
+        else:
+            block_keys = {UsageKey.from_string(field) for field in fields}
+        return make_stale_work(username, CourseKey.from_string(course_key), block_keys, force, max_keys)
+
+    def resolve(self, username, course_key, block_keys=None, before=None):
+        """
+        Release the enrollment's lease, if the update covered the leased work.
+
+        The lease is kept if it was taken at or after `before`, as the work
+        may have been collected again after the update started, or if
+        `block_keys` does not include all of the leased blocks.
+        """
+        member = self._member(username, course_key)
+        if before is not None:
+            before = (before - EPOCH).total_seconds()
+        resolved_fields = {six.text_type(block_key) for block_key in block_keys} if block_keys else None
+
+        def release(pipe):
+            fields = {_text(field): _text(value) for field, value in pipe.hgetall(self._leased_key(member)).items()}
+            if not fields:
+                return
+            if before is not None and float(fields.pop(self.LEASED, 0)) >= before:
+                return
+            fields.pop(self.LEASED, None)
+            fields.pop(self.QUEUED, None)
+            fields.pop(self.FORCE, None)
+            if resolved_fields is not None and not set(fields) <= resolved_fields:
+                return
+            queued = pipe.zscore(self.queue_key, member) is not None
+            pipe.multi()
+            pipe.zrem(self.processing_key, member)
+            pipe.delete(self._leased_key(member))
+            if not queued:
+                pipe.srem(self._user_key(username), member)
+
+        self.client.transaction(release, self._leased_key(member), self._blocks_key(member))
+
+    def discard(self, usernames, course_key=None):
+        """
+        Remove the users' queued and leased enrollments.
+        """
+        usernames = list(usernames)
+        if course_key is not None:
+            members = {username: [self._member(username, course_key)] for username in usernames}
+        else:
+            pipe = self.client.pipeline(transaction=False)
+            for username in usernames:
+                pipe.smembers(self._user_key(username))
+            members = {
+                username: [_text(member) for member in user_members]
+                for username, user_members in zip(usernames, pipe.execute())
+            }
+        if not any(six.itervalues(members)):
+            return
+        pipe = self.client.pipeline(transaction=True)
+        for username, user_members in six.iteritems(members):
+            for member in user_members:
+                pipe.zrem(self.queue_key, member)
+                pipe.zrem(self.processing_key, member)
+                pipe.delete(self._blocks_key(member), self._leased_key(member))
+                pipe.srem(self._user_key(username), member)
+        pipe.execute()
+
+    def is_stale(self, username, course_key):
+        """
+        Return True if the enrollment is queued or leased.
+        """
+        return bool(self.is_stale_many([(username, course_key)]))
+
+    def is_stale_many(self, enrollments):
+        """
+        Find the queued and leased enrollments with a single round trip to redis.
+        """
+        enrollments = list(enrollments)
+        pipe = self.client.pipeline(transaction=False)
+        for username, course_key in enrollments:
+            member = self._member(username, course_key)
+            pipe.zscore(self.queue_key, member)
+            pipe.zscore(self.processing_key, member)
+        scores = pipe.execute()
+        return {
+            enrollment for index, enrollment in enumerate(enrollments)
+            if scores[2 * index] is not None or scores[2 * index + 1] is not None
+        }
+
+    def cleanup(self):
+        """
+        Do nothing, as work is removed when it is resolved.
+        """
+
+
+def _filter_enrollments(queryset, enrollments):
+    """
+    Return the set of the given (username, course_key) pairs that have rows in the queryset.
+
+    All the users and courses are queried together, so the query can match
+    pairs that were not asked about; those are discarded.
+    """
+    enrollments = set(enrollments)
+    if not enrollments:
+        return set()
+    found = set(
+        (username, six.text_type(course_key))
+        for username, course_key in queryset.filter(
+            username__in={username for username, _ in enrollments},
+            course_key__in={course_key for _, course_key in enrollments},
+        ).values_list('username', 'course_key').distinct()
+    )
+    return {
+        (username, course_key) for username, course_key in enrollments
+        if (username, six.text_type(course_key)) in found
+    }
+
+
+def _text(value):
+    """
+    Decode a value returned by redis.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
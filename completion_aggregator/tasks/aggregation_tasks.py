@@ -14,8 +14,7 @@ from opaque_keys.edx.keys import CourseKey, UsageKey
 from django.contrib.auth.models import User
 from django.db import connection
 
-from .. import core
-from ..models import StaleCompletion
+from .. import core, stale
 
 try:
     from progress.models import CourseModuleCompletion
@@ -75,7 +74,7 @@ def update_aggregators(username, course_key, block_keys=(), force=False):
         user = User.objects.get(username=username)
     except User.DoesNotExist:
         log.warning("User %s does not exist.  Marking stale completions resolved.", username)
-        StaleCompletion.objects.filter(username=username).update(resolved=True)
+        stale.get_stale_backend().discard([username])
         return
 
     course_key = CourseKey.from_string(course_key)
@@ -84,6 +83,51 @@ def update_aggregators(username, course_key, block_keys=(), force=False):
     return core.update_aggregators(user, course_key, block_keys, force)
 
 
+@shared_task(task=LoggedTask)
+def update_aggregators_in_bulk(course_key, enrollments):
+    """
+    Update aggregators for many enrollments in a single course.
+
+    Parameters
+    ----------
+        course_key (str):
+            The course in which the aggregators need updating.
+        enrollments (list[dict]):
+            The enrollments whose aggregators need updating.  Each is a dict
+            with the following keys:
+
+            * username (str): The user whose aggregators need updating.
+            * block_keys (list[str]): A list of completable blocks that have
+              changed.  If empty, the whole course is updated.
+            * force (bool): If True, update aggregators even if they are
+              up-to-date.
+
+    The course structure is handled once for the whole batch, and the
+    aggregators of all the enrollments are loaded and saved in bulk.
+    """
+    course_key = CourseKey.from_string(course_key)
+    users = {
+        user.username: user for user in User.objects.filter(
+            username__in=[enrollment['username'] for enrollment in enrollments]
+        )
+    }
+    missing = set(enrollment['username'] for enrollment in enrollments) - set(users)
+    if missing:
+        log.warning("Users %s do not exist.  Marking stale completions resolved.", sorted(missing))
+        stale.get_stale_backend().discard(missing)
+
+    core_enrollments = []
+    for enrollment in enrollments:
+        if enrollment['username'] in missing:
+            continue
+        block_keys = set(
+            UsageKey.from_string(key).map_into_course(course_key) for key in enrollment.get('block_keys', ())
+        )
+        core_enrollments.append((users[enrollment['username']], block_keys, enrollment.get('force', False)))
+    log.info("Updating aggregators in %s for %s enrollments.", course_key, len(core_enrollments))
+    return core.update_aggregators_in_bulk(course_key, core_enrollments)
+
+
 @shared_task
 def migrate_batch(start, stop):  # Cannot pass a queryset to a task.
     """
@@ -127,18 +171,16 @@ def migrate_batch(start, stop):  # Cannot pass a queryset to a task.
     with connection.cursor() as cur:
         cur.executemany(sql, insert_params)
     # Create aggregators later.
-    stale_completions = []
+    stale_entries = []
     for course_key in processed:
         for user in processed[course_key]:
-            stale_completions.append(
-                StaleCompletion(
+            stale_entries.append(
+                stale.StaleEntry(
                     username=user.username,
                     course_key=course_key,
                     block_key=None,
                     force=True
                 )
             )
-    StaleCompletion.objects.bulk_create(
-        stale_completions,
-    )
+    stale.get_stale_backend().mark_stale(stale_entries)
     log.info("Completed progress migration batch from %s to %s", start, stop)
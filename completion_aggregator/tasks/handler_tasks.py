@@ -2,27 +2,158 @@
 Tasks used in processing signal handlers.
 """
 
+from datetime import timedelta
+
 import six
 from celery import shared_task
 from celery_utils.logged_task import LoggedTask
+from opaque_keys.edx.keys import CourseKey
 
 from django.conf import settings
+from django.utils import timezone
 
+from .. import stale
 from ..batch import perform_aggregation
 from ..cachegroup import CacheGroup
-from ..models import StaleCompletion
-from ..utils import get_active_users
+from ..models import PendingStaleCourse
+from ..utils import iter_active_user_chunks
+
+DEFAULT_MARK_ALL_STALE_CHUNK_SIZE = 1000
+DEFAULT_STALE_COURSE_DEBOUNCE_MAX_DELAY = 600
+DEFAULT_STALE_COURSE_SWEEP_INTERVAL = 60
 
 
 @shared_task(task=LoggedTask)
-def mark_all_stale(course_key, users=None):
+def mark_all_stale(course_key, users=None, user_id_range=None):
     """
     Mark the specified enrollments as stale for all blocks.
+
+    If `users` is not given, all users with aggregators in the course are
+    marked stale, a chunk at a time.  If
+    COMPLETION_AGGREGATOR_MARK_ALL_STALE_USERS_PER_TASK is set, the users
+    are instead split into ranges of user ids of that size, and each range
+    is marked stale by a separate task.
+
+    user_id_range ((int, int)|None):
+        Only mark users with ids in this inclusive range stale.  Used by the
+        subtasks.
     """
-    users = users or get_active_users(course_key)
-    stale_objects = [StaleCompletion(username=user.username, course_key=course_key, force=True) for user in users]
-    StaleCompletion.objects.bulk_create(stale_objects, batch_size=1000)
-    CacheGroup().delete_group(six.text_type(course_key))
+    if users:
+        _mark_users_stale(course_key, [user.username for user in users])
+    else:
+        users_per_task = getattr(settings, 'COMPLETION_AGGREGATOR_MARK_ALL_STALE_USERS_PER_TASK', None)
+        if users_per_task and user_id_range is None:
+            for chunk in iter_active_user_chunks(course_key, users_per_task, fields=('id',)):
+                mark_all_stale.delay(course_key=course_key, user_id_range=(chunk[0][0], chunk[-1][0]))
+            CacheGroup().delete_group(six.text_type(course_key))
+            return
+        chunk_size = getattr(
+            settings,
+            'COMPLETION_AGGREGATOR_MARK_ALL_STALE_CHUNK_SIZE',
+            DEFAULT_MARK_ALL_STALE_CHUNK_SIZE,
+        )
+        for chunk in iter_active_user_chunks(course_key, chunk_size, fields=('username',), user_id_range=user_id_range):
+            _mark_users_stale(course_key, [username for (username,) in chunk])
+    if user_id_range is None:
+        CacheGroup().delete_group(six.text_type(course_key))
 
     if not getattr(settings, 'COMPLETION_AGGREGATOR_ASYNC_AGGREGATION', False):
         perform_aggregation()
+
+
+def _mark_users_stale(course_key, usernames):
+    """
+    Mark all blocks stale for the given users in a course.
+    """
+    stale.get_stale_backend().mark_stale([
+        stale.StaleEntry(username=username, course_key=course_key, block_key=None, force=True)
+        for username in usernames
+    ])
+
+
+def schedule_mark_all_stale(course_key):
+    """
+    Mark all enrollments in the course stale, once changes to the course have settled.
+
+    If COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_SECONDS is set, the
+    course is recorded as a PendingStaleCourse, and marked stale once that
+    many seconds pass without it being scheduled again, or at most
+    COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_MAX_DELAY seconds after it
+    was first scheduled.  Otherwise, it is marked stale straight away.
+    """
+    window = getattr(settings, 'COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_SECONDS', 0)
+    if not window:
+        mark_all_stale.delay(course_key=course_key)
+        return
+    max_delay = getattr(
+        settings,
+        'COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_MAX_DELAY',
+        DEFAULT_STALE_COURSE_DEBOUNCE_MAX_DELAY,
+    )
+    now = timezone.now()
+    pending, created = PendingStaleCourse.objects.get_or_create(
+        course_key=course_key,
+        defaults={'requested': now, 'run_at': now + timedelta(seconds=window)},
+    )
+    if created:
+        mark_pending_course_stale.apply_async(kwargs={'course_key': six.text_type(course_key)}, countdown=window)
+        return
+    run_at = min(now + timedelta(seconds=window), pending.requested + timedelta(seconds=max_delay))
+    if not PendingStaleCourse.objects.filter(id=pending.id).update(run_at=run_at):
+        # The pending course was marked stale since it was read.  Schedule it again.
+        schedule_mark_all_stale(course_key)
+
+
+@shared_task(task=LoggedTask)
+def mark_pending_course_stale(course_key):
+    """
+    Mark all enrollments in a PendingStaleCourse stale, if it is due.
+
+    If it has been postponed, check again when it is next due.
+    """
+    course_key = CourseKey.from_string(course_key)
+    now = timezone.now()
+    due = PendingStaleCourse.objects.filter(course_key=course_key, run_at__lte=now).first()
+    # Deleting the row claims it, so the course is only marked stale once,
+    # without holding a lock while it is marked.  Publishes made meanwhile
+    # record the course again.
+    if due is not None and PendingStaleCourse.objects.filter(id=due.id, run_at=due.run_at).delete()[0]:
+        try:
+            mark_all_stale(course_key)
+        except Exception:
+            # Put the course back, so it is tried again by `mark_due_courses_stale`.
+            PendingStaleCourse.objects.get_or_create(
+                course_key=course_key,
+                defaults={'requested': due.requested, 'run_at': due.run_at},
+            )
+            raise
+        return
+    pending = PendingStaleCourse.objects.filter(course_key=course_key).first()
+    if pending is not None:
+        mark_pending_course_stale.apply_async(
+            kwargs={'course_key': six.text_type(course_key)},
+            countdown=max((pending.run_at - now).total_seconds(), 0),
+        )
+
+
+def mark_due_courses_stale():
+    """
+    Enqueue the PendingStaleCourses that are overdue.
+
+    Normally, each is handled by the task scheduled when it was recorded.
+    This catches those whose task was lost, such as by a worker restart, or
+    whose marking failed.  Only courses that have been due for
+    COMPLETION_AGGREGATOR_STALE_COURSE_SWEEP_INTERVAL seconds are enqueued,
+    and their `run_at` is moved to now, so each is enqueued at most once per
+    interval while its task waits to run.
+    """
+    interval = getattr(
+        settings,
+        'COMPLETION_AGGREGATOR_STALE_COURSE_SWEEP_INTERVAL',
+        DEFAULT_STALE_COURSE_SWEEP_INTERVAL,
+    )
+    now = timezone.now()
+    overdue = PendingStaleCourse.objects.filter(run_at__lte=now - timedelta(seconds=interval))
+    for pending_id, course_key, run_at in overdue.values_list('id', 'course_key', 'run_at'):
+        if PendingStaleCourse.objects.filter(id=pending_id, run_at=run_at).update(run_at=now):
+            mark_pending_course_stale.delay(course_key=six.text_type(course_key))
@@ -1,6 +1,13 @@
 """
 Various utility functionality.
 """
+import threading
+from collections import OrderedDict
+
+import xblock.plugin
+from xblock.completable import XBlockCompletionMode
+from xblock.core import XBlock
+
 import django
 from django.contrib.auth import get_user_model
 from django.utils import timezone
@@ -30,6 +37,63 @@ class BagOfHolding(object):
         pass
 
 
+class CompletionModeRegistry(object):
+    """
+    A bounded, process-wide cache of the completion mode of each block type.
+
+    Resolving a block type to its XBlock class is an entry point lookup, which
+    is too slow to repeat for every block in a course.  Block types that are
+    not registered as XBlocks are treated as EXCLUDED.
+
+    The cache is invalidated automatically whenever the XBlock plugin cache
+    is replaced (as `XBlock.register_temp_plugin` does), and can be
+    invalidated explicitly by calling `invalidate()`.
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        Create an empty registry holding at most `maxsize` block types.
+        """
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._modes = OrderedDict()
+        self._plugin_cache = xblock.plugin.PLUGIN_CACHE
+
+    def get(self, block_type):
+        """
+        Return the completion mode of the given block type.
+        """
+        if self._plugin_cache is not xblock.plugin.PLUGIN_CACHE:
+            self.invalidate()
+        try:
+            return self._modes[block_type]
+        except KeyError:
+            pass
+        try:
+            mode = XBlockCompletionMode.get_mode(XBlock.load_class(block_type))
+        except xblock.plugin.PluginMissingError:
+            # Do not count blocks that aren't registered
+            mode = XBlockCompletionMode.EXCLUDED
+        with self._lock:
+            while len(self._modes) >= self.maxsize:
+                self._modes.popitem(last=False)
+            self._modes[block_type] = mode
+        return mode
+
+    def invalidate(self):
+        """
+        Forget all cached completion modes.
+
+        Call this after XBlock plugins have been added, removed, or reloaded.
+        """
+        with self._lock:
+            self._modes = OrderedDict()
+            self._plugin_cache = xblock.plugin.PLUGIN_CACHE
+
+
+completion_modes = CompletionModeRegistry()  # pylint: disable=invalid-name
+
+
 def get_active_users(course_key):
     """
     Return a list of users that have Aggregators in the course.
@@ -37,6 +101,34 @@ def get_active_users(course_key):
     return get_user_model().objects.filter(aggregator__course_key=course_key).distinct()
 
 
+def iter_active_user_chunks(course_key, chunk_size, fields=('id', 'username'), user_id_range=None):
+    """
+    Yield lists of tuples of `fields` for the users that have Aggregators in the course.
+
+    Users are read in order of id, `chunk_size` at a time, using keyset
+    pagination on the user id, so that the users of large courses are never
+    all held in memory.  The user id is always fetched, to paginate on,
+    but is only included in the tuples if it is one of the `fields`.
+
+    If `user_id_range` is given, only users with ids within that inclusive
+    (first, last) range are included.
+    """
+    queryset = get_user_model().objects.filter(aggregator__course_key=course_key)
+    if user_id_range is not None:
+        queryset = queryset.filter(id__gte=user_id_range[0], id__lte=user_id_range[1])
+    queryset = queryset.order_by('id').distinct()
+    last_id = None
+    while True:
+        page = queryset if last_id is None else queryset.filter(id__gt=last_id)
+        rows = list(page.values_list('id', *fields)[:chunk_size])
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[1:] for row in rows]
+        if len(rows) < chunk_size:
+            return
+
+
 def make_datetime_timezone_unaware(date):
     """
     Return a timezone unaware(localize) version of the datetime instance.
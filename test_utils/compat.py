@@ -8,6 +8,8 @@ import collections
 
 from mock import MagicMock
 
+from django.db.models import CharField, ExpressionWrapper, F
+
 from completion.models import BlockCompletion
 
 from .test_app.models import CohortMembership, CourseAccessRole, CourseEnrollment, CourseUserGroup
@@ -19,8 +21,9 @@ class StubCompat(object):
     replaced with local elements.
     """
 
-    def __init__(self, blocks):
+    def __init__(self, blocks, course_version=None):
         self.blocks = blocks
+        self.course_version = course_version
 
     def init_course_block_key(self, modulestore, course_key):  # pylint: disable=unused-argument
         """
@@ -45,6 +48,16 @@ class StubCompat(object):
             *(block for block in self.blocks if block.block_id.split('-')[:len(root_segments)] == root_segments)
         )
 
+    def get_course_structure_signature(self, modulestore, user, course_key):  # pylint: disable=unused-argument
+        """
+        Return a structure signature shared by all users.
+
+        Course structures are only shared if a course version was provided.
+        """
+        if self.course_version is None:
+            return None
+        return (self.course_version, ())
+
     def get_block_aggregators(self, course_blocks, block):
         """
         Returns a list of aggregator blocks that contain the specified block.
@@ -58,6 +71,17 @@ class StubCompat(object):
         """
         return BlockCompletion.objects.filter(user=user, course_key=course_key)
 
+    def get_block_completion_values(self, user_ids, course_key, block_keys=None):
+        """
+        Return (user_id, block_key, completion, modified) tuples for the current course.
+        """
+        queryset = BlockCompletion.objects.filter(user_id__in=user_ids, course_key=course_key)
+        if block_keys is not None:
+            queryset = queryset.filter(block_key__in=block_keys)
+        return queryset.annotate(
+            raw_block_key=ExpressionWrapper(F('block_key'), output_field=CharField()),
+        ).values_list('user_id', 'raw_block_key', 'completion', 'modified')
+
     def get_children(self, course_blocks, block_key):
         """
         Return children for the given block.
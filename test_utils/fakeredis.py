@@ -0,0 +1,152 @@
+"""
+An in-memory stand-in for the parts of the redis client used by completion_aggregator.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import six
+
+
+def _bytes(value):
+    """
+    Encode a value the way redis stores it.
+    """
+    if isinstance(value, bytes):
+        return value
+    return six.text_type(value).encode('utf-8')
+
+
+class FakeRedis(object):
+    """
+    Implements the sorted set, hash, set, pipeline, and transaction commands of redis.StrictRedis.
+
+    Commands run one at a time, so watched keys never change during a
+    transaction.
+
+    Like redis, values are returned as bytes.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def zadd(self, name, mapping, nx=False):
+        zset = self.data.setdefault(_bytes(name), {})
+        added = 0
+        for member, score in mapping.items():
+            member = _bytes(member)
+            if member not in zset:
+                added += 1
+            elif nx:
+                continue
+            zset[member] = float(score)
+        return added
+
+    def zrange(self, name, start, end):
+        zset = self.data.get(_bytes(name), {})
+        members = [member for member, _ in sorted(zset.items(), key=lambda item: (item[1], item[0]))]
+        if end == -1:
+            return members[start:]
+        return members[start:end + 1]
+
+    def zrangebyscore(self, name, min_score, max_score):
+        return [
+            member for member in self.zrange(name, 0, -1)
+            if float(min_score) <= self.zscore(name, member) <= float(max_score)
+        ]
+
+    def zrem(self, name, *members):
+        zset = self.data.get(_bytes(name), {})
+        removed = sum(1 for member in members if zset.pop(_bytes(member), None) is not None)
+        if not zset:
+            # Like redis, remove empty sets.
+            self.data.pop(_bytes(name), None)
+        return removed
+
+    def zscore(self, name, member):
+        return self.data.get(_bytes(name), {}).get(_bytes(member))
+
+    def zcard(self, name):
+        return len(self.data.get(_bytes(name), {}))
+
+    def hset(self, name, key, value):
+        fields = self.data.setdefault(_bytes(name), {})
+        added = int(_bytes(key) not in fields)
+        fields[_bytes(key)] = _bytes(value)
+        return added
+
+    def hgetall(self, name):
+        return dict(self.data.get(_bytes(name), {}))
+
+    def sadd(self, name, *values):
+        members = self.data.setdefault(_bytes(name), set())
+        added = {_bytes(value) for value in values} - members
+        members.update(added)
+        return len(added)
+
+    def srem(self, name, *values):
+        members = self.data.get(_bytes(name), set())
+        removed = members & {_bytes(value) for value in values}
+        members -= removed
+        if not members:
+            self.data.pop(_bytes(name), None)
+        return len(removed)
+
+    def smembers(self, name):
+        return set(self.data.get(_bytes(name), set()))
+
+    def delete(self, *names):
+        return sum(1 for name in names if self.data.pop(_bytes(name), None) is not None)
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return FakePipeline(self)
+
+    def transaction(self, func, *watches, **kwargs):
+        pipe = self.pipeline()
+        pipe.watch(*watches)
+        value = func(pipe)
+        result = pipe.execute()
+        return value if kwargs.get('value_from_callable') else result
+
+
+class FakePipeline(object):
+    """
+    Queue commands, and run them together when executed.
+
+    Like redis, commands run immediately between `watch` and `multi`.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def watch(self, *names):  # pylint: disable=unused-argument
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def reset(self):
+        self.commands = []
+        self.immediate = False
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if self.immediate:
+            return method
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        self.immediate = False
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
@@ -0,0 +1,163 @@
+"""
+Tests of the pacing of enqueued tasks.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+from mock import patch
+from opaque_keys.edx.keys import CourseKey
+
+from django.test import TestCase
+
+from completion_aggregator.backpressure import FixedDelay, RateController
+from completion_aggregator.batch import perform_aggregation
+from completion_aggregator.models import StaleCompletion
+from completion_aggregator.service import AggregatorService
+
+
+class StubQueue(object):
+    """
+    A celery queue whose workers complete `rate` tasks per second.
+    """
+
+    def __init__(self, depth=0, rate=10.0):
+        self.depth = depth
+        self.rate = rate
+        self.now = 0.0
+        self.sleeps = []
+
+    def probe(self):
+        return self.depth
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        self.depth = max(self.depth - int(self.rate * seconds), 0)
+
+    def enqueue(self, controller, count):
+        for _ in range(count):
+            self.depth += 1
+            controller.enqueued()
+
+
+class BackpressureTestCase(TestCase):
+    """
+    Test the pacers.
+    """
+
+    def test_fixed_delay(self):
+        sleeps = []
+        pacer = FixedDelay(0.5, every=3, sleep=sleeps.append)
+        for _ in range(7):
+            pacer.enqueued()
+        assert sleeps == [0.5, 0.5]
+
+    def test_no_sleep_below_target(self):
+        queue = StubQueue()
+        controller = RateController(50, queue.probe, check_every=10, sleep=queue.sleep, clock=queue.clock)
+        queue.enqueue(controller, 50)
+        assert queue.sleeps == []
+
+    def test_paced_by_completion_rate(self):
+        queue = StubQueue(rate=10.0)
+        controller = RateController(
+            20, queue.probe, check_every=10, max_sleep=2.0, sleep=queue.sleep, clock=queue.clock
+        )
+        queue.enqueue(controller, 30)
+        # The rate is unknown until the queue has been measured after a pause.
+        assert queue.sleeps == [2.0]
+        assert controller.completion_rate == 10.0
+        assert queue.depth == 10
+        queue.enqueue(controller, 20)
+        # 10 tasks over the target, completed at 10 tasks per second.
+        assert queue.sleeps == [2.0, 1.0]
+        assert queue.depth == 20
+
+    def test_wait_is_capped(self):
+        queue = StubQueue(depth=100, rate=0.0)
+        controller = RateController(
+            10, queue.probe, check_every=1, max_sleep=2.0, max_wait=5.0, sleep=queue.sleep, clock=queue.clock
+        )
+        controller.enqueued()
+        # The workers have stopped, so enqueueing continues after max_wait.
+        assert queue.sleeps == [2.0, 2.0, 1.0]
+        queue.enqueue(controller, 1)
+        assert queue.sleeps == [2.0, 2.0, 1.0, 2.0, 2.0, 1.0]
+
+    def test_stop_event_ends_wait(self):
+        queue = StubQueue(depth=100, rate=0.0)
+        stopped = threading.Event()
+
+        def sleep(seconds):
+            queue.sleep(seconds)
+            stopped.set()
+
+        controller = RateController(10, queue.probe, check_every=1, stop_event=stopped, sleep=sleep, clock=queue.clock)
+        controller.enqueued()
+        assert queue.sleeps == [5.0]
+        controller.enqueued()
+        assert queue.sleeps == [5.0]
+
+    def test_stop_event_wakes_sleep(self):
+        stopped = threading.Event()
+        stopped.set()
+        controller = RateController(10, lambda: 100, check_every=1, max_wait=3600.0, stop_event=stopped)
+        # Sleeping on the stop event returns at once, rather than after max_sleep.
+        controller.enqueued()
+        assert controller.sleeping == 0.0
+
+    def test_unknown_depth(self):
+        sleeps = []
+        controller = RateController(0, lambda: None, check_every=1, sleep=sleeps.append)
+        for _ in range(5):
+            controller.enqueued()
+        assert sleeps == []
+
+    @patch('completion_aggregator.tasks.aggregation_tasks.update_aggregators.apply_async')
+    def test_perform_aggregation_with_pacer(self, mock_task):
+        course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        for username in ['spy', 'vsspy', 'counterspy']:
+            StaleCompletion.objects.create(username=username, course_key=course_key)
+        queue = StubQueue(depth=5, rate=1.0)
+        mock_task.side_effect = lambda *args, **kwargs: setattr(queue, 'depth', queue.depth + 1)
+        controller = RateController(5, queue.probe, check_every=1, sleep=queue.sleep, clock=queue.clock)
+        assert perform_aggregation(pacer=controller) == 3
+        assert mock_task.call_count == 3
+        assert queue.sleeps
+        assert queue.depth <= 5
+
+    @patch('completion_aggregator.tasks.aggregation_tasks.update_aggregators.apply_async')
+    def test_lanes_paced_by_own_queue(self, mock_task):
+        course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        StaleCompletion.objects.create(username='spy', course_key=course_key, block_key=None, force=True)
+        StaleCompletion.objects.create(
+            username='vsspy',
+            course_key=course_key,
+            block_key=course_key.make_usage_key('html', 'intro'),
+        )
+        interactive = StubQueue(depth=0)
+        bulk = StubQueue(depth=50, rate=50.0)
+        assert perform_aggregation(
+            pacer=RateController(5, interactive.probe, check_every=1, sleep=interactive.sleep, clock=interactive.clock),
+            bulk_pacer=RateController(5, bulk.probe, check_every=1, sleep=bulk.sleep, clock=bulk.clock),
+        ) == 2
+        assert mock_task.call_count == 2
+        assert interactive.sleeps == []
+        assert bulk.sleeps
+
+    @patch('completion_aggregator.backpressure.get_celery_queue_depth')
+    def test_service_pacers(self, mock_depth):
+        service = AggregatorService(routing_key='aggregator', target_backlog=100, bulk_routing_key='aggregator.bulk')
+        pacers = service._get_pacers()  # pylint: disable=protected-access
+        assert pacers['pacer'].stop_event is service._stopped  # pylint: disable=protected-access
+        assert pacers['bulk_pacer'].stop_event is service._stopped  # pylint: disable=protected-access
+        pacers['bulk_pacer'].probe()
+        mock_depth.assert_called_once_with('aggregator.bulk')
+        shared = AggregatorService(routing_key='aggregator', target_backlog=100)
+        assert set(shared._get_pacers()) == {'pacer'}  # pylint: disable=protected-access
+        assert AggregatorService(routing_key='aggregator')._get_pacers() == {}  # pylint: disable=protected-access
@@ -19,7 +19,9 @@ from django.test import TestCase, override_settings
 from completion.models import BlockCompletion
 from completion_aggregator.batch import perform_aggregation, perform_cleanup
 from completion_aggregator.models import StaleCompletion
+from completion_aggregator.stale import RedisStaleBackend, StaleEntry
 from test_utils.compat import StubCompat
+from test_utils.fakeredis import FakeRedis
 from test_utils.xblocks import CourseBlock, HTMLBlock, OtherAggBlock
 
 
@@ -131,10 +133,38 @@ def test_with_no_blocks(mock_task, users):
     assert mock_task.call_count == 1
 
 
+@patch('completion_aggregator.tasks.aggregation_tasks.update_aggregators_in_bulk.apply_async')
+def test_with_users_per_task(mock_task, users, django_user_model):
+    users.append(django_user_model.objects.create(username='Counterspy'))
+    course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+    for user in users:
+        StaleCompletion.objects.create(username=user.username, course_key=course_key, block_key=None)
+    StaleCompletion.objects.create(
+        username=users[0].username,
+        course_key=CourseKey.from_string('course-v1:OpenCraft+Offboarding+2018'),
+        block_key=None,
+        force=True,
+    )
+    perform_aggregation(users_per_task=2)
+    assert mock_task.call_count == 3
+    enrollments = {}
+    for call in mock_task.call_args_list:
+        kwargs = call[1]['kwargs']
+        assert 1 <= len(kwargs['enrollments']) <= 2
+        for enrollment in kwargs['enrollments']:
+            enrollments[(enrollment['username'], kwargs['course_key'])] = enrollment['force']
+    assert enrollments == {
+        ('Spy', 'course-v1:OpenCraft+Onboarding+2018'): False,
+        ('VsSpy', 'course-v1:OpenCraft+Onboarding+2018'): False,
+        ('Counterspy', 'course-v1:OpenCraft+Onboarding+2018'): False,
+        ('Spy', 'course-v1:OpenCraft+Offboarding+2018'): True,
+    }
+
+
 def test_plethora_of_stale_completions(users):
     course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
 
-    with patch('completion_aggregator.batch.MAX_KEYS_PER_TASK', new=3) as max_keys:
+    with patch('completion_aggregator.stale.MAX_KEYS_PER_TASK', new=3) as max_keys:
         for i in range(max_keys + 1):
             StaleCompletion.objects.create(
                 username=users[0].username,
@@ -202,3 +232,50 @@ def compat_patch(course_key):
         course_key.make_usage_key('vertical', 'course-vertical'),
         course_key.make_usage_key('html', 'course-vertical-html'),
     ]))
+
+
+@patch('completion_aggregator.tasks.aggregation_tasks.update_aggregators.apply_async')
+def test_priority_lanes(mock_task, users):
+    course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+    block_key = course_key.make_usage_key('html', 'html0')
+    StaleCompletion.objects.create(username=users[0].username, course_key=course_key, block_key=block_key)
+    StaleCompletion.objects.create(username=users[1].username, course_key=course_key, block_key=None)
+    StaleCompletion.objects.create(username='Counterspy', course_key=course_key, block_key=block_key, force=True)
+    assert perform_aggregation(routing_key='fast', bulk_routing_key='slow', bulk_limit=1) == 2
+    routing = {call[1]['kwargs']['username']: call[1]['routing_key'] for call in mock_task.call_args_list}
+    # Counterspy is newer, so fills the bulk lane first.
+    assert routing == {users[0].username: 'fast', 'Counterspy': 'slow'}
+    # Once the enqueued tasks have run, the deferred work is picked up.
+    StaleCompletion.objects.exclude(username=users[1].username).update(resolved=True)
+    mock_task.reset_mock()
+    assert perform_aggregation(routing_key='fast', bulk_routing_key='slow', bulk_limit=1) == 1
+    assert mock_task.call_args[1]['kwargs']['username'] == users[1].username
+    assert mock_task.call_args[1]['routing_key'] == 'slow'
+
+
+@override_settings(COMPLETION_AGGREGATOR_BULK_ROUTING_KEY='slow')
+@patch('completion_aggregator.tasks.aggregation_tasks.update_aggregators.apply_async')
+def test_deferred_work_requeued(mock_task):
+    course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+    backend = RedisStaleBackend(client=FakeRedis())
+    backend.mark_stale([
+        StaleEntry('Spy', course_key, None, False),
+        StaleEntry('VsSpy', course_key, course_key.make_usage_key('html', 'html0'), True),
+    ])
+    scores = {
+        username: backend.client.zscore(backend.queue_key, backend._member(username, course_key))
+        for username in ['Spy', 'VsSpy']
+    }
+    with patch('completion_aggregator.stale.get_stale_backend', return_value=backend):
+        assert perform_aggregation(interactive_limit=0, bulk_limit=1) == 1
+    mock_task.assert_called_once()
+    assert mock_task.call_args[1]['routing_key'] == 'slow'
+    enqueued = mock_task.call_args[1]['kwargs']['username']
+    [deferred] = {'Spy', 'VsSpy'} - {enqueued}
+    # The deferred work keeps its place in the queue, and its blocks.
+    assert backend.client.zscore(backend.queue_key, backend._member(deferred, course_key)) == scores[deferred]
+    with patch('completion_aggregator.stale.time.time', return_value=max(scores.values()) + 1):
+        backend.mark_stale([StaleEntry('Newcomer', course_key, None, False)])
+    work = backend.get_stale_work(10, 1, 16)
+    assert [item.username for item in work] == [deferred]
+    assert work[0].force == (deferred == 'VsSpy')
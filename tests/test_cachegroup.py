@@ -0,0 +1,163 @@
+"""
+Tests of the grouped cache.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from datetime import timedelta
+
+from mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from completion_aggregator.cachegroup import DELETE_INVALIDATIONS_AFTER, CacheGroup, purge_invalidations
+from completion_aggregator.models import CacheGroupInvalidation
+
+
+class CacheGroupTestCase(TestCase):
+    """
+    Test the invalidation of cache groups.
+    """
+
+    def setUp(self):
+        super(CacheGroupTestCase, self).setUp()
+        cache.clear()
+        CacheGroup.clear_local()
+        self.addCleanup(cache.clear)
+        self.addCleanup(CacheGroup.clear_local)
+        self.cache_group = CacheGroup()
+        self.cache_group.set('course-a', 'key-a1', 'a1', timeout=60)
+        self.cache_group.set('course-a', 'key-a2', 'a2', timeout=60)
+        self.cache_group.set('course-b', 'key-b1', 'b1', timeout=60)
+
+    def test_get_many(self):
+        with self.assertNumQueries(1):
+            assert self.cache_group.get_many(['key-a1', 'key-a2', 'key-b1', 'key-c1']) == {
+                'key-a1': 'a1',
+                'key-a2': 'a2',
+                'key-b1': 'b1',
+            }
+        # Group invalidations are now cached.
+        with self.assertNumQueries(0):
+            assert self.cache_group.get('key-a1') == 'a1'
+        CacheGroup.clear_local()
+        with self.assertNumQueries(0):
+            assert self.cache_group.get('key-a1') == 'a1'
+
+    def test_delete_group(self):
+        self.cache_group.get_many(['key-a1', 'key-b1'])
+        self.cache_group.delete_group('course-a')
+        with self.assertNumQueries(0):
+            assert self.cache_group.get_many(['key-a1', 'key-a2', 'key-b1']) == {'key-b1': 'b1'}
+
+        # Other processes see the invalidation once their local copy expires.
+        CacheGroup.clear_local()
+        cache.delete(CacheGroup.invalidation_key_template.format(group='course-a'))
+        with self.assertNumQueries(1):
+            assert self.cache_group.get('key-a1') is None
+
+        # Entries cached after the invalidation are valid.
+        self.cache_group.set('course-a', 'key-a1', 'new-a1', timeout=60)
+        assert self.cache_group.get('key-a1') == 'new-a1'
+
+        self.cache_group.delete_group('course-a')
+        assert CacheGroupInvalidation.objects.filter(group='course-a').count() == 1
+
+    def test_invalidation_during_read_kept(self):
+        def invalidate_during_read(*args):  # pylint: disable=unused-argument
+            # Another process invalidates the group after the database is read.
+            CacheGroup().delete_group('course-a')
+            return []
+
+        with patch.object(CacheGroupInvalidation.objects, 'filter') as mock_filter:
+            mock_filter.return_value.values_list.side_effect = invalidate_during_read
+            self.cache_group.get('key-a1')
+        CacheGroup.clear_local()
+        assert self.cache_group.get('key-a1') is None
+
+    def test_purge_invalidations(self):
+        for i in range(5):
+            CacheGroupInvalidation.objects.create(
+                group='course-old{}'.format(i),
+                invalidated_at=timezone.now() - DELETE_INVALIDATIONS_AFTER - timedelta(days=i + 1),
+            )
+        self.cache_group.delete_group('course-a')
+        with self.assertNumQueries(6):
+            # Three batches, each a select and a delete.
+            assert purge_invalidations(batch_size=2) == 5
+        assert list(CacheGroupInvalidation.objects.values_list('group', flat=True)) == ['course-a']
+
+    def test_local_invalidations_expire(self):
+        self.cache_group.get('key-a1')
+        with patch('completion_aggregator.cachegroup.time.time', return_value=10 ** 10):
+            with patch('completion_aggregator.cachegroup.cache.get_many', return_value={}):
+                with self.assertNumQueries(1):
+                    self.cache_group.get_invalidations(['course-a'])
+
+
+@override_settings(COMPLETION_AGGREGATOR_VERSIONED_CACHE_GROUPS=True)
+class VersionedCacheGroupTestCase(TestCase):
+    """
+    Test the invalidation of versioned cache groups.
+    """
+
+    def setUp(self):
+        super(VersionedCacheGroupTestCase, self).setUp()
+        cache.clear()
+        CacheGroup.clear_local()
+        self.addCleanup(cache.clear)
+        self.addCleanup(CacheGroup.clear_local)
+        self.cache_group = CacheGroup()
+        self.cache_group.set('course-a', 'key-a1', 'a1', timeout=60)
+        self.cache_group.set('course-b', 'key-b1', 'b1', timeout=60)
+
+    def test_delete_group(self):
+        with self.assertNumQueries(0):
+            assert CacheGroup().get_many(['key-a1', 'key-b1']) == {'key-a1': 'a1', 'key-b1': 'b1'}
+            CacheGroup().delete_group('course-a')
+            assert CacheGroup().get_many(['key-a1', 'key-b1']) == {'key-b1': 'b1'}
+        assert not CacheGroupInvalidation.objects.exists()
+
+    def test_versions_memoized(self):
+        CacheGroup().get('key-a1')
+        with patch('completion_aggregator.cachegroup.cache.get_many', wraps=cache.get_many) as mock_get_many:
+            assert CacheGroup().get('key-a1') == 'a1'
+        # Each CacheGroup reads the entry, but not the version, with a single round trip.
+        mock_get_many.assert_called_once_with(['key-a1'])
+
+        # Once the process's copy is gone, the version is read again.
+        CacheGroup.clear_local()
+        with patch('completion_aggregator.cachegroup.cache.get_many', wraps=cache.get_many) as mock_get_many:
+            assert CacheGroup().get('key-a1') == 'a1'
+        assert mock_get_many.call_count == 2
+
+    def test_evicted_version(self):
+        cache.delete(CacheGroup.version_key_template.format(group='course-a'))
+        CacheGroup.clear_local()
+        assert CacheGroup().get('key-a1') is None
+        self.cache_group.delete_group('course-b')
+        cache.delete(CacheGroup.version_key_template.format(group='course-b'))
+        CacheGroup().delete_group('course-b')
+        assert CacheGroup().get('key-b1') is None
+
+    def test_switching_modes(self):
+        CacheGroup(versioned=False).set('course-a', 'key-a2', 'a2', timeout=60)
+        assert CacheGroup().get('key-a2') is None
+        assert CacheGroup(versioned=False).get('key-a1') is None
+
+
+class CleanupCommandTestCase(TestCase):
+    """
+    Test that the cleanup command purges old invalidations.
+    """
+
+    def test_command(self):
+        CacheGroupInvalidation.objects.create(
+            group='course-old',
+            invalidated_at=timezone.now() - DELETE_INVALIDATIONS_AFTER - timedelta(days=1),
+        )
+        call_command('run_aggregator_cleanup', invalidation_batch_size=10)
+        assert not CacheGroupInvalidation.objects.exists()
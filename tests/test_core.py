@@ -4,6 +4,7 @@ Testing the functionality of asynchronous tasks
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import pickle
 from collections import namedtuple
 from datetime import timedelta
 
@@ -15,11 +16,14 @@ from opaque_keys.edx.keys import CourseKey
 from xblock.core import XBlock
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.utils.timezone import now
 
 from completion.models import BlockCompletion
-from completion_aggregator.core import OLD_DATETIME, AggregationUpdater
+from completion_aggregator.core import (OLD_DATETIME, AggregationPlan, AggregationUpdater, CompactCourseBlocks,
+                                        CourseBlocksEntry, StructureCache, calculate_updated_aggregators,
+                                        update_aggregators_in_bulk)
 from completion_aggregator.models import Aggregator, StaleCompletion
 from completion_aggregator.tasks import aggregation_tasks
 from test_utils.compat import StubCompat
@@ -110,13 +114,12 @@ class AggregationUpdaterTestCase(TestCase):
                 - auth_user (fetch user details)
                 - completion_aggregator_aggregator (user specific for specific course)
                 - completion_blockcompletion (user specific)
-                - auth user (fetch user details)
             * Insert or Update Query
                 - completion_aggregator_aggregator (insert aggregation data)
             * Update query
                 - completion_aggregator_stalecompletion (user specific)
         '''
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(5):
             aggregation_tasks.update_aggregators(username='saskia', course_key='course-v1:edx+course+test')
         self.agg.refresh_from_db()
         assert self.agg.last_modified > self.agg_modified
@@ -551,6 +554,481 @@ class PartialUpdateTest(TestCase):
         self.assertEqual(course_agg.last_modified, new_completions[1].modified)
 
 
+class DeltaUpdateTestCase(TestCase):
+    """
+    Test that changes are applied by difference to the aggregators on the path to the root.
+    """
+    def setUp(self):
+        super(DeltaUpdateTestCase, self).setUp()
+        self.user = get_user_model().objects.create()
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        self.blocks = [
+            self.course_key.make_usage_key('course', 'course'),
+            self.course_key.make_usage_key('chapter', 'course-chapter1'),
+            self.course_key.make_usage_key('chapter', 'course-chapter2'),
+            self.course_key.make_usage_key('html', 'course-chapter1-block1'),
+            self.course_key.make_usage_key('html', 'course-chapter1-block2'),
+            self.course_key.make_usage_key('html', 'course-chapter2-block1'),
+            self.course_key.make_usage_key('html', 'course-chapter2-block2'),
+            self.course_key.make_usage_key('sequential', 'course-chapter1-seq'),
+            self.course_key.make_usage_key('html', 'course-chapter1-seq-html'),
+        ]
+        patch = mock.patch('completion_aggregator.core.compat', StubCompat(self.blocks))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def complete(self, block_key, completion):
+        BlockCompletion.objects.update_or_create(
+            user=self.user,
+            course_key=self.course_key,
+            block_key=block_key,
+            defaults={'completion': completion},
+        )
+
+    def get_values(self):
+        return {
+            agg.block_key: (agg.earned, agg.possible, agg.last_modified)
+            for agg in Aggregator.objects.filter(user=self.user, course_key=self.course_key)
+        }
+
+    def assert_matches_recalculation(self):
+        values = self.get_values()
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update(force=True)
+        assert values == self.get_values()
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'sequential')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_only_ancestors_loaded(self):
+        self.complete(self.blocks[3], 1.0)
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update()
+        self.complete(self.blocks[5], 0.5)
+
+        updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+        with mock.patch.object(updater, 'update_for_plan') as mock_recalculate:
+            with mock.patch(
+                'completion_aggregator.core.compat.get_block_completion_values',
+                wraps=StubCompat(self.blocks).get_block_completion_values,
+            ) as mock_get_completions:
+                updater.update(changed_blocks={self.blocks[5]})
+        mock_recalculate.assert_not_called()
+        # Neither the other chapter, nor the sequential beneath it, is loaded.
+        assert set(updater._aggregators) == {self.blocks[0], self.blocks[2]}  # pylint: disable=protected-access
+        assert set(mock_get_completions.call_args[0][2]) == {self.blocks[5], self.blocks[6]}
+        values = self.get_values()
+        assert values[self.blocks[0]][:2] == (1.5, 5.0)
+        assert values[self.blocks[2]][:2] == (0.5, 2.0)
+        self.assert_matches_recalculation()
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'sequential')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_idempotent(self):
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update()
+        self.complete(self.blocks[8], 0.75)
+        for _ in range(2):
+            AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update(changed_blocks={self.blocks[8]})
+        values = self.get_values()
+        assert values[self.blocks[7]][:2] == (0.75, 1.0)
+        assert values[self.blocks[1]][:2] == (0.75, 3.0)
+        assert values[self.blocks[0]][:2] == (0.75, 5.0)
+
+        # Changing the completion again replaces the earlier value.
+        self.complete(self.blocks[8], 0.25)
+        updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+        updater.update(changed_blocks={self.blocks[8]})
+        assert self.get_values()[self.blocks[0]][:2] == (0.25, 5.0)
+        updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+        with mock.patch.object(Aggregator.objects, 'bulk_create_or_update') as mock_write:
+            updater.update(changed_blocks={self.blocks[8]})
+        mock_write.assert_called_once_with([])
+        self.assert_matches_recalculation()
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'sequential')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_nested_changes(self):
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update()
+        # One change directly beneath the chapter, and one beneath its sequential.
+        self.complete(self.blocks[3], 1.0)
+        self.complete(self.blocks[8], 0.5)
+        self.complete(self.blocks[6], 1.0)
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update(
+            changed_blocks={self.blocks[3], self.blocks[8], self.blocks[6]},
+        )
+        values = self.get_values()
+        assert values[self.blocks[7]][:2] == (0.5, 1.0)
+        assert values[self.blocks[1]][:2] == (1.5, 3.0)
+        assert values[self.blocks[0]][:2] == (2.5, 5.0)
+        self.assert_matches_recalculation()
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'sequential')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_falls_back_on_structure_change(self):
+        self.complete(self.blocks[5], 1.0)
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update()
+        # Simulate an aggregator that was calculated against an older course structure.
+        Aggregator.objects.filter(block_key=self.blocks[2]).update(possible=3.0, earned=0.0, percent=0.0)
+        self.complete(self.blocks[6], 1.0)
+
+        updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+        assert updater.calculate_delta_aggregators({self.blocks[6]}) is None
+        assert updater.updated_aggregators == []
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update(changed_blocks={self.blocks[6]})
+        values = self.get_values()
+        assert values[self.blocks[2]][:2] == (2.0, 2.0)
+        assert values[self.blocks[0]][:2] == (2.0, 5.0)
+        self.assert_matches_recalculation()
+
+
+class IncrementalUpdateTestCase(TestCase):
+    """
+    Test that incremental updates only load and recalculate the affected parts of the course.
+    """
+    def setUp(self):
+        super(IncrementalUpdateTestCase, self).setUp()
+        self.user = get_user_model().objects.create()
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        self.blocks = [
+            self.course_key.make_usage_key('course', 'course'),
+            self.course_key.make_usage_key('chapter', 'course-chapter1'),
+            self.course_key.make_usage_key('chapter', 'course-chapter2'),
+            self.course_key.make_usage_key('html', 'course-chapter1-block1'),
+            self.course_key.make_usage_key('html', 'course-chapter1-block2'),
+            self.course_key.make_usage_key('html', 'course-chapter2-block1'),
+            self.course_key.make_usage_key('html', 'course-chapter2-block2'),
+        ]
+        patch = mock.patch('completion_aggregator.core.compat', StubCompat(self.blocks))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_partial_update_loads_affected_completions(self):
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update()
+        BlockCompletion.objects.create(
+            user=self.user,
+            course_key=self.course_key,
+            block_key=self.blocks[5],
+            completion=1.0,
+        )
+        updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+        with mock.patch(
+            'completion_aggregator.core.compat.get_block_completion_values',
+            wraps=StubCompat(self.blocks).get_block_completion_values,
+        ) as mock_get_completions:
+            updater.update(changed_blocks={self.blocks[5]})
+
+        # Only the completions in the affected chapter are loaded.
+        mock_get_completions.assert_called_once()
+        user_ids, course_key, block_keys = mock_get_completions.call_args[0]
+        assert (user_ids, course_key) == ([self.user.id], self.course_key)
+        assert set(block_keys) == {self.blocks[5], self.blocks[6]}
+        chap2_agg = Aggregator.objects.get(course_key=self.course_key, block_key=self.blocks[2])
+        self.assertEqual(chap2_agg.earned, 1.0)
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'sequential')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @override_settings(COMPLETION_AGGREGATOR_DELTA_UPDATES=False)
+    def test_partial_update_loads_affected_aggregators(self):
+        sequential = self.course_key.make_usage_key('sequential', 'course-chapter1-seq')
+        blocks = self.blocks + [sequential, self.course_key.make_usage_key('html', 'course-chapter1-seq-html')]
+        with mock.patch('completion_aggregator.core.compat', StubCompat(blocks)):
+            AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update()
+            assert Aggregator.objects.filter(block_key=sequential).exists()
+            BlockCompletion.objects.create(
+                user=self.user,
+                course_key=self.course_key,
+                block_key=self.blocks[5],
+                completion=1.0,
+            )
+            updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+            updater.update(changed_blocks={self.blocks[5]})
+
+        # The sequential is beneath the unaffected chapter, so it is not loaded.
+        loaded = set(updater._aggregators)  # pylint: disable=protected-access
+        assert loaded == {self.blocks[0], self.blocks[1], self.blocks[2]}
+        course_agg = Aggregator.objects.get(course_key=self.course_key, block_key=self.blocks[0])
+        self.assertEqual(course_agg.earned, 1.0)
+        self.assertEqual(course_agg.possible, 5.0)
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_unchanged_aggregators_not_written(self):
+        BlockCompletion.objects.create(
+            user=self.user,
+            course_key=self.course_key,
+            block_key=self.blocks[3],
+            completion=1.0,
+        )
+        AggregationUpdater(self.user, self.course_key, mock.MagicMock()).update()
+        modified = dict(Aggregator.objects.values_list('block_key', 'modified'))
+
+        updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+        with mock.patch.object(Aggregator.objects, 'bulk_create_or_update') as mock_write:
+            updater.update(force=True)
+        mock_write.assert_called_once_with([])
+        assert updater.skipped_writes == 3
+        assert len(updater.updated_aggregators) == 3
+
+        BlockCompletion.objects.create(
+            user=self.user,
+            course_key=self.course_key,
+            block_key=self.blocks[5],
+            completion=1.0,
+        )
+        updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+        updater.update(force=True)
+        assert updater.skipped_writes == 1
+        assert dict(Aggregator.objects.values_list('block_key', 'modified'))[self.blocks[1]] == modified[self.blocks[1]]
+        assert Aggregator.objects.get(block_key=self.blocks[0]).earned == 2.0
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_bulk_update(self):
+        other_user = get_user_model().objects.create(username='other')
+        completed = [(self.user, self.blocks[3]), (other_user, self.blocks[5]), (other_user, self.blocks[6])]
+        for user, block_key in completed:
+            BlockCompletion.objects.create(user=user, course_key=self.course_key, block_key=block_key, completion=1.0)
+        StaleCompletion.objects.update(resolved=True)
+        StaleCompletion.objects.create(username=self.user.username, course_key=self.course_key, block_key=None)
+        StaleCompletion.objects.create(
+            username=other_user.username,
+            course_key=self.course_key,
+            block_key=self.blocks[5],
+        )
+
+        update_aggregators_in_bulk(self.course_key, [
+            (self.user, set(), False),
+            (other_user, {self.blocks[5], self.blocks[6]}, False),
+        ])
+        expected = {
+            (self.user.id, self.blocks[0]): 1.0,
+            (self.user.id, self.blocks[1]): 1.0,
+            (self.user.id, self.blocks[2]): 0.0,
+            (other_user.id, self.blocks[0]): 2.0,
+            (other_user.id, self.blocks[1]): 0.0,
+            (other_user.id, self.blocks[2]): 2.0,
+        }
+        earned = {
+            (agg.user_id, agg.block_key): agg.earned for agg in Aggregator.objects.filter(course_key=self.course_key)
+        }
+        self.assertEqual(earned, expected)
+        assert not StaleCompletion.objects.filter(resolved=False).exists()
+
+
+class SharedStructureTestCase(TestCase):
+    """
+    Test that users with the same view of a course share its structure.
+    """
+    def setUp(self):
+        super(SharedStructureTestCase, self).setUp()
+        self.users = [
+            get_user_model().objects.create(username='spy'),
+            get_user_model().objects.create(username='vsspy'),
+        ]
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        self.blocks = [
+            self.course_key.make_usage_key('course', 'course'),
+            self.course_key.make_usage_key('chapter', 'course-chapter1'),
+            self.course_key.make_usage_key('html', 'course-chapter1-block1'),
+        ]
+        StructureCache.clear_local()
+        self.addCleanup(StructureCache.clear_local)
+        self.addCleanup(cache.clear)
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @override_settings(COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES=True)
+    def test_structure_shared_between_users(self):
+        stub = StubCompat(self.blocks, course_version='v1')
+        with mock.patch('completion_aggregator.core.compat', stub):
+            with mock.patch.object(stub, 'init_course_blocks', wraps=stub.init_course_blocks) as mock_init:
+                updaters = [AggregationUpdater(user, self.course_key, mock.MagicMock()) for user in self.users]
+                for updater in updaters:
+                    updater.update()
+                assert mock_init.call_count == 1
+                assert updaters[0].plan is updaters[1].plan
+
+                # The structure is also found in the django cache by other processes.
+                StructureCache.clear_local()
+                AggregationUpdater(self.users[0], self.course_key, mock.MagicMock())
+                assert mock_init.call_count == 1
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @override_settings(COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES=True)
+    def test_structure_not_shared_without_signature(self):
+        stub = StubCompat(self.blocks)
+        with mock.patch('completion_aggregator.core.compat', stub):
+            with mock.patch.object(stub, 'init_course_blocks', wraps=stub.init_course_blocks) as mock_init:
+                for user in self.users:
+                    AggregationUpdater(user, self.course_key, mock.MagicMock()).update()
+                assert mock_init.call_count == 2
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @override_settings(COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES=False)
+    def test_structure_shared_in_bulk(self):
+        stub = StubCompat(self.blocks, course_version='v1')
+        with mock.patch('completion_aggregator.core.compat', stub):
+            with mock.patch.object(stub, 'init_course_blocks', wraps=stub.init_course_blocks) as mock_init:
+                update_aggregators_in_bulk(self.course_key, [(user, set(), False) for user in self.users])
+                assert mock_init.call_count == 1
+        # Without the setting, the structure is not kept for other tasks.
+        assert StructureCache(self.course_key, self.blocks[0], ('v1', ())).get() is None
+        assert Aggregator.objects.filter(course_key=self.course_key).count() == 4
+
+
+class CompactCourseBlocksTestCase(TestCase):
+    """
+    Test the compact course structure stored in the updater caches.
+    """
+    def setUp(self):
+        super(CompactCourseBlocksTestCase, self).setUp()
+        course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        self.course = course_key.make_usage_key('course', 'course')
+        self.chapters = [course_key.make_usage_key('chapter', 'chapter{}'.format(i)) for i in range(3)]
+        self.html = [course_key.make_usage_key('html', 'html{}'.format(i)) for i in range(30)]
+        self.structure = {
+            self.course: CourseBlocksEntry(children=self.chapters, aggregators=[]),
+        }
+        for i, chapter in enumerate(self.chapters):
+            self.structure[chapter] = CourseBlocksEntry(
+                children=self.html[i * 10:i * 10 + 10],
+                aggregators=[self.course],
+            )
+        for i, html in enumerate(self.html):
+            self.structure[html] = CourseBlocksEntry(children=[], aggregators=[self.course, self.chapters[i // 10]])
+
+    def test_mapping(self):
+        compact = CompactCourseBlocks(self.structure)
+        assert len(compact) == len(self.structure)
+        assert set(compact) == set(self.structure)
+        for block, entry in self.structure.items():
+            assert block in compact
+            assert compact[block] == entry
+        unknown = self.course.course_key.make_usage_key('html', 'unknown')
+        assert unknown not in compact
+        assert compact.get(unknown) is None
+        with pytest.raises(KeyError):
+            compact[unknown]  # pylint: disable=pointless-statement
+
+    def test_pickling(self):
+        compact = pickle.loads(pickle.dumps(CompactCourseBlocks(self.structure), pickle.HIGHEST_PROTOCOL))
+        assert len(pickle.dumps(compact)) < len(pickle.dumps(self.structure))
+        # Keys are only created when they are looked up.
+        assert all(block is None for block in compact._blocks)  # pylint: disable=protected-access
+        assert compact[self.chapters[1]] == self.structure[self.chapters[1]]
+        assert set(compact) == set(self.structure)
+
+
+class AggregationPlanTestCase(TestCase):
+    """
+    Test the flattened course traversal used by the AggregationUpdater.
+    """
+    def setUp(self):
+        super(AggregationPlanTestCase, self).setUp()
+        self.user = get_user_model().objects.create()
+        self.course_key = CourseKey.from_string('OpenCraft/Onboarding/2018')
+        self.blocks = [
+            self.course_key.make_usage_key('course', 'course'),
+            self.course_key.make_usage_key('chapter', 'course-chapter1'),
+            self.course_key.make_usage_key('chapter', 'course-chapter2'),
+            self.course_key.make_usage_key('html', 'course-chapter1-block1'),
+            self.course_key.make_usage_key('html', 'course-chapter1-block2'),
+            self.course_key.make_usage_key('hidden', 'course-chapter2-block1'),
+        ]
+        patch = mock.patch('completion_aggregator.core.compat', StubCompat(self.blocks))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @XBlock.register_temp_plugin(HiddenBlock, 'hidden')
+    def test_plan_is_post_ordered(self):
+        plan = AggregationUpdater(self.user, self.course_key, mock.MagicMock()).plan
+        assert len(plan) == len(self.blocks)
+        assert plan.blocks[plan.root] == self.blocks[0]
+        assert plan.parents[plan.root] == -1
+        assert plan.first[plan.root] == 0
+        for index, block in enumerate(plan.blocks):
+            if index != plan.root:
+                parent = plan.parents[index]
+                assert parent > index
+                assert plan.first[parent] <= plan.first[index] <= index
+                assert block.block_id.startswith(plan.blocks[parent].block_id + '-')
+        assert plan.registered == [block.block_type in {'course', 'chapter'} for block in plan.blocks]
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @XBlock.register_temp_plugin(HiddenBlock, 'hidden')
+    @override_settings(COMPLETION_AGGREGATOR_SHARE_COURSE_STRUCTURES=False)
+    def test_plan_cached_with_structure(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        BlockCompletion.objects.create(
+            user=self.user,
+            course_key=self.course_key,
+            block_key=self.blocks[3],
+            completion=1.0,
+        )
+        with mock.patch.object(AggregationPlan, 'get_mode', wraps=AggregationPlan.get_mode) as mock_get_mode:
+            first = calculate_updated_aggregators(self.user, self.course_key, force=True)
+            second = calculate_updated_aggregators(self.user, self.course_key, force=True)
+        # The plan is compiled once, and then read from the updater cache with the course blocks.
+        assert mock_get_mode.call_count == len(self.blocks)
+        assert {(agg.block_key, agg.earned) for agg in second} == {(agg.block_key, agg.earned) for agg in first}
+        assert {(agg.block_key, agg.earned) for agg in second} == {
+            (self.blocks[0], 1.0),
+            (self.blocks[1], 1.0),
+            (self.blocks[2], 0.0),
+        }
+
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_plan_pickling(self):
+        course_blocks = CompactCourseBlocks({
+            self.blocks[1]: CourseBlocksEntry(children=self.blocks[3:5], aggregators=[]),
+            self.blocks[3]: CourseBlocksEntry(children=[], aggregators=[self.blocks[1]]),
+            self.blocks[4]: CourseBlocksEntry(children=[], aggregators=[self.blocks[1]]),
+        })
+        plan = AggregationPlan(course_blocks, self.blocks[1])
+        restored = pickle.loads(pickle.dumps(plan, pickle.HIGHEST_PROTOCOL))
+        # Keys are only created when they are looked up.
+        assert all(block is None for block in restored.blocks._items)  # pylint: disable=protected-access
+        assert list(restored.blocks) == list(plan.blocks) == [self.blocks[3], self.blocks[4], self.blocks[1]]
+        assert list(restored.keys) == [six.text_type(block) for block in plan.blocks]
+        assert restored.node(self.blocks[4]) == 1
+        assert self.blocks[2] not in restored
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(OtherAggBlock, 'chapter')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @XBlock.register_temp_plugin(HiddenBlock, 'hidden')
+    def test_modes_resolved_once_per_block_type(self):
+        with mock.patch.object(XBlock, 'load_class', wraps=XBlock.load_class) as mock_load_class:
+            updater = AggregationUpdater(self.user, self.course_key, mock.MagicMock())
+            updater.calculate_updated_aggregators()
+            updater.calculate_updated_aggregators(force=True)
+        assert mock_load_class.call_count == 4
+
+
 class TaskArgumentHandlingTestCase(TestCase):
     """
     Celery tasks must be called with primitive python types.
@@ -596,3 +1074,21 @@ class TaskArgumentHandlingTestCase(TestCase):
             self.block_keys,
             False,
         )
+
+    @mock.patch('completion_aggregator.core.update_aggregators_in_bulk')
+    def test_calling_bulk_task(self, mock_update):
+        with self.assertNumQueries(1):
+            aggregation_tasks.update_aggregators_in_bulk(
+                course_key='course-v1:OpenCraft+Onboarding+2018',
+                enrollments=[
+                    {
+                        'username': 'sandystudent',
+                        'block_keys': [
+                            'block-v1:OpenCraft+Onboarding+2018+type@html+block@course-chapter-html0',
+                            'block-v1:OpenCraft+Onboarding+2018+type@html+block@course-chapter-html1',
+                        ],
+                        'force': False,
+                    },
+                ],
+            )
+        mock_update.assert_called_once_with(self.course_key, [(self.user, self.block_keys, False)])
@@ -0,0 +1,196 @@
+"""
+Tests of the tasks run by signal handlers.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from datetime import timedelta
+
+import six
+from mock import patch
+from opaque_keys.edx.keys import CourseKey
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+
+from completion_aggregator.models import Aggregator, PendingStaleCourse, StaleCompletion
+from completion_aggregator.tasks.handler_tasks import (mark_all_stale, mark_due_courses_stale,
+                                                       mark_pending_course_stale, schedule_mark_all_stale)
+from completion_aggregator.utils import iter_active_user_chunks
+
+
+@override_settings(COMPLETION_AGGREGATOR_ASYNC_AGGREGATION=True)
+class MarkAllStaleTestCase(TestCase):
+    """
+    Test marking every learner in a course stale.
+    """
+
+    def setUp(self):
+        super(MarkAllStaleTestCase, self).setUp()
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        other_course_key = CourseKey.from_string('course-v1:OpenCraft+Offboarding+2018')
+        self.users = [get_user_model().objects.create(username='user{}'.format(i)) for i in range(5)]
+        for user in self.users[:4]:
+            for block_key in [self.course_key.make_usage_key('course', 'course'),
+                              self.course_key.make_usage_key('chapter', 'chapter')]:
+                self.submit(user, block_key)
+        self.submit(self.users[4], other_course_key.make_usage_key('course', 'course'))
+        patcher = patch('completion_aggregator.tasks.handler_tasks.CacheGroup')
+        self.mock_cache_group = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def submit(self, user, block_key):
+        Aggregator.objects.submit_completion(
+            user=user,
+            course_key=block_key.course_key,
+            block_key=block_key,
+            aggregation_name=block_key.block_type,
+            earned=1.0,
+            possible=2.0,
+            last_modified=now(),
+        )
+
+    def test_iter_active_user_chunks(self):
+        chunks = list(iter_active_user_chunks(self.course_key, 3))
+        assert chunks == [
+            [(user.id, user.username) for user in self.users[:3]],
+            [(self.users[3].id, self.users[3].username)],
+        ]
+        chunks = list(iter_active_user_chunks(
+            self.course_key, 10, fields=('username',), user_id_range=(self.users[1].id, self.users[2].id),
+        ))
+        assert chunks == [[('user1',), ('user2',)]]
+
+    @override_settings(COMPLETION_AGGREGATOR_MARK_ALL_STALE_CHUNK_SIZE=3)
+    def test_mark_all_stale_in_chunks(self):
+        mark_all_stale(self.course_key)
+        self.mock_cache_group().delete_group.assert_called_once_with(six.text_type(self.course_key))
+        assert set(StaleCompletion.objects.values_list('username', 'course_key', 'block_key', 'force')) == {
+            ('user{}'.format(i), self.course_key, None, True) for i in range(4)
+        }
+
+    @override_settings(COMPLETION_AGGREGATOR_MARK_ALL_STALE_USERS_PER_TASK=3)
+    def test_fan_out(self):
+        with patch('completion_aggregator.tasks.handler_tasks.mark_all_stale.delay') as mock_delay:
+            mark_all_stale(self.course_key)
+        assert [call[1] for call in mock_delay.call_args_list] == [
+            {'course_key': self.course_key, 'user_id_range': (self.users[0].id, self.users[2].id)},
+            {'course_key': self.course_key, 'user_id_range': (self.users[3].id, self.users[3].id)},
+        ]
+        assert not StaleCompletion.objects.exists()
+        self.mock_cache_group().delete_group.assert_called_once_with(six.text_type(self.course_key))
+        for call in mock_delay.call_args_list:
+            mark_all_stale(**call[1])
+        assert set(StaleCompletion.objects.values_list('username', flat=True)) == {
+            'user{}'.format(i) for i in range(4)
+        }
+
+    def test_given_users(self):
+        mark_all_stale(self.course_key, users=[self.users[4]])
+        assert list(StaleCompletion.objects.values_list('username', flat=True)) == ['user4']
+
+
+@override_settings(
+    COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_SECONDS=60,
+    COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_MAX_DELAY=150,
+)
+@patch('completion_aggregator.tasks.handler_tasks.mark_all_stale')
+@patch('completion_aggregator.tasks.handler_tasks.mark_pending_course_stale.apply_async')
+class DebounceTestCase(TestCase):
+    """
+    Test that repeated course-wide stale markings are collapsed.
+    """
+
+    def setUp(self):
+        super(DebounceTestCase, self).setUp()
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        self.start = now()
+
+    def at(self, seconds):
+        return patch('completion_aggregator.tasks.handler_tasks.timezone.now', return_value=self.start + timedelta(
+            seconds=seconds,
+        ))
+
+    def test_repeated_publishes_collapsed(self, mock_schedule, mock_mark_all_stale):
+        with self.at(0):
+            schedule_mark_all_stale(self.course_key)
+        mock_schedule.assert_called_once_with(kwargs={'course_key': six.text_type(self.course_key)}, countdown=60)
+        for seconds in (30, 50):
+            with self.at(seconds):
+                schedule_mark_all_stale(self.course_key)
+        assert mock_schedule.call_count == 1
+        assert PendingStaleCourse.objects.get().run_at == self.start + timedelta(seconds=110)
+
+        # The task scheduled for the first publish postpones itself.
+        with self.at(60):
+            mark_pending_course_stale(six.text_type(self.course_key))
+        assert not mock_mark_all_stale.called
+        assert mock_schedule.call_args[1]['countdown'] == 50
+
+        with self.at(110):
+            mark_pending_course_stale(six.text_type(self.course_key))
+        mock_mark_all_stale.assert_called_once_with(self.course_key)
+        assert not PendingStaleCourse.objects.exists()
+
+    def test_kept_if_marking_fails(self, mock_schedule, mock_mark_all_stale):
+        with self.at(0):
+            schedule_mark_all_stale(self.course_key)
+        mock_mark_all_stale.side_effect = RuntimeError
+        with self.at(60), self.assertRaises(RuntimeError):
+            mark_pending_course_stale(six.text_type(self.course_key))
+        # The course is put back, so it is tried again.
+        assert PendingStaleCourse.objects.get().run_at == self.start + timedelta(seconds=60)
+        mock_mark_all_stale.side_effect = None
+        with self.at(61):
+            mark_pending_course_stale(six.text_type(self.course_key))
+        assert mock_mark_all_stale.call_count == 2
+        assert not PendingStaleCourse.objects.exists()
+
+    def test_max_delay(self, mock_schedule, mock_mark_all_stale):
+        for seconds in range(0, 200, 40):
+            with self.at(seconds):
+                schedule_mark_all_stale(self.course_key)
+        assert PendingStaleCourse.objects.get().run_at == self.start + timedelta(seconds=150)
+
+    @patch('completion_aggregator.tasks.handler_tasks.mark_pending_course_stale.delay')
+    def test_lost_tasks_recovered(self, mock_delay, mock_schedule, mock_mark_all_stale):
+        with self.at(0):
+            schedule_mark_all_stale(self.course_key)
+            mark_due_courses_stale()
+        assert not mock_delay.called
+        # Courses are only enqueued once they are overdue by the sweep interval.
+        with self.at(61):
+            mark_due_courses_stale()
+        assert not mock_delay.called
+        with self.at(120):
+            mark_due_courses_stale()
+        mock_delay.assert_called_once_with(course_key=six.text_type(self.course_key))
+        # Its task is given another interval to run before it is enqueued again.
+        with self.at(150):
+            mark_due_courses_stale()
+        assert mock_delay.call_count == 1
+        with self.at(180):
+            mark_due_courses_stale()
+        assert mock_delay.call_count == 2
+
+    def test_publish_while_marking(self, mock_schedule, mock_mark_all_stale):
+        with self.at(0):
+            schedule_mark_all_stale(self.course_key)
+
+        def publish(course_key):
+            # The course is no longer pending, so the publish records it again.
+            assert not PendingStaleCourse.objects.exists()
+            with self.at(65):
+                schedule_mark_all_stale(course_key)
+        mock_mark_all_stale.side_effect = publish
+        with self.at(60):
+            mark_pending_course_stale(six.text_type(self.course_key))
+        assert PendingStaleCourse.objects.get().run_at == self.start + timedelta(seconds=125)
+        assert mock_schedule.call_count == 2
+
+    @override_settings(COMPLETION_AGGREGATOR_STALE_COURSE_DEBOUNCE_SECONDS=0)
+    def test_disabled(self, mock_schedule, mock_mark_all_stale):
+        schedule_mark_all_stale(self.course_key)
+        mock_mark_all_stale.delay.assert_called_once_with(course_key=self.course_key)
+        assert not PendingStaleCourse.objects.exists()
@@ -9,11 +9,12 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import ddt
 import pytest
 import six
+from mock import patch
 from opaque_keys.edx.keys import UsageKey
 
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.timezone import now
 
 from completion_aggregator.models import Aggregator
@@ -215,3 +216,56 @@ class AggregatorTestCase(TestCase):
         values = aggregator.get_values()
         self.assertEqual(values['user'], self.user.id)
         self.assertEqual(values['percent'], expected_percent)
+        row = aggregator.get_row()
+        self.assertEqual(row[:3], (self.user.id, six.text_type(block_key_obj.course_key), six.text_type(block_key_obj)))
+        self.assertEqual(row[6], expected_percent)
+        self.assertEqual(row[7], values['last_modified'])
+
+    def _make_aggregators(self, count, earned):
+        """
+        Return unsaved aggregators for `count` different chapters.
+        """
+        return [
+            Aggregator(
+                user=self.user,
+                course_key=self.COURSE_KEY_OBJ,
+                block_key=self.COURSE_KEY_OBJ.make_usage_key('chapter', 'chapter{}'.format(i)),
+                aggregation_name='chapter',
+                earned=earned,
+                possible=2.0,
+                last_modified=now(),
+            ) for i in range(count)
+        ]
+
+    def assert_stored(self, aggregators):
+        """
+        Assert that the stored aggregators have the values of the given aggregators.
+        """
+        self.assertEqual(
+            {
+                six.text_type(block_key): (earned, percent)
+                for block_key, earned, percent in Aggregator.objects.values_list('block_key', 'earned', 'percent')
+            },
+            {
+                six.text_type(aggregator.block_key): (aggregator.earned, aggregator.earned / aggregator.possible)
+                for aggregator in aggregators
+            },
+        )
+
+    @override_settings(COMPLETION_AGGREGATOR_UPSERT_BATCH_SIZE=2)
+    def test_bulk_create_or_update(self):
+        aggregators = self._make_aggregators(5, 1.0)
+        with self.assertNumQueries(3):
+            Aggregator.objects.bulk_create_or_update(aggregators)
+        self.assert_stored(aggregators)
+        aggregators = self._make_aggregators(5, 2.0)
+        with self.assertNumQueries(3):
+            Aggregator.objects.bulk_create_or_update(aggregators)
+        self.assert_stored(aggregators)
+
+    @patch('completion_aggregator.models.AggregatorManager._supports_on_conflict', return_value=False)
+    def test_bulk_create_or_update_without_on_conflict(self, _mock_supports):
+        Aggregator.objects.bulk_create_or_update(self._make_aggregators(5, 1.0))
+        aggregators = self._make_aggregators(5, 2.0)
+        Aggregator.objects.bulk_create_or_update(aggregators)
+        self.assert_stored(aggregators)
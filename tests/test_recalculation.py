@@ -0,0 +1,156 @@
+"""
+Tests of the parallel recalculation of stale aggregators.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+
+from mock import patch
+from opaque_keys.edx.keys import CourseKey
+from xblock.core import XBlock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from completion_aggregator import recalculation
+from completion_aggregator.models import Aggregator
+from completion_aggregator.serializers import AggregatorAdapter
+from test_utils.test_blocks import StubCourse
+
+
+class RecalculationTestCase(TestCase):
+    """
+    Test recalculating AggregatorAdapters in a thread pool.
+    """
+
+    def setUp(self):
+        super(RecalculationTestCase, self).setUp()
+        self.user = User.objects.create(username='spy')
+        self.course_keys = [
+            CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018'),
+            CourseKey.from_string('course-v1:OpenCraft+Offboarding+2018'),
+        ]
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.addCleanup(recalculation._in_flight.clear)  # pylint: disable=protected-access
+
+    def make_aggregator(self, course_key, earned):
+        return Aggregator(
+            user=self.user,
+            course_key=course_key,
+            block_key=course_key.make_usage_key('course', 'course'),
+            aggregation_name='course',
+            earned=earned,
+            possible=4.0,
+            percent=earned / 4.0,
+        )
+
+    def make_adapters(self):
+        return [
+            AggregatorAdapter(self.user, course_key, aggregators=[self.make_aggregator(course_key, 1.0)])
+            for course_key in self.course_keys
+        ]
+
+    @override_settings(COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS=None)
+    def test_serial_by_default(self):
+        assert recalculation.get_executor() is None
+
+    @override_settings(COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS=2)
+    def test_shared_executor(self):
+        assert recalculation.get_executor() is recalculation.get_executor()
+
+    @XBlock.register_temp_plugin(StubCourse, 'course')
+    @override_settings(COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS=2)
+    @patch('completion_aggregator.recalculation.db.connections.close_all')
+    @patch('completion_aggregator.recalculation.calculate_updated_aggregators')
+    def test_recalculated_in_parallel(self, mock_calculate, mock_close_all):
+        started = []
+
+        def calculate(user, course_key, root_block=None, force=False):  # pylint: disable=unused-argument
+            # Each recalculation waits for the other to start, so they only
+            # finish if they run at the same time.
+            started.append(course_key)
+            if len(started) == len(self.course_keys):
+                self.release.set()
+            self.release.wait(5)
+            return [self.make_aggregator(course_key, 3.0)]
+
+        mock_calculate.side_effect = calculate
+        adapters = self.make_adapters()
+        recalculation.recalculate(adapters, recalculation.get_executor(), budget=5)
+        assert [adapter.earned for adapter in adapters] == [3.0, 3.0]
+        assert not any(adapter.stale for adapter in adapters)
+        # Each thread closes its database connections when it is done.
+        assert mock_close_all.call_count == 2
+
+    @XBlock.register_temp_plugin(StubCourse, 'course')
+    @override_settings(COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS=2)
+    @patch('completion_aggregator.recalculation.calculate_updated_aggregators')
+    def test_budget_exceeded(self, mock_calculate):
+
+        def calculate(user, course_key, root_block=None, force=False):  # pylint: disable=unused-argument
+            if course_key == self.course_keys[1]:
+                self.release.wait(5)
+            return [self.make_aggregator(course_key, 3.0)]
+
+        mock_calculate.side_effect = calculate
+        adapters = self.make_adapters()
+        recalculation.recalculate(adapters, recalculation.get_executor(), budget=0.5)
+        # The slow course is served from its stored aggregators.
+        assert [adapter.earned for adapter in adapters] == [3.0, 1.0]
+        assert [adapter.stale for adapter in adapters] == [False, True]
+
+    @XBlock.register_temp_plugin(StubCourse, 'course')
+    @override_settings(COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS=2)
+    @patch('completion_aggregator.recalculation.calculate_updated_aggregators')
+    def test_running_recalculation_not_resubmitted(self, mock_calculate):
+
+        def calculate(user, course_key, root_block=None, force=False):  # pylint: disable=unused-argument
+            if course_key == self.course_keys[1]:
+                self.release.wait(5)
+            return [self.make_aggregator(course_key, 3.0)]
+
+        mock_calculate.side_effect = calculate
+        executor = recalculation.get_executor()
+        recalculation.recalculate(self.make_adapters(), executor, budget=0.5)
+        assert mock_calculate.call_count == 2
+        # The slow course is still being recalculated, so a second request
+        # waits on that recalculation, rather than taking another thread.
+        adapters = self.make_adapters()
+        recalculation.recalculate(adapters, executor, budget=0.5)
+        assert mock_calculate.call_count == 3
+        assert [adapter.stale for adapter in adapters] == [False, True]
+        self.release.set()
+        deadline = time.time() + 5
+        while recalculation._in_flight and time.time() < deadline:  # pylint: disable=protected-access
+            time.sleep(0.01)
+        # Once it has finished, the course is recalculated again.
+        adapters = self.make_adapters()
+        recalculation.recalculate(adapters, executor, budget=5)
+        assert mock_calculate.call_count == 5
+        assert [adapter.earned for adapter in adapters] == [3.0, 3.0]
+
+    @XBlock.register_temp_plugin(StubCourse, 'course')
+    @override_settings(COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS=2)
+    @patch('completion_aggregator.recalculation.calculate_updated_aggregators')
+    def test_recalculation_fails(self, mock_calculate):
+
+        def calculate(user, course_key, root_block=None, force=False):  # pylint: disable=unused-argument
+            if course_key == self.course_keys[1]:
+                raise ValueError("Course structure unavailable")
+            return [self.make_aggregator(course_key, 3.0)]
+
+        mock_calculate.side_effect = calculate
+        adapters = self.make_adapters()
+        recalculation.recalculate(adapters, recalculation.get_executor(), budget=5)
+        # The failed course is served from its stored aggregators, and the other is still recalculated.
+        assert [adapter.earned for adapter in adapters] == [3.0, 1.0]
+        assert [adapter.stale for adapter in adapters] == [False, True]
+
+    @override_settings(COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET=None)
+    @patch('completion_aggregator.recalculation.futures.wait', return_value=(set(), set()))
+    def test_default_budget(self, mock_wait):
+        recalculation.recalculate([], recalculation.futures.ThreadPoolExecutor(max_workers=1))
+        assert mock_wait.call_args[1]['timeout'] == recalculation.DEFAULT_RECALCULATION_BUDGET
@@ -0,0 +1,132 @@
+"""
+Tests of the continuously running aggregator service.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from mock import patch
+from opaque_keys.edx.keys import CourseKey
+
+from django.test import TestCase
+
+from completion_aggregator.models import StaleCompletion
+from completion_aggregator.service import AggregatorService
+from completion_aggregator.stale import TableStaleBackend
+
+
+@patch('completion_aggregator.tasks.aggregation_tasks.update_aggregators.apply_async')
+class AggregatorServiceTestCase(TestCase):
+    """
+    Test the cycles of the aggregator service.
+    """
+
+    def setUp(self):
+        super(AggregatorServiceTestCase, self).setUp()
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+
+    def mark_stale(self, *usernames):
+        for username in usernames:
+            StaleCompletion.objects.create(username=username, course_key=self.course_key)
+
+    def test_idle_backoff(self, mock_task):
+        service = AggregatorService(min_sleep=1.0, max_sleep=5.0)
+        assert [service.run_cycle().sleep for _ in range(4)] == [2.0, 4.0, 5.0, 5.0]
+        self.mark_stale('spy')
+        metrics = service.run_cycle()
+        assert metrics.enrollments == 1
+        assert metrics.sleep == 1.0
+        assert mock_task.call_count == 1
+
+    def test_full_cycle(self, mock_task):
+        self.mark_stale('spy', 'vsspy', 'counterspy')
+        service = AggregatorService(limit=2, batch_size=2, min_sleep=1.0)
+        metrics = service.run_cycle()
+        assert metrics.enrollments == 2
+        assert metrics.sleep == 0.0
+        # The tasks run, and resolve their stale work.
+        StaleCompletion.objects.exclude(username='spy').update(resolved=True)
+        metrics = service.run_cycle()
+        assert metrics.enrollments == 1
+        assert metrics.sleep == 1.0
+        assert mock_task.call_count == 3
+
+    def test_limit_counts_stale_blocks(self, mock_task):
+        StaleCompletion.objects.bulk_create([
+            StaleCompletion(
+                username='spy',
+                course_key=self.course_key,
+                block_key=self.course_key.make_usage_key('html', 'html{}'.format(i)),
+            ) for i in range(3)
+        ])
+        service = AggregatorService(limit=2, min_sleep=1.0)
+        metrics = service.run_cycle()
+        # A single enrollment filled the limit of stale blocks.
+        assert metrics.enrollments == 1
+        assert metrics.sleep == 0.0
+        assert mock_task.call_count == 1
+
+    def test_in_flight_enrollments_do_not_starve_older_work(self, mock_task):
+        self.mark_stale('spy', 'vsspy')
+        service = AggregatorService(limit=1, batch_size=1)
+        assert service.run_cycle().enrollments == 1
+        # The newest enrollment is still in flight, so the scan continues
+        # past it to the older one.
+        assert service.run_cycle().enrollments == 1
+        assert [call[1]['kwargs']['username'] for call in mock_task.call_args_list] == ['vsspy', 'spy']
+
+    def test_scan_limited(self, mock_task):
+        self.mark_stale('spy', 'vsspy')
+        service = AggregatorService(limit=1, batch_size=1, scan_limit=1)
+        assert service.run_cycle().enrollments == 1
+        # The scan stops at the newest enrollment, which is still in flight,
+        # rather than reading the rest of the backlog.
+        with patch.object(
+            TableStaleBackend,
+            '_iter_stale_rows',
+            side_effect=TableStaleBackend._iter_stale_rows,  # pylint: disable=protected-access
+        ) as mock_rows:
+            assert service.run_cycle().enrollments == 0
+        mock_rows.assert_called_once_with(1, 1)
+        assert mock_task.call_count == 1
+
+    def test_backpressure(self, mock_task):
+        self.mark_stale('spy')
+        depths = [10, 3]
+        service = AggregatorService(max_queue_depth=5, queue_depth=depths.pop)
+        metrics = service.run_cycle()
+        assert metrics.enrollments == 1
+        assert metrics.queue_depth == 3
+        metrics = service.run_cycle()
+        assert metrics.enrollments is None
+        assert metrics.queue_depth == 10
+        assert mock_task.call_count == 1
+
+    def test_in_flight_enrollments_not_requeued(self, mock_task):
+        self.mark_stale('spy')
+        service = AggregatorService(requeue_after=60.0)
+        with patch('completion_aggregator.service.time.time', return_value=1000.0):
+            assert service.run_cycle().enrollments == 1
+            self.mark_stale('vsspy')
+            assert service.run_cycle().enrollments == 1
+        with patch('completion_aggregator.service.time.time', return_value=1061.0):
+            assert service.run_cycle().enrollments == 2
+        assert [call[1]['kwargs']['username'] for call in mock_task.call_args_list] == [
+            'spy', 'vsspy', 'vsspy', 'spy',
+        ]
+
+    @patch('completion_aggregator.service.handler_tasks.mark_due_courses_stale')
+    def test_overdue_courses_swept_less_often(self, mock_sweep, mock_task):
+        service = AggregatorService()
+        for seconds in (1000.0, 1001.0, 1059.0, 1060.0):
+            with patch('completion_aggregator.service.time.time', return_value=seconds):
+                service.run_cycle()
+        assert mock_sweep.call_count == 2
+
+    def test_run_until_stopped(self, mock_task):
+        service = AggregatorService(min_sleep=0.0, max_sleep=0.0)
+        service.run(max_cycles=3)
+        assert service.cycles == 3
+        service.stop()
+        service.run()
+        assert service.cycles == 3
+        assert mock_task.call_count == 0
@@ -10,7 +10,8 @@ from mock import patch
 from opaque_keys.edx.keys import CourseKey, UsageKey
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils.timezone import now
 
 from completion.models import BlockCompletion
@@ -110,3 +111,114 @@ class SignalsTestCase(TestCase):
         with patch('completion_aggregator.core.compat', StubCompat([])):
             cohort_updated_handler(user, course_key)
             assert StaleCompletion.objects.filter(username=user.username, course_key=course_key, force=True).exists()
+
+
+@override_settings(COMPLETION_AGGREGATOR_COALESCE_STALE_COMPLETIONS=True)
+class CoalescedStaleCompletionTestCase(TransactionTestCase):
+    """
+    Test that StaleCompletions are written once per transaction when coalescing is enabled.
+    """
+    def setUp(self):
+        super(CoalescedStaleCompletionTestCase, self).setUp()
+        self.user = get_user_model().objects.create(username='coalescer')
+        self.course_key = CourseKey.from_string('course-v1:edX+test+2018')
+        self.block_keys = [self.course_key.make_usage_key('video', 'video{}'.format(i)) for i in range(2)]
+
+    def save_completions(self):
+        """
+        Save three completions of two blocks.
+        """
+        for completion, block_key in [(0.5, self.block_keys[0]), (1.0, self.block_keys[0]), (1.0, self.block_keys[1])]:
+            BlockCompletion.objects.update_or_create(
+                user=self.user,
+                course_key=self.course_key,
+                block_key=block_key,
+                defaults={'completion': completion},
+            )
+
+    def test_coalesced_on_commit(self):
+        with transaction.atomic():
+            self.save_completions()
+            assert not StaleCompletion.objects.exists()
+        self.assertEqual(
+            set(StaleCompletion.objects.values_list('block_key', flat=True)),
+            set(self.block_keys),
+        )
+        assert StaleCompletion.objects.count() == 2
+
+    def test_flushed_after_savepoint_rollback(self):
+        with transaction.atomic():
+            with transaction.atomic():
+                self.save_completions()
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    BlockCompletion.objects.create(
+                        user=self.user,
+                        course_key=self.course_key,
+                        block_key=self.course_key.make_usage_key('video', 'rolled-back'),
+                        completion=1.0,
+                    )
+                    raise ValueError
+        # Blocks buffered in the rolled back savepoint are marked stale too,
+        # which only causes a redundant update.
+        assert StaleCompletion.objects.count() == 3
+
+    def test_flush_registered_once(self):
+        on_commit = patch('completion_aggregator.signals.transaction.on_commit', wraps=transaction.on_commit)
+        with on_commit as mock_on_commit:
+            with transaction.atomic():
+                self.save_completions()
+                with transaction.atomic():
+                    self.save_completions()
+        assert mock_on_commit.call_count == 1
+        assert StaleCompletion.objects.count() == 2
+
+    def test_registered_again_after_savepoint_rollback(self):
+        with transaction.atomic():
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    self.save_completions()
+                    raise ValueError
+            # The flush registered in the rolled back savepoint was discarded
+            # with it, so the next block registers it again.
+            BlockCompletion.objects.create(
+                user=self.user,
+                course_key=self.course_key,
+                block_key=self.course_key.make_usage_key('video', 'committed'),
+                completion=1.0,
+            )
+        self.assertEqual(
+            list(StaleCompletion.objects.values_list('block_key', flat=True)),
+            [self.course_key.make_usage_key('video', 'committed')],
+        )
+
+    def test_cleared_after_rollback(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.save_completions()
+                raise ValueError
+        # Blocks buffered by a rolled back transaction are not marked stale
+        # by the next one.
+        with transaction.atomic():
+            BlockCompletion.objects.create(
+                user=self.user,
+                course_key=self.course_key,
+                block_key=self.course_key.make_usage_key('video', 'committed'),
+                completion=1.0,
+            )
+        self.assertEqual(
+            list(StaleCompletion.objects.values_list('block_key', flat=True)),
+            [self.course_key.make_usage_key('video', 'committed')],
+        )
+
+    @override_settings(COMPLETION_AGGREGATOR_DEDUPE_STALE_COMPLETIONS=True)
+    def test_deduplicated(self):
+        StaleCompletion.objects.create(
+            username=self.user.username,
+            course_key=self.course_key,
+            block_key=self.block_keys[0],
+        )
+        with transaction.atomic():
+            self.save_completions()
+        assert StaleCompletion.objects.filter(block_key=self.block_keys[0]).count() == 1
+        assert StaleCompletion.objects.filter(block_key=self.block_keys[1]).count() == 1
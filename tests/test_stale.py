@@ -0,0 +1,329 @@
+"""
+Tests of the stale work backends.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+from datetime import timedelta
+
+import six
+from mock import patch
+from opaque_keys.edx.keys import CourseKey
+
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+
+from completion_aggregator.batch import perform_aggregation
+from completion_aggregator.models import StaleCompletion, StaleEnrollment
+from completion_aggregator.stale import EnrollmentStaleBackend, RedisStaleBackend, StaleEntry, TableStaleBackend
+from completion_aggregator.utils import BagOfHolding
+from test_utils.fakeredis import FakeRedis
+
+
+class TableStaleBackendTestCase(TestCase):
+    """
+    Test the streaming scan of the StaleCompletion table.
+    """
+
+    def setUp(self):
+        super(TableStaleBackendTestCase, self).setUp()
+        self.backend = TableStaleBackend()
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        self.block_keys = [self.course_key.make_usage_key('html', 'html{}'.format(i)) for i in range(4)]
+
+    def test_sparse_ids(self):
+        for i in range(10):
+            StaleCompletion.objects.create(
+                username='user{}'.format(i),
+                course_key=self.course_key,
+                block_key=self.block_keys[0],
+                resolved=i % 3 != 0,
+            )
+        # Each page skips the resolved rows, and a short page ends the scan.
+        with self.assertNumQueries(2):
+            work = self.backend.get_stale_work(batch_size=3, limit=None, max_keys=16)
+        assert [item.username for item in work] == ['user9', 'user6', 'user3', 'user0']
+
+    def test_limit(self):
+        for i in range(5):
+            StaleCompletion.objects.create(username='user{}'.format(i), course_key=self.course_key)
+        with self.assertNumQueries(2):
+            work = self.backend.get_stale_work(batch_size=2, limit=3, max_keys=16)
+        assert [item.username for item in work] == ['user4', 'user3', 'user2', 'user1']
+
+    @patch.object(TableStaleBackend, 'ENROLLMENTS_PER_FLUSH', new=1)
+    def test_streaming(self):
+        StaleCompletion.objects.create(username='spy', course_key=self.course_key, block_key=self.block_keys[0])
+        StaleCompletion.objects.create(username='vsspy', course_key=self.course_key, block_key=self.block_keys[0])
+        StaleCompletion.objects.create(username='spy', course_key=self.course_key, block_key=self.block_keys[1])
+        StaleCompletion.objects.create(username='spy', course_key=self.course_key, force=True)
+        stream = self.backend.iter_stale_work(batch_size=2, limit=None, max_keys=16)
+        with self.assertNumQueries(1):
+            first = next(stream)
+        assert first.username == 'spy'
+        assert isinstance(first.block_keys, BagOfHolding)
+        assert first.force
+        # The older row for the same enrollment is left for the next run.
+        assert [(item.username, item.block_keys) for item in stream] == [('vsspy', {self.block_keys[0]})]
+
+    @patch.object(TableStaleBackend, 'ENROLLMENTS_PER_FLUSH', new=1)
+    def test_flushed_enrollments_forgotten(self):
+        StaleCompletion.objects.create(username='spy', course_key=self.course_key, block_key=self.block_keys[0])
+        StaleCompletion.objects.create(username='vsspy', course_key=self.course_key, block_key=self.block_keys[0])
+        StaleCompletion.objects.create(username='vsspy', course_key=self.course_key, block_key=self.block_keys[1])
+        StaleCompletion.objects.create(username='spy', course_key=self.course_key, block_key=self.block_keys[1])
+        work = self.backend.get_stale_work(batch_size=1, limit=None, max_keys=16)
+        # Only the previous flush's enrollment is skipped, so the oldest row
+        # is yielded again for the first enrollment.
+        assert [(item.username, item.block_keys) for item in work] == [
+            ('spy', {self.block_keys[1]}),
+            ('vsspy', {self.block_keys[1]}),
+            ('spy', {self.block_keys[0]}),
+        ]
+
+    def test_is_stale_many(self):
+        other_course_key = CourseKey.from_string('course-v1:OpenCraft+Offboarding+2018')
+        StaleCompletion.objects.create(username='spy', course_key=self.course_key)
+        StaleCompletion.objects.create(username='spy', course_key=self.course_key, block_key=self.block_keys[0])
+        StaleCompletion.objects.create(username='vsspy', course_key=other_course_key)
+        StaleCompletion.objects.create(username='vsspy', course_key=self.course_key, resolved=True)
+        with self.assertNumQueries(1):
+            found = self.backend.is_stale_many([
+                ('spy', self.course_key),
+                ('spy', other_course_key),
+                ('vsspy', self.course_key),
+            ])
+        # ('vsspy', other_course_key) matches the query, but was not asked about.
+        assert found == {('spy', self.course_key)}
+        with self.assertNumQueries(0):
+            assert self.backend.is_stale_many([]) == set()
+
+    @override_settings(COMPLETION_AGGREGATOR_DEDUPE_STALE_COMPLETIONS=True)
+    def test_deduplicated_row_not_resolved_by_earlier_update(self):
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[0], False)])
+        StaleCompletion.objects.update(modified=now() - timedelta(minutes=1))
+        start = now()
+        # The block is completed again while an update that started at
+        # `start` is running.
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[0], False)])
+        assert StaleCompletion.objects.count() == 1
+        self.backend.resolve('spy', self.course_key, {self.block_keys[0]}, before=start)
+        assert self.backend.is_stale('spy', self.course_key)
+
+
+class EnrollmentStaleBackendTestCase(TestCase):
+    """
+    Test the per-enrollment stale table.
+    """
+
+    def setUp(self):
+        super(EnrollmentStaleBackendTestCase, self).setUp()
+        self.backend = EnrollmentStaleBackend()
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        self.block_keys = [self.course_key.make_usage_key('html', 'html{}'.format(i)) for i in range(4)]
+
+    def test_one_row_per_enrollment(self):
+        self.backend.mark_stale([
+            StaleEntry('spy', self.course_key, self.block_keys[0], False),
+            StaleEntry('vsspy', self.course_key, self.block_keys[0], False),
+        ])
+        self.backend.mark_stale([
+            StaleEntry('spy', self.course_key, self.block_keys[1], False),
+            StaleEntry('spy', self.course_key, self.block_keys[0], True),
+        ])
+        assert StaleEnrollment.objects.count() == 2
+        assert self.backend.is_stale('spy', self.course_key)
+        work = {item.username: item for item in self.backend.get_stale_work(batch_size=1, limit=None, max_keys=16)}
+        assert work['spy'].block_keys == set(self.block_keys[:2])
+        assert work['spy'].force
+        assert work['vsspy'].block_keys == {self.block_keys[0]}
+        assert not work['vsspy'].force
+
+    @patch('completion_aggregator.stale.MAX_KEYS_PER_TASK', new=2)
+    def test_spill_to_all_blocks(self):
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, block_key, False) for block_key in self.block_keys])
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[0], False)])
+        row = StaleEnrollment.objects.get()
+        assert row.all_blocks
+        assert row.block_keys == ''
+        [work] = self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16)
+        assert isinstance(work.block_keys, BagOfHolding)
+
+    def test_unchanged_row_touched(self):
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[0], False)])
+        StaleEnrollment.objects.update(modified=now() - timedelta(minutes=1))
+        start = now()
+        # The block is completed again after an update has started.
+        with self.assertNumQueries(4):
+            # SAVEPOINT, SELECT ... FOR UPDATE, UPDATE, RELEASE SAVEPOINT
+            self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[0], False)])
+        self.backend.resolve('spy', self.course_key, before=start)
+        self.backend.resolve('spy', self.course_key, {self.block_keys[0]}, before=start)
+        self.backend.resolve_many(['spy'], self.course_key, before=start)
+        assert self.backend.is_stale('spy', self.course_key)
+
+    def test_resolve(self):
+        self.backend.mark_stale([
+            StaleEntry('spy', self.course_key, self.block_keys[0], False),
+            StaleEntry('spy', self.course_key, self.block_keys[1], False),
+        ])
+        # Work on other blocks is still outstanding.
+        self.backend.resolve('spy', self.course_key, {self.block_keys[0]})
+        assert self.backend.is_stale('spy', self.course_key)
+        self.backend.resolve('spy', self.course_key, set(self.block_keys))
+        assert not self.backend.is_stale('spy', self.course_key)
+
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, None, False)])
+        self.backend.resolve('spy', self.course_key, set(self.block_keys))
+        assert self.backend.is_stale('spy', self.course_key)
+        self.backend.resolve_many(['spy'], self.course_key)
+        assert not self.backend.is_stale('spy', self.course_key)
+
+    def test_is_stale_many(self):
+        other_course_key = CourseKey.from_string('course-v1:OpenCraft+Offboarding+2018')
+        self.backend.mark_stale([
+            StaleEntry('spy', self.course_key, self.block_keys[0], False),
+            StaleEntry('vsspy', other_course_key, None, False),
+        ])
+        with self.assertNumQueries(1):
+            found = self.backend.is_stale_many([('spy', self.course_key), ('vsspy', self.course_key)])
+        assert found == {('spy', self.course_key)}
+
+
+class RedisStaleBackendTestCase(TestCase):
+    """
+    Test the redis stale backend against an in-memory stand-in for redis.
+    """
+
+    def setUp(self):
+        super(RedisStaleBackendTestCase, self).setUp()
+        self.client = FakeRedis()
+        self.backend = RedisStaleBackend(client=self.client, prefix='test')
+        self.course_key = CourseKey.from_string('course-v1:OpenCraft+Onboarding+2018')
+        self.other_course_key = CourseKey.from_string('course-v1:OpenCraft+Offboarding+2018')
+        self.block_keys = [self.course_key.make_usage_key('html', 'html{}'.format(i)) for i in range(4)]
+
+    def test_enrollments_deduplicated(self):
+        self.backend.mark_stale([
+            StaleEntry('spy', self.course_key, self.block_keys[0], False),
+            StaleEntry('spy', self.course_key, self.block_keys[1], False),
+            StaleEntry('spy', self.course_key, self.block_keys[0], False),
+            StaleEntry('vsspy', self.course_key, None, True),
+        ])
+        assert self.client.zcard(self.backend.queue_key) == 2
+        assert self.backend.is_stale('spy', self.course_key)
+        assert not self.backend.is_stale('spy', self.other_course_key)
+
+        work = {item.username: item for item in self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16)}
+        assert set(work) == {'spy', 'vsspy'}
+        assert work['spy'].course_key == self.course_key
+        assert work['spy'].block_keys == set(self.block_keys[:2])
+        assert not work['spy'].force
+        assert isinstance(work['vsspy'].block_keys, BagOfHolding)
+        assert work['vsspy'].force
+
+        # Collected work is not collected again, but is still stale until it is resolved.
+        assert self.backend.is_stale('spy', self.course_key)
+        assert self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16) == []
+        self.backend.resolve('spy', self.course_key, set(self.block_keys[:2]))
+        self.backend.resolve_many(['vsspy'], self.course_key)
+        assert not self.backend.is_stale('spy', self.course_key)
+        assert self.client.data == {}
+
+    def test_lease_kept_for_work_collected_after_update_started(self):
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[0], False)])
+        self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16)
+        start = now()
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[1], False)])
+        [work] = self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16)
+        # The new lease also covers the blocks of the update in flight.
+        assert work.block_keys == set(self.block_keys[:2])
+        self.backend.resolve('spy', self.course_key, {self.block_keys[0]}, before=start)
+        assert self.backend.is_stale('spy', self.course_key)
+        # An update of only some of the leased blocks does not release the lease.
+        self.backend.resolve('spy', self.course_key, {self.block_keys[0]}, before=now())
+        assert self.backend.is_stale('spy', self.course_key)
+        self.backend.resolve('spy', self.course_key, set(self.block_keys[:2]), before=now())
+        assert not self.backend.is_stale('spy', self.course_key)
+
+    def test_expired_lease_requeued(self):
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[0], True)])
+        self.backend.mark_stale([StaleEntry('vsspy', self.course_key, self.block_keys[1], False)])
+        score = self.client.zscore(self.backend.queue_key, self.backend._member('spy', self.course_key))
+        assert len(self.backend.get_stale_work(batch_size=1, limit=None, max_keys=16)) == 2
+        assert self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16) == []
+
+        # The update task was lost.
+        with patch('completion_aggregator.stale.time.time', return_value=time.time() + self.backend.lease + 1):
+            work = self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16)
+        assert [(item.username, item.block_keys, item.force) for item in work] == [
+            ('spy', {self.block_keys[0]}, True),
+            ('vsspy', {self.block_keys[1]}, False),
+        ]
+        # The requeued work kept its place in the queue.
+        assert self.client.zscore(self.backend.processing_key, self.backend._member('spy', self.course_key)) > score
+        assert float(
+            self.client.hgetall(self.backend._leased_key(self.backend._member('spy', self.course_key)))[b'!queued']
+        ) == score
+
+    def test_batches_and_limit(self):
+        self.backend.mark_stale(
+            [StaleEntry('user{}'.format(i), self.course_key, self.block_keys[0], False) for i in range(5)]
+        )
+        work = self.backend.get_stale_work(batch_size=2, limit=3, max_keys=16)
+        assert len(work) == 3
+        work.extend(self.backend.get_stale_work(batch_size=2, limit=None, max_keys=16))
+        assert sorted(item.username for item in work) == ['user{}'.format(i) for i in range(5)]
+
+    def test_too_many_blocks(self):
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, block_key, False) for block_key in self.block_keys])
+        [work] = self.backend.get_stale_work(batch_size=10, limit=None, max_keys=3)
+        assert isinstance(work.block_keys, BagOfHolding)
+
+    def test_is_stale_many(self):
+        self.backend.mark_stale([
+            StaleEntry('spy', self.course_key, self.block_keys[0], False),
+            StaleEntry('vsspy', self.other_course_key, None, False),
+        ])
+        found = self.backend.is_stale_many([
+            ('spy', self.course_key),
+            ('spy', self.other_course_key),
+            ('vsspy', self.other_course_key),
+        ])
+        assert found == {('spy', self.course_key), ('vsspy', self.other_course_key)}
+
+    def test_discard(self):
+        self.backend.mark_stale([
+            StaleEntry('spy', self.course_key, self.block_keys[0], False),
+            StaleEntry('spy', self.other_course_key, None, False),
+            StaleEntry('vsspy', self.course_key, None, False),
+        ])
+        self.backend.discard(['spy'], self.course_key)
+        assert not self.backend.is_stale('spy', self.course_key)
+        assert self.backend.is_stale('spy', self.other_course_key)
+        self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16)
+        # Work is found through the users' indexes, rather than by scanning the queue.
+        with patch.object(self.client, 'zrange') as mock_zrange:
+            self.backend.discard(['spy'])
+        mock_zrange.assert_not_called()
+        assert not self.backend.is_stale('spy', self.other_course_key)
+        assert self.backend.is_stale('vsspy', self.course_key)
+        self.backend.discard(['vsspy'])
+        assert self.client.data == {}
+
+    @patch('completion_aggregator.tasks.aggregation_tasks.update_aggregators.apply_async')
+    def test_perform_aggregation(self, mock_task):
+        self.backend.mark_stale([StaleEntry('spy', self.course_key, self.block_keys[0], False)])
+        with patch('completion_aggregator.stale.get_stale_backend', return_value=self.backend):
+            perform_aggregation()
+        mock_task.assert_called_once_with(
+            kwargs={
+                'username': 'spy',
+                'course_key': six.text_type(self.course_key),
+                'block_keys': [six.text_type(self.block_keys[0])],
+                'force': False,
+            },
+        )
+        assert self.backend.is_stale('spy', self.course_key)
+        assert self.backend.get_stale_work(batch_size=10, limit=None, max_keys=16) == []
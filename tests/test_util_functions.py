@@ -8,10 +8,14 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import ddt
 import pytest
+from mock import patch
+from xblock.completable import XBlockCompletionMode
+from xblock.core import XBlock
 
 from django.test import TestCase
 
-from completion_aggregator.utils import get_percent
+from completion_aggregator.utils import CompletionModeRegistry, get_percent
+from test_utils.xblocks import CourseBlock, HiddenBlock, HTMLBlock
 
 
 @ddt.ddt
@@ -32,3 +36,50 @@ class GetPercentTestCase(TestCase):
     def test_get_percent_with_valid_values(self, earned, possible, expected_percentage):
         percentage = get_percent(earned, possible)
         self.assertEqual(percentage, expected_percentage)
+
+
+class CompletionModeRegistryTestCase(TestCase):
+    """
+    Tests of the `CompletionModeRegistry` class
+    """
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @XBlock.register_temp_plugin(HiddenBlock, 'hidden')
+    def test_modes(self):
+        registry = CompletionModeRegistry()
+        assert registry.get('course') == XBlockCompletionMode.AGGREGATOR
+        assert registry.get('html') == XBlockCompletionMode.COMPLETABLE
+        assert registry.get('hidden') == XBlockCompletionMode.EXCLUDED
+        assert registry.get('not-a-block') == XBlockCompletionMode.EXCLUDED
+
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    def test_lookups_are_memoized(self):
+        registry = CompletionModeRegistry()
+        with patch.object(XBlock, 'load_class', wraps=XBlock.load_class) as mock_load_class:
+            for _ in range(3):
+                assert registry.get('html') == XBlockCompletionMode.COMPLETABLE
+            assert mock_load_class.call_count == 1
+            registry.invalidate()
+            assert registry.get('html') == XBlockCompletionMode.COMPLETABLE
+            assert mock_load_class.call_count == 2
+
+    def test_plugin_changes_invalidate(self):
+        registry = CompletionModeRegistry()
+        assert registry.get('html') == XBlockCompletionMode.EXCLUDED
+
+        @XBlock.register_temp_plugin(HTMLBlock, 'html')
+        def check_with_plugin():
+            assert registry.get('html') == XBlockCompletionMode.COMPLETABLE
+
+        check_with_plugin()
+        assert registry.get('html') == XBlockCompletionMode.EXCLUDED
+
+    @XBlock.register_temp_plugin(CourseBlock, 'course')
+    @XBlock.register_temp_plugin(HTMLBlock, 'html')
+    @XBlock.register_temp_plugin(HiddenBlock, 'hidden')
+    def test_bounded_size(self):
+        registry = CompletionModeRegistry(maxsize=2)
+        for block_type in 'course', 'html', 'hidden':
+            registry.get(block_type)
+        assert list(registry._modes) == ['html', 'hidden']  # pylint: disable=protected-access
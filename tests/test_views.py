@@ -4,6 +4,7 @@ Test serialization of completion data.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import json
+import threading
 from datetime import timedelta
 
 import ddt
@@ -19,13 +20,15 @@ from waffle.testutils import override_flag
 from xblock.core import XBlock
 
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
 from completion.models import BlockCompletion, BlockCompletionManager
 from completion_aggregator import models
 from completion_aggregator.api.v1.views import CompletionViewMixin
 from completion_aggregator.core import AggregationUpdater
+from completion_aggregator.serializers import AggregatorAdapter
+from completion_aggregator.stale import TableStaleBackend
 from completion_aggregator.utils import WAFFLE_AGGREGATE_STALE_FROM_SCRATCH
 from test_utils.compat import StubCompat
 from test_utils.test_blocks import StubCourse, StubHTML, StubSequential
@@ -335,6 +338,66 @@ class CompletionViewTestCase(CompletionAPITestMixin, TestCase):
         }
         self.assertEqual(response.data, expected)
 
+    @ddt.data(0, 1)
+    @XBlock.register_temp_plugin(StubCourse, 'course')
+    @XBlock.register_temp_plugin(StubSequential, 'sequential')
+    @XBlock.register_temp_plugin(StubHTML, 'html')
+    @patch.object(TableStaleBackend, 'is_stale')
+    def test_list_view_checks_stale_in_bulk(self, version, mock_is_stale):
+        """
+        Test that staleness is looked up once for the page, rather than once per enrollment.
+        """
+        self.create_enrollment(
+            user=self.test_user,
+            course_id=self.other_org_course_key,
+        )
+        models.StaleCompletion.objects.create(
+            username=self.test_user.username,
+            course_key=self.other_org_course_key,
+            force=True,
+        )
+        with patch.object(AggregatorAdapter, 'update_aggregators', autospec=True) as mock_update_aggregators:
+            response = self.client.get(self.get_list_url(version, username=self.test_user.username))
+        self.assertEqual(response.status_code, 200)
+        assert mock_is_stale.call_count == 0
+        assert {
+            six.text_type(call[0][0].course_key): call[1]['is_stale']
+            for call in mock_update_aggregators.call_args_list
+        } == {
+            'edX/toy/2012_Fall': False,
+            'otherOrg/toy/2012_Fall': True,
+        }
+
+    @ddt.data(0, 1)
+    @XBlock.register_temp_plugin(StubCourse, 'course')
+    @XBlock.register_temp_plugin(StubSequential, 'sequential')
+    @XBlock.register_temp_plugin(StubHTML, 'html')
+    @override_settings(
+        COMPLETION_AGGREGATOR_STALE_RECALCULATION_THREADS=2,
+        COMPLETION_AGGREGATOR_STALE_RECALCULATION_BUDGET=0.1,
+    )
+    @patch('completion_aggregator.recalculation.calculate_updated_aggregators')
+    def test_list_view_recalculation_over_budget(self, version, mock_calculate):
+        """
+        Test that a course whose recalculation takes too long is served from its stored aggregators, flagged as stale.
+        """
+        release = threading.Event()
+        self.addCleanup(release.set)
+        mock_calculate.side_effect = lambda *args, **kwargs: release.wait(5) and []
+        models.StaleCompletion.objects.create(
+            username=self.test_user.username,
+            course_key=self.course_key,
+            force=True,
+        )
+        response = self.client.get(
+            self.get_list_url(version, username=self.test_user.username, requested_fields='stale')
+        )
+        self.assertEqual(response.status_code, 200)
+        [result] = response.data['results']
+        assert result['stale']
+        assert result['completion']['earned'] == 1.0
+        assert mock_calculate.call_count == 1
+
     @ddt.data(0, 1)
     @XBlock.register_temp_plugin(StubCourse, 'course')
     @XBlock.register_temp_plugin(StubSequential, 'sequential')